@@ -3,8 +3,11 @@
 layout(location = 0) in vec4 aPosition;
 
 out vec3 vTexCoord;
-uniform mat4 MVP;
-uniform vec3    scale;
+layout(std140) uniform BBox     // BBox.ubo
+{
+    mat4    MVP;
+    vec3    scale;
+};
 
 void main() {
     vTexCoord = aPosition.xyz;
@@ -0,0 +1,180 @@
+"""
+benchmark_cc6.py
+
+Headless rendering benchmark of the cc6 raycaster: a deterministic camera
+orbit and isolevel sweep over datasets, framebuffer sizes and step sizes.
+Reports p50/p95/p99 frame times, the host time per frame (Python and GL call
+submission; on llvmpipe the shading pass waits for the G-buffer, use --forward
+to see the submission alone), rays/s, EVALs/s and the texture fetches per EVAL
+(--layouts plain packed compares the lattice layouts, see Volume.packed), saves
+them as a baseline and flags regressions against it. Runs on Mesa llvmpipe (EGL by default, set
+PYOPENGL_PLATFORM=osmesa for OSMesa), e.g.
+
+    >> python3 benchmark_cc6.py --volumes ML40 --sizes 64x64 --save-baseline
+    >> python3 benchmark_cc6.py --volumes ML40 --sizes 64x64
+
+"""
+import os
+# PyOpenGL binds its platform when it is first imported
+os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+import sys
+import time
+from OpenGL.GL import *
+import json
+import platform
+import argparse
+import itertools
+import numpy as np
+from raycaster_cc6 import HeadlessContext, Program, Scene, FBO_render, orbit_poses, cost_stats, volumes, open_dataset
+
+def benchmark_poses(info, num_frames, num_levels, sweep=0.05):
+    """ Orbit at the isolevel of the dataset, then a sweep of num_levels isolevels
+    within +-sweep (relative to the level) at a fixed pose."""
+    poses = orbit_poses(num_frames, level=info.level)
+    for level in np.linspace(info.level*(1-sweep), info.level*(1+sweep), num_levels):
+        poses.append({'angle_x': 320, 'angle_y': 30, 'level': float(level)})
+    return poses
+
+def run_config(scene, fbo, poses):
+    """ Renders every pose once to warm up, then timed, then for the host time; returns the
+    statistics of the config."""
+    times = []
+    host = []       # time until Scene.render returns: Python and GL call submission
+    rays = evals = 0
+    scene.timers.enabled = True
+    for pose in poses:
+        scene.set_pose(pose)
+        scene.render(fbo.fbo)
+        glFinish()
+        cost = cost_stats(scene.render_cost())
+        rays += cost['rays']
+        evals += cost['evals']['total'] if 'evals' in cost else 0
+    scene.timers.records = []
+    for pose in poses:
+        scene.set_pose(pose)
+        t = time.perf_counter()
+        scene.render(fbo.fbo)
+        glFinish()
+        times.append(time.perf_counter() - t)
+    scene.timers.collect(wait=True)
+    scene.timers.enabled = False
+    # without the timer queries, which make some drivers (llvmpipe) wait for the passes
+    for pose in poses:
+        scene.set_pose(pose)
+        t = time.perf_counter()
+        scene.render(fbo.fbo)
+        host.append(time.perf_counter() - t)
+        glFinish()
+    times = np.array(times)*1e3
+    result = {'frames': len(times),
+              'p50_ms': float(np.percentile(times, 50)),
+              'p95_ms': float(np.percentile(times, 95)),
+              'p99_ms': float(np.percentile(times, 99)),
+              'host_us_p50': float(np.percentile(host, 50)*1e6),
+              'rays_per_s': rays/(times.sum()*1e-3),
+              'evals_per_s': evals/(times.sum()*1e-3),
+              'evals': evals,
+              'fetches_per_eval': scene.volume.fetches_per_eval}
+    for name, stat in scene.timers.stats().items():
+        result[f'gpu_{name}_p50'] = stat.get('p50')
+    return result
+
+def run(args):
+    sizes = [tuple(int(s) for s in size.lower().split('x')) for size in args.sizes]
+    context = HeadlessContext(max(w for w, h in sizes), max(h for w, h in sizes))
+    glEnable(GL_DEPTH_TEST)
+    results = {}
+    for name in args.volumes:
+        info = open_dataset(name, cache=not args.no_cache)
+        poses = benchmark_poses(info, args.frames, args.levels)
+        for (width, height), layout in itertools.product(sizes, args.layouts):
+            scene = Scene(width, height, info, packed=layout == 'packed')
+            scene.quad_full.deferred = not args.forward
+            # render_cost() counts the EVALs of full marches, the ones the timed frames march without --temporal
+            scene.quad_full.temporal = args.temporal
+            fbo = FBO_render(width, height)
+            for scale_step, scale_delta in itertools.product(args.scale_steps, args.scale_deltas):
+                scene.quad_full.scale_step = scale_step
+                scene.quad_full.scale_delta = scale_delta
+                key = (f'{name}/{width}x{height}/step={scale_step:g}/delta={scale_delta:g}' + ('/forward' if args.forward else '') +
+                       ('/temporal' if args.temporal else '') + ('/packed' if layout == 'packed' else ''))
+                results[key] = run_config(scene, fbo, poses)
+                print_result(key, results[key])
+            fbo.delete()
+    return results
+
+def print_result(key, r):
+    print(f'{key:40s} p50 {r["p50_ms"]:9.2f} ms  p95 {r["p95_ms"]:9.2f} ms  p99 {r["p99_ms"]:9.2f} ms  '
+          f'host {r["host_us_p50"]:7.0f} us  {r["rays_per_s"]/1e6:7.3f} Mrays/s  {r["evals_per_s"]/1e6:8.3f} MEVALs/s  '
+          f'{r["fetches_per_eval"]} fetches/EVAL')
+
+def environment():
+    return {'renderer': glGetString(GL_RENDERER).decode(), 'version': glGetString(GL_VERSION).decode(),
+            'machine': platform.machine(), 'python': platform.python_version()}
+
+def compare(results, baseline, tolerance):
+    """ Returns the regressions of results against the baseline: frame times more than
+    tolerance slower or throughput more than tolerance lower."""
+    regressions = []
+    for key, r in results.items():
+        if key not in baseline:
+            continue
+        b = baseline[key]
+        for stat in ('p50_ms', 'p95_ms'):
+            if r[stat] > b[stat]*(1+tolerance):
+                regressions.append(f'{key}: {stat} {b[stat]:.2f} -> {r[stat]:.2f}')
+        if r['evals_per_s'] < b['evals_per_s']*(1-tolerance):
+            regressions.append(f'{key}: EVALs/s {b["evals_per_s"]:.4g} -> {r["evals_per_s"]:.4g}')
+        if r['evals'] != b['evals']:
+            # not a regression by itself, but the frames no longer do the same work
+            print(f'note: {key}: EVALs per run changed {b["evals"]:.0f} -> {r["evals"]:.0f}')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless rendering benchmark of the cc6 raycaster')
+    parser.add_argument('--volumes', nargs='+', default=['ML40', 'ML50', 'ML80'],
+                        help='registered datasets (' + ', '.join(volumes) + '), lattice files or directories of timesteps, as raycaster_cc6.py')
+    parser.add_argument('--no-cache', action='store_true', help='do not use the on-disk dataset and shader program cache')
+    parser.add_argument('--sizes', nargs='+', default=['64x64', '128x128'], help='framebuffer sizes WxH')
+    parser.add_argument('--scale-steps', nargs='+', type=float, default=[0.001, 0.004])
+    parser.add_argument('--scale-deltas', nargs='+', type=float, default=[0.01])
+    parser.add_argument('--forward', action='store_true', help='shade in the raycast instead of a separate pass over a G-buffer')
+    parser.add_argument('--temporal', action='store_true',
+                        help='temporal ray-start reuse (deferred only); EVALs/s then counts the EVALs of full marches')
+    parser.add_argument('--layouts', nargs='+', default=['plain'], choices=['plain', 'packed'], help='lattice texture layouts (packed: see Volume.packed)')
+    parser.add_argument('--frames', type=int, default=4, help='orbit frames')
+    parser.add_argument('--levels', type=int, default=3, help='isolevels of the sweep')
+    parser.add_argument('--baseline', default='benchmark_baseline.json', help='baseline file to compare with (or to save)')
+    parser.add_argument('--save-baseline', action='store_true', help='save the results as the baseline instead of comparing')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative slowdown flagged as a regression')
+    parser.add_argument('--out', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    if args.no_cache:
+        Program.path_binaries = None
+    results = run(args)
+    report = {'environment': environment(), 'args': vars(args), 'results': results}
+    if args.out:
+        json.dump(report, open(args.out, 'w'), indent=1)
+    if args.save_baseline:
+        json.dump(report, open(args.baseline, 'w'), indent=1)
+        print(f'baseline saved to {args.baseline}')
+        return
+    if not os.path.exists(args.baseline):
+        print(f'no baseline {args.baseline}, run with --save-baseline first')
+        return
+    baseline = json.load(open(args.baseline, 'r'))
+    if baseline['environment']['renderer'] != report['environment']['renderer']:
+        print(f'warning: baseline renderer {baseline["environment"]["renderer"]} differs from {report["environment"]["renderer"]}')
+    missing = set(results) - set(baseline['results'])
+    if missing:
+        print(f'not in the baseline: {", ".join(sorted(missing))}')
+    regressions = compare(results, baseline['results'], args.tolerance)
+    for r in regressions:
+        print(f'REGRESSION {r}')
+    if regressions:
+        sys.exit(1)
+    print('no regressions')
+
+if __name__ == '__main__':
+    main()
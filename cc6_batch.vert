@@ -0,0 +1,21 @@
+#version 330 core
+
+// Batched views: instance i draws the full-screen quad of view i into tile i of an
+// atlas of columns x rows tiles (row-major from the bottom left).
+
+layout(location = 0) in vec2 aPosition;
+layout(location = 1) in vec2 aTexCoord;
+
+uniform int columns;
+uniform int rows;
+
+out vec2 vTexCoord;
+flat out int vView;
+
+void main() {
+    ivec2   tile = ivec2(gl_InstanceID % columns, gl_InstanceID / columns);
+    vec2    p = (vec2(tile) + aTexCoord)/vec2(columns, rows);
+    gl_Position = vec4(2.0*p - 1.0, 0, 1);
+    vTexCoord = aTexCoord;
+    vView = gl_InstanceID;
+}
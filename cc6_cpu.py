@@ -0,0 +1,392 @@
+"""
+cc6_cpu.py
+
+Tile-parallel CPU raycaster of the cc6 isosurface, for render nodes without a GPU.
+
+It follows the forward path of the GPU raycaster step by step: the camera of
+Scene (camera_matrices of cc6_view.py), the analytic bbox intersection, the march with
+empty-space skipping and the root refinement of cc6_raycast_curvature.frag, and
+the Blinn-Phong shading with the curvature colormap (COLORMAP_CURVATURE) of
+cc6_shading.glsl, in float32. Its frames match the GPU frames up to rounding,
+which flips a few pixels at grazing silhouettes.
+
+The image is cut into tiles raycast by a pool of processes. The padded lattice
+is put once into shared memory, so the workers evaluate it with CC6Evaluator
+without a copy, and all the rays of a tile are marched together as NumPy
+batches. Tiles are handed out one at a time, so the pool scales with the cores.
+
+    >> python3 cc6_cpu.py ML40 --size 256x256 --frames 4 --processes 8 --out frames_cpu
+
+"""
+import os
+import time
+import json
+import argparse
+import concurrent.futures
+from multiprocessing import shared_memory
+import numpy as np
+import glm
+import pylab
+from cc6_datasets import LatticeFile, volumes, open_dataset
+from cc6_numpy import CC6Evaluator, compute_minmax, PAD
+from cc6_view import camera_matrices, COLORMAP_CURVATURE
+
+MAX_ITERATIONS = 1000       # as in cc6_raycast_curvature.frag
+MAX_REFINEMENTS = 16
+
+def normalize(v):
+    return v/np.linalg.norm(v, axis=-1, keepdims=True)
+
+#############################################################################################################
+class RayTracer:
+    """ Raycasts tiles of a frame on the CPU, one NumPy batch of rays per tile.
+
+    Positions are in lattice coordinates as in the shader. frame is the dict of
+    CPURaycaster.frame(): the inverse MVP and the MV as Scene.MVP and Scene.MV
+    (the transposes of the GL matrices), the size of the frame and the settings.
+    """
+    size_macro = 8          # as Volume.size_macro
+
+    def __init__(self, info, lattice, minmax):
+        self.evaluator = CC6Evaluator(lattice, padded=True, n_threads=1)
+        self.minmax = minmax
+        self.shape_minmax = np.array(minmax.shape[2::-1])
+        bbox_size_max = max(info.bbox_size)
+        self.scale_norm = np.array([info.scale[i]/bbox_size_max for i in range(3)], np.float32)
+        self.offset_norm = np.array([info.offset[i]/bbox_size_max for i in range(3)], np.float32)
+        self.scale_lattice = np.array([info.bbox_size[i]/info.scale[i] for i in range(3)], np.float32)
+        self.offset_lattice = np.array([-info.offset[i]/info.scale[i] for i in range(3)], np.float32)
+        self.scale_bbox_norm = np.array([info.bbox_size[i]/bbox_size_max for i in range(3)], np.float32)
+        self.dim_max = max(info.dim[:3])
+        self.colormap = np.round(COLORMAP_CURVATURE*255).reshape(3, 3, 3)/255    # RGBA8 texels
+
+    def trace(self, frame, x0, y0, width, height):
+        """ (height, width, 4) uint8 colors of the pixels [x0, x0+width) x [y0, y0+height),
+        bottom row first as glReadPixels."""
+        x, y = np.meshgrid(np.arange(x0, x0+width), np.arange(y0, y0+height))
+        tc = np.stack([(x+.5)/frame['width'], (y+.5)/frame['height']], axis=-1).reshape(-1, 2).astype(np.float32)
+        start, end = self.intersect_bbox(frame['MVP_inv'], tc)
+        color = np.ones((len(tc), 3), np.float32)
+        rays, p, orientation = self.march(frame, start, end)
+        if len(rays):
+            color[rays] = self.shade(frame, p, orientation)
+        rgba = np.concatenate([color, np.ones((len(tc), 1), np.float32)], axis=1)
+        return np.round(np.clip(rgba, 0, 1)*255).astype(np.uint8).reshape(height, width, 4)
+
+    def intersect_bbox(self, MVP_inv, tc):
+        """ intersect_bbox() of the shader, returning the entry and exit in lattice coordinates."""
+        ndc = np.concatenate([2*tc-1, np.zeros((len(tc), 1), np.float32), np.ones((len(tc), 1), np.float32)], axis=1)
+        ndc[:,2] = -1
+        p_near = ndc @ MVP_inv
+        ndc[:,2] = 1
+        p_far = ndc @ MVP_inv
+        o = p_near[:,:3]/p_near[:,3:]
+        d = p_far[:,:3]/p_far[:,3:] - o
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t0 = (-.5*self.scale_bbox_norm - o)/d
+            t1 = (.5*self.scale_bbox_norm - o)/d
+        t_entry = np.maximum(np.minimum(t0, t1).max(axis=1), 0)[:,None]
+        t_exit = np.minimum(np.maximum(t0, t1).min(axis=1), 1)[:,None]
+        hit = t_entry < t_exit
+        entry = np.where(hit, (o + t_entry*d)/self.scale_bbox_norm + .5, 0)
+        exit = np.where(hit, (o + t_exit*d)/self.scale_bbox_norm + .5, 0)
+        return (entry*self.scale_lattice + self.offset_lattice).astype(np.float32), \
+               (exit*self.scale_lattice + self.offset_lattice).astype(np.float32)
+
+    def march(self, frame, start, end):
+        """ Marches all the rays together; returns the rays that hit the isosurface, their
+        refined hits and the orientations (+1: the ray starts below the level)."""
+        level = np.float32(frame['level'])
+        step = np.float32(frame['scale_step']*self.dim_max)
+        len_full = np.linalg.norm(end - start, axis=1)
+        rays = np.flatnonzero(len_full > 0)
+        start, dir, len_full = start[rays], (end - start)[rays]/len_full[rays,None], len_full[rays]
+        len_full = np.minimum(len_full, np.float32(MAX_ITERATIONS + .5)*step)     # as the shader
+        p = start.copy()
+        k = np.zeros(len(rays), np.int64)      # sample k is at start + k*step*dir, as the shader
+        voxel = self.evaluator.value(p)
+        orientation = np.where(voxel < level, 1, -1).astype(np.float32)
+        p_prev, voxel_prev = p.copy(), voxel
+        hits, p_hits = [], []
+
+        active = np.arange(len(rays))
+        for i in range(MAX_ITERATIONS):
+            if not len(active):
+                break
+            if frame['skip_empty']:
+                n_steps = self.steps_to_skip(p[active], dir[active], step, orientation[active], level)
+            else:
+                n_steps = np.ones(len(active), np.int64)
+            k[active] += n_steps
+            length = k[active].astype(np.float32)*step
+            p[active] = start[active] + length[:,None]*dir[active]
+            inside = length <= len_full[active]
+            active, n_steps = active[inside], n_steps[inside]
+
+            voxel = self.evaluator.value(p[active])
+            crossed = orientation[active]*voxel > orientation[active]*level
+            if crossed.any():
+                # the previous sample was skipped: evaluate it for the secant
+                skipped = active[crossed & (n_steps > 1)]
+                p_prev[skipped] = start[skipped] + ((k[skipped] - 1).astype(np.float32)*step)[:,None]*dir[skipped]
+                voxel_prev[skipped] = self.evaluator.value(p_prev[skipped])
+                r = active[crossed]
+                hits.append(r)
+                p_hits.append(self.refine(frame, p_prev[r], voxel_prev[r], p[r], voxel[crossed], dir[r], orientation[r], level))
+            active, voxel = active[~crossed], voxel[~crossed]
+            p_prev[active] = p[active]
+            voxel_prev[active] = voxel
+        if not hits:
+            return np.zeros(0, np.int64), np.zeros((0, 3), np.float32), np.zeros(0, np.float32)
+        hits = np.concatenate(hits)
+        return rays[hits], np.concatenate(p_hits), orientation[hits]
+
+    def steps_to_skip(self, p, dir, dt, orientation, level):
+        """ steps_to_skip() of the shader."""
+        cell = np.clip(np.floor(p/np.float32(self.size_macro)).astype(np.int64), 0, self.shape_minmax-1)
+        minmax = self.minmax[cell[:,2], cell[:,1], cell[:,0]]
+        empty = np.where(orientation > 0, minmax[:,1] <= level, minmax[:,0] >= level)
+        bound = (cell + (dir >= 0))*np.float32(self.size_macro)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.where(dir == 0, np.float32(1e20), (bound - p)/dir)
+        n_steps = np.maximum(1, np.ceil(t.min(axis=1)/dt)).astype(np.int64)
+        return np.where(empty, n_steps, 1)
+
+    def refine(self, frame, p0, f0, p1, f1, dir, orientation, iso):
+        if frame['intersection'] == 'bisection':
+            return self.refine_bisection(frame, p0, f0, p1, f1, orientation, iso)
+        elif frame['intersection'] == 'newton':
+            return self.refine_newton(frame, p0, f0, p1, f1, dir, orientation, iso)
+        return refine_secant(p0, f0, p1, f1, iso)
+
+    def refine_bisection(self, frame, p0, f0, p1, f1, orientation, iso):
+        p0, f0, p1, f1 = p0.copy(), f0.copy(), p1.copy(), f1.copy()
+        tol = np.float32(frame['tolerance']*self.dim_max)
+        for i in range(MAX_REFINEMENTS):
+            r = np.flatnonzero(np.linalg.norm(p0 - p1, axis=1) > tol)
+            if not len(r):
+                break
+            pm = .5*(p0[r] + p1[r])
+            fm = self.evaluator.value(pm)
+            above = orientation[r]*fm > orientation[r]*iso
+            p1[r[above]], f1[r[above]] = pm[above], fm[above]
+            p0[r[~above]], f0[r[~above]] = pm[~above], fm[~above]
+        return refine_secant(p0, f0, p1, f1, iso)
+
+    def refine_newton(self, frame, p0, f0, p1, f1, dir, orientation, iso):
+        tol = np.float32(frame['tolerance']*self.dim_max)
+        t0 = np.zeros(len(p0), np.float32)
+        t1 = np.einsum('ni,ni->n', p1 - p0, dir)
+        t = np.einsum('ni,ni->n', refine_secant(p0, f0, p1, f1, iso) - p0, dir)
+        r = np.arange(len(p0))
+        for i in range(MAX_REFINEMENTS):
+            if not len(r):
+                break
+            f, g, _ = self.evaluator.evaluate(p0[r] + t[r,None]*dir[r], hessian=False)
+            above = orientation[r]*f > orientation[r]*iso
+            t1[r[above]] = t[r[above]]
+            t0[r[~above]] = t[r[~above]]
+            df = np.einsum('ni,ni->n', g, dir[r])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t_next = np.where(df != 0, t[r] - (f-iso)/df, .5*(t0[r] + t1[r]))
+            t_next = np.where((t_next <= t0[r]) | (t_next >= t1[r]), .5*(t0[r] + t1[r]), t_next).astype(np.float32)
+            converged = (np.abs(t_next - t[r]) < tol) | (t1[r] - t0[r] < tol)
+            t[r] = t_next
+            r = r[~converged]
+        return p0 + t[:,None]*dir
+
+    def shade(self, frame, p, orientation):
+        """ compute_color() of the shader at the hits p: Blinn-Phong with the curvature colormap."""
+        _, g, H = self.evaluator.evaluate(p)
+        s = self.scale_norm
+        g = g*s
+        H = H*np.concatenate([s*s, s[[1,2,0]]*s[[2,0,1]]])
+        pos = p*s + self.offset_norm - .5
+        k = compute_curvature(g, H)
+        # texture(tex_colormap_2d, scale_k*k + .5): bilinear over the 3x3 texels, clamped to the edges
+        u = np.clip((frame['scale_k']*k + .5)*3 - .5, 0, 2)
+        i = np.minimum(np.floor(u).astype(np.int64), 1)
+        w = (u - i)[:,:,None]
+        c = self.colormap
+        diffuse = (1-w[:,1])*((1-w[:,0])*c[i[:,1], i[:,0]] + w[:,0]*c[i[:,1], i[:,0]+1]) + \
+                  w[:,1]*((1-w[:,0])*c[i[:,1]+1, i[:,0]] + w[:,0]*c[i[:,1]+1, i[:,0]+1])
+        return shade_Blinn_Phong(frame['MV'], pos, normalize(-orientation[:,None]*g), diffuse)
+
+def refine_secant(p0, f0, p1, f1, iso):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = (p1*(f0-iso)[:,None] - p0*(f1-iso)[:,None])/(f0-f1)[:,None]
+    return np.where((np.abs(f1-f0) > 0.00001)[:,None], p, p1).astype(np.float32)
+
+def compute_curvature(g, d2):
+    """ compute_curvature() of the shader: (n, 2) principal curvatures (k_max, k_min)."""
+    xx, yy, zz, yz, zx, xy = d2.T
+    H = np.stack([xx, xy, zx, xy, yy, yz, zx, yz, zz], axis=1).reshape(-1, 3, 3)
+    one_over_len_g = 1/np.linalg.norm(g, axis=1)
+    n = -g*one_over_len_g[:,None]
+    P = np.eye(3, dtype=np.float32) - n[:,:,None]*n[:,None,:]
+    M = -P @ H @ P*one_over_len_g[:,None,None]
+    T = np.trace(M, axis1=1, axis2=2)
+    F2 = (M*M).sum(axis=(1,2))
+    root = np.sqrt(np.maximum(2*F2 - T*T, 0))
+    return np.stack([(T + root)*.5, (T - root)*.5], axis=1)
+
+def shade_Blinn_Phong(MV, pos, n, diffuse):
+    """ shade_curvature() of cc6_shading.glsl with its material and directional light."""
+    n = normalize(n @ MV[:3,:3])
+    pos_eye = np.concatenate([pos, np.ones((len(pos), 1), np.float32)], axis=1) @ MV
+    l = normalize(np.ones(3, np.float32))
+    v = -normalize(pos_eye[:,:3])
+    h = normalize(l + v)
+    l_dot_n = np.maximum(n @ l, 0)[:,None]
+    specular = np.maximum(np.einsum('ni,ni->n', h, n), 0)[:,None]**64
+    return .2*.1 + diffuse*l_dot_n + specular
+
+#############################################################################################################
+# The workers of the pool keep their RayTracer, built on the lattice in shared memory.
+_tracer = None
+_shm = None
+
+def init_worker(info, name_shm, shape, minmax):
+    global _tracer, _shm
+    _shm = shared_memory.SharedMemory(name_shm)
+    _tracer = RayTracer(info, np.ndarray(shape, np.float32, buffer=_shm.buf), minmax)
+
+def trace_tile(args):
+    return _tracer.trace(*args)
+
+class CPURaycaster:
+    """ Renders frames of a volume with RayTracer over tiles in a pool of processes.
+
+    The camera, the isolevel and the raycast settings are attributes as in Scene
+    and QuadFull, set_pose() sets the ones of a pose. processes=1 raycasts in this
+    process. Call close() (or use it as a context manager) to stop the pool and
+    free the shared lattice.
+    """
+    pose_keys = ('view_angle', 'angle_x', 'angle_y', 'position_x', 'position_y', 'level')
+
+    def __init__(self, info, width, height, processes=None, size_tile=64):
+        if info.timesteps:
+            print(f'{info.filename}: the CPU raycaster renders the first timestep of the series')
+        self.info = info
+        self.width = width
+        self.height = height
+        self.size_tile = size_tile
+
+        self.view_angle = 21
+        self.angle_x = 320
+        self.angle_y = 0
+        self.position_x = 0
+        self.position_y = 0
+        self.level = info.level
+
+        self.scale_step = 0.001
+        self.tolerance = 0.0001
+        self.intersection = 'secant'
+        self.skip_empty = True
+        self.scale_k = 10.
+
+        # the lattice padded as CC6Evaluator pads it, read slab by slab into shared memory
+        data = LatticeFile(info.filename, info.dtype, info.dim, info.offset_file)
+        shape = tuple(n + 2*PAD for n in data.shape)
+        self.shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape))*4)
+        lattice = np.ndarray(shape, np.float32, buffer=self.shm.buf)
+        lattice[:] = 0
+        for z, slab in data.slabs(64 << 20):
+            lattice[PAD+z:PAD+z+len(slab), PAD:-PAD, PAD:-PAD] = slab
+        size_macro = RayTracer.size_macro
+        minmax = info.cached(f'minmax_{size_macro}_3_0', lambda: compute_minmax(data, size_macro))
+
+        self.processes = processes or os.cpu_count() or 1
+        if self.processes > 1:
+            self.pool = concurrent.futures.ProcessPoolExecutor(self.processes, initializer=init_worker,
+                                                               initargs=(info, self.shm.name, shape, minmax))
+            self.tracer = None
+        else:
+            self.pool = None
+            self.tracer = RayTracer(info, lattice, minmax)
+
+    def set_pose(self, pose):
+        for key in self.pose_keys:
+            if key in pose:
+                setattr(self, key, pose[key])
+
+    def frame(self):
+        P, MV = camera_matrices(self.view_angle, self.width/self.height, self.angle_x, self.angle_y, self.position_x, self.position_y)
+        MVP = np.array(glm.transpose(P * MV))
+        return {'MVP_inv': np.linalg.inv(MVP).astype(np.float32), 'MV': np.array(glm.transpose(MV), np.float32),
+                'width': self.width, 'height': self.height, 'level': self.level,
+                'scale_step': self.scale_step, 'tolerance': self.tolerance, 'intersection': self.intersection,
+                'skip_empty': self.skip_empty, 'scale_k': self.scale_k}
+
+    def tiles(self):
+        return [(x, y, min(self.size_tile, self.width-x), min(self.size_tile, self.height-y))
+                for y in range(0, self.height, self.size_tile) for x in range(0, self.width, self.size_tile)]
+
+    def render(self, pose={}):
+        """ (height, width, 4) uint8 frame of the pose, top row first."""
+        self.set_pose(pose)
+        frame = self.frame()
+        tiles = self.tiles()
+        args = [(frame,) + tile for tile in tiles]
+        colors = self.pool.map(trace_tile, args) if self.pool else (self.tracer.trace(*a) for a in args)
+        img = np.empty((self.height, self.width, 4), np.uint8)
+        for (x, y, w, h), color in zip(tiles, colors):
+            img[y:y+h, x:x+w] = color
+        return img[::-1]
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown()
+            self.pool = None
+        self.tracer = None
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+#############################################################################################################
+def main():
+    parser = argparse.ArgumentParser(description='Tile-parallel CPU raycaster of the cc6 isosurface')
+    parser.add_argument('volume', help='registered dataset (' + ', '.join(volumes) + ') or lattice file, as raycaster_cc6.py')
+    parser.add_argument('--no-cache', action='store_true', help='do not use the on-disk dataset cache')
+    parser.add_argument('--size', default='512x512', help='frame size WxH')
+    parser.add_argument('--poses', help='JSON file with a list of poses, each a dict with any of ' + ', '.join(CPURaycaster.pose_keys))
+    parser.add_argument('--frames', type=int, default=36, help='number of orbit frames when no --poses is given')
+    parser.add_argument('--out', default='frames', help='output directory')
+    parser.add_argument('--format', nargs='+', default=['png'], choices=['png', 'npy'], help='output frame formats')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: one per core, 1: no pool)')
+    parser.add_argument('--tile', type=int, default=64, help='tile size in pixels')
+    parser.add_argument('--scale-step', type=float, default=0.001, help='marching step relative to the largest dimension')
+    parser.add_argument('--intersection', default='secant', choices=('secant', 'bisection', 'newton'), help='root refinement at a sign change')
+    parser.add_argument('--tolerance', type=float, default=0.0001, help='stop tolerance of the root refinement, relative as --scale-step')
+    args = parser.parse_args()
+
+    info = open_dataset(args.volume, cache=not args.no_cache)
+    width, height = (int(s) for s in args.size.lower().split('x'))
+    if args.poses:
+        poses = json.load(open(args.poses, 'r'))
+    else:
+        poses = [{'angle_x': 320, 'angle_y': 360*i/args.frames} for i in range(args.frames)]
+    os.makedirs(args.out, exist_ok=True)
+    with CPURaycaster(info, width, height, args.processes, args.tile) as raycaster:
+        raycaster.scale_step = args.scale_step
+        raycaster.intersection = args.intersection
+        raycaster.tolerance = args.tolerance
+        for i, pose in enumerate(poses):
+            t = time.perf_counter()
+            img = raycaster.render(pose)
+            t = time.perf_counter() - t
+            print(f'frame {i}: {t*1e3:.0f} ms, {width*height/t/1e3:.1f} Krays/s ({raycaster.processes} processes)')
+            name = os.path.join(args.out, f'frame_{i:05d}')
+            for fmt in args.format:
+                if fmt == 'png':
+                    pylab.imsave(name + '.png', img)
+                elif fmt == 'npy':
+                    np.save(name + '.npy', img)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+"""
+cc6_datasets.py
+
+Dataset registry and loaders of the cc6 raycaster.
+
+A dataset is described by a VolumeInfo: the raw lattice file with its byte
+offset, dtype, dimensions, spacing, origin and default isolevel. open_dataset()
+accepts either the name of a registered dataset (see `volumes`) or a path, in
+which case the loader registered for its extension reads the header:
+
+- NRRD (.nrrd with attached data, .nhdr with detached data)
+- raw lattice with a JSON sidecar (foo.raw + foo.json)
+- NumPy arrays (.npy)
+- a directory of any of the above, read as consecutive timesteps
+
+Lattices that cannot be read in place (compressed, foreign endianness or a
+dtype without a texture format) are converted once into a DatasetCache entry,
+which also keeps the derived data (min/max grids, value ranges) of each file
+so that reopening a dataset skips the preprocessing.
+
+# Copyright (c) 2022, Minho Kim & Hyunjun Kim
+# Computer Graphics Lab, Dept of Computer Science, University of Seoul
+# All rights reserved.
+
+"""
+import os
+import re
+import copy
+import gzip
+import json
+import hashlib
+import numpy as np
+
+# dtypes the raycaster uploads without conversion
+SUPPORTED_DTYPES = ('uint8', 'uint16', 'float16', 'float32', 'float64')
+
+class VolumeInfo:
+    def __init__(self, filename, dtype, dim, scale, level, offset=(0,0,0), offset_file=0):
+        self.filename = filename
+        self.dtype = dtype
+        self.dim = dim
+        self.scale = scale
+        self.level = level
+        self.offset = offset
+        self.offset_file = offset_file  # bytes before the lattice in the file
+        self.bbox_size = tuple((dim[i]-1)*scale[i] for i in range(3))
+        self.timesteps = None           # VolumeInfo of every timestep of a time series
+        self.cache = None               # DatasetCache
+        self.cache_key = None
+
+    def cached(self, name, compute):
+        """ Returns the derived array `name` from the dataset cache, computing and storing it if missing."""
+        if self.cache is None:
+            return compute()
+        return self.cache.get(self.cache_key, name, compute)
+
+path_volume = './'
+
+volumes = {
+    'ML40' :VolumeInfo(path_volume + 'ML_40_lattice.raw', np.float32, (41,41,41), (1,1,1), 0.5),
+    'ML50' :VolumeInfo(path_volume + 'ML_50_lattice.raw', np.float32, (51,51,51), (1,1,1), 0.5),
+    'ML80' :VolumeInfo(path_volume + 'ML_80_lattice.raw', np.float32, (81,81,81), (1,1,1), 0.5),
+    }
+
+#############################################################################################################
+class LatticeFile:
+    """ Read-only view of a raw lattice file, indexed [z,y,x] with slices.
+
+    Indexing maps only the z-slabs it needs with np.memmap and returns a copy, so
+    reading a lattice slab by slab keeps the resident memory bounded.
+    """
+    def __init__(self, filename, dtype, dim, offset=0):
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.shape = (dim[2], dim[1], dim[0])
+        self.offset = offset
+        self.size_plane = dim[0]*dim[1]*self.dtype.itemsize
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        z0, z1, step = key[0].indices(self.shape[0])
+        if step != 1 or z1 <= z0:
+            raise IndexError(f'LatticeFile only reads non-empty z-slabs, got {key[0]}')
+        mapped = np.memmap(self.filename, dtype=self.dtype, mode='r', offset=self.offset + z0*self.size_plane, shape=(z1-z0,)+self.shape[1:])
+        slab = np.array(mapped[(slice(None),) + key[1:]])
+        del mapped
+        return slab
+
+    def slabs(self, size_slab, z0=0, z1=None):
+        """ Yields (z, slab) for consecutive z-slabs of at most size_slab bytes (of the planes [z0, z1))."""
+        n = max(1, size_slab//self.size_plane)
+        z1 = self.shape[0] if z1 is None else z1
+        for z in range(z0, z1, n):
+            yield z, self[z:min(z+n, z1)]
+
+def value_range(data, size_slab=64 << 20):
+    """ (min, max) of a LatticeFile, read slab by slab."""
+    lo, hi = np.inf, -np.inf
+    for z, slab in data.slabs(size_slab):
+        lo, hi = min(lo, float(slab.min())), max(hi, float(slab.max()))
+    return np.array([lo, hi])
+
+#############################################################################################################
+def path_cache():
+    """ Root directory of the on-disk caches: $CC6_CACHE or ~/.cache/cc6."""
+    return os.environ.get('CC6_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'cc6'))
+
+class DatasetCache:
+    """ On-disk cache of converted lattices and derived arrays, keyed by file hash.
+
+    Every source file gets a directory named after the BLAKE2 hash of its
+    contents. The hash itself is remembered per (path, size, mtime) in
+    index.json so that an unchanged file is not hashed again.
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = path_cache()
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+        self.filename_index = os.path.join(self.path, 'index.json')
+        try:
+            self.index = json.load(open(self.filename_index, 'r'))
+        except (OSError, ValueError):
+            self.index = {}
+
+    def key(self, filename):
+        stat = os.stat(filename)
+        path = os.path.abspath(filename)
+        entry = self.index.get(path)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return entry['hash']
+        h = hashlib.blake2b(digest_size=16)
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 24), b''):
+                h.update(chunk)
+        self.index[path] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': h.hexdigest()}
+        self.save_index()
+        return h.hexdigest()
+
+    def save_index(self):
+        filename_tmp = self.filename_index + f'.{os.getpid()}'
+        json.dump(self.index, open(filename_tmp, 'w'), indent=1)
+        os.replace(filename_tmp, self.filename_index)
+
+    def entry(self, key):
+        path = os.path.join(self.path, key)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def get(self, key, name, compute):
+        filename = os.path.join(self.entry(key), name + '.npy')
+        if os.path.exists(filename):
+            return np.load(filename)
+        value = np.asarray(compute())
+        filename_tmp = filename + f'.{os.getpid()}.npy'
+        np.save(filename_tmp, value)
+        os.replace(filename_tmp, filename)
+        return value
+
+#############################################################################################################
+# Loaders: each reads the header of a path and returns a Header, registered by extension.
+class Header:
+    def __init__(self, filename, dtype, dim, scale=(1,1,1), offset=(0,0,0), offset_file=0,
+                 encoding='raw', level=None):
+        self.filename = filename        # file holding the lattice
+        self.dtype = np.dtype(dtype)    # with the byte order of the file
+        self.dim = tuple(int(d) for d in dim)
+        self.scale = tuple(float(s) for s in scale)
+        self.offset = tuple(float(o) for o in offset)
+        self.offset_file = offset_file
+        self.encoding = encoding        # 'raw' or 'gzip'
+        self.level = level
+
+    def readable_in_place(self):
+        return (self.encoding == 'raw' and self.dtype.isnative and self.dtype.name in SUPPORTED_DTYPES)
+
+loaders = {}
+
+def register_loader(*extensions):
+    def register(loader):
+        for extension in extensions:
+            loaders[extension] = loader
+        return loader
+    return register
+
+nrrd_types = {
+    'uchar': 'u1', 'unsigned char': 'u1', 'uint8': 'u1', 'uint8_t': 'u1',
+    'signed char': 'i1', 'int8': 'i1', 'int8_t': 'i1',
+    'ushort': 'u2', 'unsigned short': 'u2', 'unsigned short int': 'u2', 'uint16': 'u2', 'uint16_t': 'u2',
+    'short': 'i2', 'short int': 'i2', 'signed short': 'i2', 'signed short int': 'i2', 'int16': 'i2', 'int16_t': 'i2',
+    'uint': 'u4', 'unsigned int': 'u4', 'uint32': 'u4', 'uint32_t': 'u4',
+    'int': 'i4', 'signed int': 'i4', 'int32': 'i4', 'int32_t': 'i4',
+    'float': 'f4', 'double': 'f8',
+    }
+
+@register_loader('.nrrd', '.nhdr')
+def read_nrrd_header(filename):
+    fields = {}
+    with open(filename, 'rb') as f:
+        magic = f.readline()
+        if not magic.startswith(b'NRRD'):
+            raise ValueError(f'{filename} is not a NRRD file')
+        for line in f:
+            line = line.decode('latin-1').rstrip('\r\n')
+            if line == '':
+                break
+            if line.startswith('#') or ':=' in line:
+                continue
+            key, value = line.split(':', 1)
+            fields[key.strip().lower()] = value.strip()
+        offset_file = f.tell()
+
+    if int(fields['dimension']) != 3:
+        raise ValueError(f'{filename}: only 3D NRRD files are supported')
+    dtype = np.dtype(nrrd_types[fields['type'].lower()])
+    if dtype.itemsize > 1:
+        dtype = dtype.newbyteorder('>' if fields.get('endian', 'little') == 'big' else '<')
+    dim = [int(s) for s in fields['sizes'].split()]
+
+    scale = (1, 1, 1)
+    if 'space directions' in fields:
+        vectors = re.findall(r'\(([^)]*)\)', fields['space directions'])
+        scale = [np.linalg.norm([float(v) for v in vector.split(',')]) for vector in vectors]
+    elif 'spacings' in fields:
+        scale = [float(s) for s in fields['spacings'].split()]
+    offset = (0, 0, 0)
+    if 'space origin' in fields:
+        offset = [float(v) for v in fields['space origin'].strip('()').split(',')]
+
+    data_file = fields.get('data file', fields.get('datafile'))
+    if data_file is not None:
+        filename = os.path.join(os.path.dirname(filename), data_file)
+        offset_file = 0
+    if int(fields.get('byte skip', 0)) > 0:
+        offset_file += int(fields['byte skip'])
+    encoding = {'raw': 'raw', 'gzip': 'gzip', 'gz': 'gzip'}.get(fields.get('encoding', 'raw'))
+    if encoding is None:
+        raise ValueError(f'{filename}: unsupported NRRD encoding {fields["encoding"]}')
+    return Header(filename, dtype, dim, scale, offset, offset_file, encoding)
+
+@register_loader('.json')
+def read_sidecar(filename):
+    """ JSON sidecar of a raw lattice, e.g.
+        {"file": "lattice.raw", "dtype": "float32", "dim": [81,81,81],
+         "scale": [1,1,1], "offset": [0,0,0], "level": 0.5, "endian": "little", "header": 0}
+    "file" defaults to the sidecar name with the .raw extension.
+    """
+    desc = json.load(open(filename, 'r'))
+    filename_data = os.path.join(os.path.dirname(filename), desc.get('file', os.path.splitext(os.path.basename(filename))[0] + '.raw'))
+    dtype = np.dtype(desc['dtype']).newbyteorder('>' if desc.get('endian', 'little') == 'big' else '<')
+    return Header(filename_data, dtype, desc['dim'], desc.get('scale', (1,1,1)), desc.get('offset', (0,0,0)),
+                  desc.get('header', 0), desc.get('encoding', 'raw'), desc.get('level'))
+
+@register_loader('.raw')
+def read_raw(filename):
+    sidecar = os.path.splitext(filename)[0] + '.json'
+    if not os.path.exists(sidecar):
+        raise ValueError(f'{filename} needs a JSON sidecar {sidecar} with its dim and dtype')
+    return read_sidecar(sidecar)
+
+@register_loader('.npy')
+def read_npy_header(filename):
+    with open(filename, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset_file = f.tell()
+    if len(shape) != 3:
+        raise ValueError(f'{filename}: expected a 3D array, got shape {shape}')
+    # C order [z,y,x] and Fortran order [x,y,z] share the memory layout of the lattice
+    dim = shape if fortran_order else shape[::-1]
+    return Header(filename, dtype, dim, offset_file=offset_file)
+
+def read_header(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in loaders:
+        raise ValueError(f'{filename}: no loader for {extension} (known: {", ".join(sorted(loaders))})')
+    return loaders[extension](filename)
+
+#############################################################################################################
+def convert_lattice(header, filename_out, size_slab=64 << 20):
+    """ Writes the lattice of header as a native-endian raw file in a supported dtype."""
+    dtype_out = header.dtype.newbyteorder('=')
+    if dtype_out.name not in SUPPORTED_DTYPES:
+        dtype_out = np.dtype(np.float32)
+    size_total = int(np.prod(header.dim))*header.dtype.itemsize
+    size_chunk = max(header.dtype.itemsize, size_slab - size_slab % header.dtype.itemsize)
+    filename_tmp = filename_out + f'.{os.getpid()}'
+    with open(header.filename, 'rb') as f, open(filename_tmp, 'wb') as out:
+        f.seek(header.offset_file)
+        src = gzip.GzipFile(fileobj=f) if header.encoding == 'gzip' else f
+        remaining = size_total
+        while remaining > 0:
+            chunk = src.read(min(size_chunk, remaining))
+            if not chunk:
+                raise ValueError(f'{header.filename}: lattice data ends early')
+            remaining -= len(chunk)
+            np.frombuffer(chunk, dtype=header.dtype).astype(dtype_out).tofile(out)
+    os.replace(filename_tmp, filename_out)
+    return dtype_out
+
+def natural_key(name):
+    return [int(s) if s.isdigit() else s for s in re.split(r'(\d+)', name)]
+
+def open_file(filename, cache, level=None):
+    header = read_header(filename)
+    key = cache.key(header.filename) if cache is not None else None
+    if header.readable_in_place():
+        filename_data, dtype, offset_file = header.filename, header.dtype, header.offset_file
+    else:
+        if cache is None:
+            raise ValueError(f'{filename} needs conversion ({header.encoding}, {header.dtype.str}), which needs the dataset cache')
+        filename_data = os.path.join(cache.entry(key), 'lattice.raw')
+        filename_dtype = filename_data + '.dtype'
+        if not os.path.exists(filename_data):
+            print(f'converting {header.filename} into {filename_data}')
+            open(filename_dtype, 'w').write(convert_lattice(header, filename_data).str)
+        dtype, offset_file = np.dtype(open(filename_dtype).read()), 0
+
+    info = VolumeInfo(filename_data, dtype, header.dim, header.scale, level if level is not None else header.level,
+                      header.offset, offset_file)
+    info.cache, info.cache_key = cache, key
+    if info.level is None:
+        # without an isolevel in the header, start in the middle of the value range
+        lo, hi = info.cached('range', lambda: value_range(LatticeFile(info.filename, info.dtype, info.dim, info.offset_file)))
+        info.level = float(.5*(lo + hi))
+    return info
+
+def open_dataset(name, cache=True):
+    """ VolumeInfo of a registered dataset name, a lattice file or a directory of timesteps.
+
+    cache is a DatasetCache, True for the default one, or False/None to disable caching.
+    """
+    if cache is True:
+        cache = DatasetCache()
+    elif not cache:
+        cache = None
+    if name in volumes:
+        # a copy: the registry entry stays without the cache of this caller
+        info = copy.copy(volumes[name])
+        if cache is not None and os.path.exists(info.filename):
+            info.cache, info.cache_key = cache, cache.key(info.filename)
+        return info
+    if os.path.isdir(name):
+        files = sorted((f for f in os.listdir(name) if os.path.splitext(f)[1].lower() in loaders), key=natural_key)
+        # the data files of detached headers (.nhdr, .json sidecars) belong to their header's timestep
+        data_files = {os.path.abspath(read_header(os.path.join(name, f)).filename)
+                      for f in files if os.path.splitext(f)[1].lower() in ('.nhdr', '.json')}
+        files = [f for f in files if os.path.abspath(os.path.join(name, f)) not in data_files]
+        if not files:
+            raise ValueError(f'{name}: no lattice files found')
+        timesteps = [open_file(os.path.join(name, files[0]), cache)]
+        # a common isolevel for the whole series
+        timesteps += [open_file(os.path.join(name, f), cache, timesteps[0].level) for f in files[1:]]
+        for t in timesteps[1:]:
+            if (t.dim, np.dtype(t.dtype)) != (timesteps[0].dim, np.dtype(timesteps[0].dtype)):
+                raise ValueError(f'{t.filename}: timesteps differ in dim or dtype')
+        info = timesteps[0]
+        info.timesteps = timesteps
+        return info
+    if os.path.exists(name):
+        return open_file(name, cache)
+    raise ValueError(f'{name} is neither a registered dataset ({", ".join(volumes)}) nor a file')
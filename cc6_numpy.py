@@ -0,0 +1,322 @@
+"""
+cc6_numpy.py
+
+Vectorized CPU evaluator of the six-direction cubic box-spline (cc6).
+
+The piecewise polynomials are taken verbatim from cc6_raycast_curvature.frag
+(eval_M_expr_*, eval_G_expr_* and eval_H_expr_*) so the CPU and GPU
+reconstructions cannot drift apart. Every expression is linear in the 38
+coefficients and homogeneous in the barycentric coordinates u, so each one is
+converted once into a (38 x #monomials) integer matrix and a batch of points
+is then evaluated with a couple of matrix products per tetrahedron type.
+
+# Copyright (c) 2022, Minho Kim & Hyunjun Kim
+# Computer Graphics Lab, Dept of Computer Science, University of Seoul
+# All rights reserved.
+
+"""
+import os
+import re
+import itertools
+import concurrent.futures
+import numpy as np
+
+path_shader = os.path.dirname(os.path.abspath(__file__))
+filename_frag = 'cc6_raycast_curvature.frag'
+
+DENOM_M = 1/384
+DENOM_G = 1/64
+DENOM_H = 1/16
+
+TYPE_BLUE = 0
+TYPE_GREEN = 1
+TYPE_RED = 2
+TYPE_NAMES = {TYPE_BLUE: 'blue', TYPE_GREEN: 'green', TYPE_RED: 'red'}
+
+# Offsets of c0..c37 in the (dirx, diry, dirz) frame of fetch_coefficients().
+OFFSETS = np.array([
+    (-1,-1, 0), (-1, 0,-1), (-1, 0, 0), (-1, 0, 1), (-1, 1, 0), (-1, 1, 1),
+    ( 0,-1,-1), ( 0,-1, 0), ( 0,-1, 1), ( 0, 0,-1), ( 0, 0, 0), ( 0, 0, 1),
+    ( 0, 0, 2), ( 0, 1,-1), ( 0, 1, 0), ( 0, 1, 1), ( 0, 1, 2), ( 0, 2, 0),
+    ( 0, 2, 1), ( 1,-1,-1), ( 1,-1, 0), ( 1,-1, 1), ( 1, 0,-1), ( 1, 0, 0),
+    ( 1, 0, 1), ( 1, 0, 2), ( 1, 1,-1), ( 1, 1, 0), ( 1, 1, 1), ( 1, 1, 2),
+    ( 1, 2, 0), ( 1, 2, 1), ( 2,-1, 0), ( 2, 0,-1), ( 2, 0, 0), ( 2, 0, 1),
+    ( 2, 1, 0), ( 2, 1, 1)], dtype=np.int64)
+
+# Pieces of the (+,+,+) octant: (type_tet, type_P) after preprocess().
+PIECES = [(TYPE_BLUE, 0), (TYPE_GREEN, 0), (TYPE_RED, 0), (TYPE_RED, 1), (TYPE_RED, 2)]
+# Swizzles of compute_gradient()/compute_Hessian(): xyz, zxy and yzx.
+PERMUTATIONS = np.array([[0,1,2], [2,0,1], [1,2,0]])
+
+# The stencil reaches two lattice points away from the nearest lattice point,
+# so the lattice is padded with zeros (the GL_CLAMP_TO_BORDER color) and the
+# nearest lattice point is clamped to where the whole stencil is zero.
+PAD = 5
+
+def monomials(degree):
+    return [e for e in itertools.product(range(degree+1), repeat=4) if sum(e) == degree]
+
+MONOMIALS = {degree: monomials(degree) for degree in (1, 2, 3)}
+EXPONENTS = {degree: np.array(exps) for degree, exps in MONOMIALS.items()}
+
+def eval_monomials(u, degree):
+    """ Evaluates the monomials of the given degree in u0..u3 as columns."""
+    exps = EXPONENTS[degree] if degree in EXPONENTS else np.array(monomials(degree))
+    # powers[e, :, i] = u_i**e; multiplying u0..u3 in turn (times exact ones) keeps the rounding of a product loop
+    powers = np.stack([np.ones_like(u), u, u*u, u*u*u][:degree+1])
+    return np.ascontiguousarray((powers[exps[:,0],:,0]*powers[exps[:,1],:,1]*powers[exps[:,2],:,2]*powers[exps[:,3],:,3]).T)
+
+def barycentric(p_cube, piece):
+    """ Barycentric coordinates u of preprocess() for points of the same piece."""
+    type_tet, type_P = PIECES[piece]
+    x, y, z = (p_cube[:,(type_P+i)%3] for i in range(3))
+    if type_tet == TYPE_BLUE:
+        return 2*np.stack([x+y+z-1, 0.5-y, 0.5-z, 0.5-x], axis=1)
+    elif type_tet == TYPE_GREEN:
+        return np.stack([1-x-y-z, x-y+z, x+y-z, -x+y+z], axis=1)
+    else:
+        return 2*np.stack([0.5-x, z, y, x-y-z], axis=1)
+
+#############################################################################################################
+class ShaderExpressions:
+    """ Coefficient matrices of the cc6 polynomials parsed from the fragment shader."""
+
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.path.join(path_shader, filename_frag)
+        self.src = open(filename, 'r').read()
+        self.M = {}
+        self.G = {}
+        self.H = {}
+        for t, name in TYPE_NAMES.items():
+            self.M[t] = self.build(self.body(f'eval_M_expr_{name}'), r'return\s+(.*?);', 3)
+            self.G[t] = self.build(self.body(f'eval_G_expr_{name}'), r'g\.([xyz])\s*=\s*(.*?);', 2, ['x','y','z'])
+            self.H[t] = self.build(self.body(f'eval_H_expr_{name}'), r'h\[([01])\]\.([xyz])\s*=\s*(.*?);', 1,
+                                   [('0','x'), ('0','y'), ('0','z'), ('1','x'), ('1','y'), ('1','z')])
+
+    def body(self, name):
+        m = re.search(name + r'\s*\(\s*void\s*\)\s*\{(.*?)\n\}', self.src, re.S)
+        if m is None:
+            raise RuntimeError(f'{name} not found in the shader source')
+        return m.group(1)
+
+    def build(self, body, pattern, degree, components=None):
+        # Evaluate the GLSL expression with c_k = e_k and generic u samples,
+        # then solve for the integer coefficient of every monomial.
+        exps = monomials(degree)
+        rng = np.random.default_rng(0)
+        u = rng.integers(1, 7, size=(len(exps)*2, 4)).astype(np.float64)
+        V = eval_monomials(u, degree)
+        env = {f'c{k}': np.eye(38)[k][:,None] for k in range(38)}
+        env.update({f'u{i}': u[:,i][None,:] for i in range(4)})
+        for i in range(4):
+            e = [0,0,0,0]
+            for n in (2, 3):
+                e[i] = n
+                env['u' + ''.join(map(str, e))] = (u[:,i]**n)[None,:]
+
+        found = {}
+        for m in re.finditer(pattern, body, re.S):
+            *key, expr = m.groups()
+            key = tuple(key) if len(key) > 1 else (key[0] if key else None)
+            found[key] = eval(expr.replace('\n', ' '), {'__builtins__': {}}, env)
+        if components is None:
+            components = [None]
+        A = []
+        for key in components:
+            val = np.broadcast_to(found[key], (38, len(u)))
+            coef, *_ = np.linalg.lstsq(V, val.T, rcond=None)
+            A.append(np.rint(coef.T))      # (38, #monomials)
+        return np.array(A) if len(A) > 1 else A[0]
+
+_expressions = None
+
+def get_expressions():
+    global _expressions
+    if _expressions is None:
+        _expressions = ShaderExpressions()
+    return _expressions
+
+#############################################################################################################
+class CC6Evaluator:
+    """ Evaluates the cc6 reconstruction of a lattice at arbitrary points.
+
+    Points are given in lattice coordinates (x, y, z), i.e., the texel
+    coordinates used by GET_DATA in the shader, where x runs fastest in the
+    raw file. Derivatives are with respect to lattice coordinates; the shader
+    additionally multiplies them by scale_norm.
+    """
+
+    def __init__(self, data, dim=None, dtype=np.float32, size_chunk=1<<17, n_threads=None, padded=False):
+        if dim is not None:
+            data = np.asarray(data).reshape(dim[2], dim[1], dim[0])
+        if data.ndim != 3:
+            raise ValueError('data should be a 3D array or come with its dim=(x,y,z)')
+        self.dtype = dtype
+        self.size_chunk = size_chunk
+        # NumPy releases the GIL in the gathers and matrix products, so chunks scale over threads.
+        self.n_threads = n_threads if n_threads is not None else (os.cpu_count() or 1)
+        if padded:
+            # already padded by PAD (e.g. a lattice in shared memory, see cc6_cpu.py): used as is, not copied
+            self.lattice = np.asarray(data, dtype=dtype)
+            self.dim = tuple(n - 2*PAD for n in self.lattice.shape[::-1])
+        else:
+            self.dim = (data.shape[2], data.shape[1], data.shape[0])
+            self.lattice = np.pad(np.asarray(data, dtype=dtype), PAD)
+        self.strides = np.array([1, self.lattice.shape[2], self.lattice.shape[2]*self.lattice.shape[1]], dtype=np.int64)
+        self.flat = self.lattice.reshape(-1)
+        self.init_configurations()
+
+    def init_configurations(self):
+        # A point's configuration is its piece and the reflection type_R, 5*8 in total.
+        # Within a configuration the 38 fetch offsets are constant, and so are the
+        # permutation/reflection of the derivatives, which are folded into the matrices.
+        expr = get_expressions()
+        self.offsets = np.empty((len(PIECES)*8, 38), dtype=np.int64)
+        self.A_M, self.A_G, self.A_H = [], [], []
+        for config in range(len(PIECES)*8):
+            piece, bits_R = divmod(config, 8)
+            type_tet, type_P = PIECES[piece]
+            R = np.array([1 if bits_R & (1<<i) else -1 for i in range(3)])
+            bit_P = np.eye(3, dtype=np.int64)[type_P]
+            dirs = np.stack([R*bit_P, R*bit_P[[2,0,1]], R*bit_P[[1,2,0]]])
+            self.offsets[config] = OFFSETS @ dirs @ self.strides
+
+            perm = PERMUTATIONS[type_P]
+            G = expr.G[type_tet][perm]*R[:,None,None]
+            H = np.concatenate([expr.H[type_tet][perm], expr.H[type_tet][3+perm]*(R*R.prod())[:,None,None]])
+            self.A_M.append((expr.M[type_tet]*DENOM_M).astype(self.dtype))
+            self.A_G.append((np.concatenate(G, axis=1)*DENOM_G).astype(self.dtype))
+            self.A_H.append((np.concatenate(H, axis=1)*DENOM_H).astype(self.dtype))
+
+    @classmethod
+    def from_info(cls, info, **kwargs):
+        """ Loads the lattice described by a VolumeInfo the same way Volume.load_data does."""
+        data = np.fromfile(info.filename, dtype=info.dtype, count=int(np.prod(info.dim)), offset=info.offset_file).astype(np.float32)
+        return cls(data, info.dim, **kwargs)
+
+    def preprocess(self, p):
+        """ Vectorized preprocess() of the shader.
+
+        Returns the nearest lattice points, the configuration index of every
+        point (see init_configurations) and the local coordinates p_cube in the
+        (+,+,+) octant.
+        """
+        org = np.floor(p + 0.5)
+        p_local = p - org
+        p_cube = np.abs(p_local)
+        x, y, z = p_cube[:,0], p_cube[:,1], p_cube[:,2]
+        bit1 = -x+y-z > 0
+        bit2 = -x-y+z > 0
+        is_blue = x+y+z > 1
+        is_red = ~is_blue & ((x-y-z > 0) | bit1 | bit2)
+        piece = np.where(is_blue, 0, np.where(is_red, 2 + bit1 + 2*bit2, 1))
+        bits_R = (p_local > 0) @ np.array([1, 2, 4])
+        return org.astype(np.int64), (piece*8 + bits_R).astype(np.int8), p_cube
+
+    def fetch_coefficients(self, base, config):
+        """ Vectorized fetch_coefficients() of the shader for one configuration or one per point.
+        Returns (n, 38) coefficients."""
+        return np.take(self.flat, base[:,None] + self.offsets[config])
+
+    def flat_index(self, org):
+        org = np.clip(org, -3, np.array(self.dim)+2) + PAD
+        return org @ self.strides
+
+    def evaluate(self, points, gradient=True, hessian=True):
+        """ Returns the value, the gradient (n, 3) and the Hessian terms (n, 6)
+        ordered as xx, yy, zz, yz, zx, xy like compute_Hessian()."""
+        points = np.asarray(points, dtype=self.dtype)
+        shape = points.shape[:-1]
+        points = points.reshape(-1, 3)
+        value = np.empty(len(points), dtype=self.dtype)
+        g = np.empty((len(points), 3), dtype=self.dtype) if gradient else None
+        H = np.empty((len(points), 6), dtype=self.dtype) if hessian else None
+        def run(i):
+            s = slice(i, i+self.size_chunk)
+            self.evaluate_chunk(points[s], value[s], g[s] if gradient else None, H[s] if hessian else None)
+        chunks = range(0, len(points), self.size_chunk)
+        if self.n_threads > 1 and len(chunks) > 1:
+            with concurrent.futures.ThreadPoolExecutor(self.n_threads) as pool:
+                list(pool.map(run, chunks))
+        else:
+            for i in chunks:
+                run(i)
+        value = value.reshape(shape)
+        g = g.reshape(shape + (3,)) if gradient else None
+        H = H.reshape(shape + (6,)) if hessian else None
+        return value, g, H
+
+    def value(self, points):
+        return self.evaluate(points, gradient=False, hessian=False)[0]
+
+    def evaluate_chunk(self, p, value, g, H):
+        org, config, p_cube = self.preprocess(p)
+        # Sort the points by configuration so every group is a contiguous slice. The value
+        # alone does not depend on the reflection, so then the points are only grouped by
+        # piece and fetch with their own offsets: 5 groups instead of 40 for the march.
+        by_piece = g is None and H is None
+        key = config//8 if by_piece else config
+        order = np.argsort(key, kind='stable')
+        bounds = np.searchsorted(key[order], np.arange((len(PIECES) if by_piece else len(self.offsets))+1))
+        base = self.flat_index(org)[order]
+        p_cube = p_cube[order]
+        config = config[order]
+
+        value_sorted = np.empty_like(value)
+        g_sorted = np.empty_like(g) if g is not None else None
+        H_sorted = np.empty_like(H) if H is not None else None
+        for k in np.flatnonzero(np.diff(bounds)):
+            s = slice(bounds[k], bounds[k+1])
+            piece = k if by_piece else k//8
+            u = barycentric(p_cube[s], piece)
+            c = self.fetch_coefficients(base[s], config[s] if by_piece else k)
+            value_sorted[s] = np.einsum('nj,nj->n', c @ self.A_M[piece*8 if by_piece else k], eval_monomials(u, 3))
+            if g is not None:
+                g_sorted[s] = np.einsum('nij,nj->ni', (c @ self.A_G[k]).reshape(-1, 3, 10), eval_monomials(u, 2))
+            if H is not None:
+                H_sorted[s] = np.einsum('nij,nj->ni', (c @ self.A_H[k]).reshape(-1, 6, 4), eval_monomials(u, 1))
+
+        value[order] = value_sorted
+        if g is not None:
+            g[order] = g_sorted
+        if H is not None:
+            H[order] = H_sorted
+
+#############################################################################################################
+def compute_minmax(data, size_macro, apron=3, border=0):
+    """ Conservative (min, max) of the cc6 reconstruction over macro-cells.
+
+    data is indexed [z,y,x]. Macro-cell m covers the sample positions
+    [m*size_macro, (m+1)*size_macro) along each axis. Their nearest lattice
+    points are at most one lattice point further and the stencil reaches two
+    more, so the range of the coefficients within `apron` lattice points of the
+    cell bounds the reconstruction: the box-spline is non-negative and sums up
+    to one. Texels outside the lattice read as `border` and are included as such.
+    Returns a float32 array of shape (nz, ny, nx, 2).
+    """
+    n = [(d-1)//size_macro + 1 for d in data.shape]
+    def window(m, d):
+        lo, hi = m*size_macro - apron, (m+1)*size_macro + apron + 1
+        return slice(max(lo, 0), min(hi, d)), lo < 0 or hi > d
+
+    minmax = np.empty((n[0], n[1], n[2], 2), dtype=np.float32)
+    for mz in range(n[0]):
+        # Reduce one slab along z first so only one slab is converted at a time.
+        sz, border_z = window(mz, data.shape[0])
+        slab = np.asarray(data[sz], dtype=np.float32)
+        lo, hi = slab.min(axis=0), slab.max(axis=0)
+        lo_y = np.empty((n[1], data.shape[2]), dtype=np.float32)
+        hi_y = np.empty((n[1], data.shape[2]), dtype=np.float32)
+        border_y = np.zeros(n[1], dtype=bool)
+        for my in range(n[1]):
+            sy, border_y[my] = window(my, data.shape[1])
+            lo_y[my], hi_y[my] = lo[sy].min(axis=0), hi[sy].max(axis=0)
+        for mx in range(n[2]):
+            sx, border_x = window(mx, data.shape[2])
+            minmax[mz,:,mx,0] = lo_y[:,sx].min(axis=1)
+            minmax[mz,:,mx,1] = hi_y[:,sx].max(axis=1)
+            outside = border_z | border_x | border_y
+            minmax[mz,outside,mx,0] = np.minimum(minmax[mz,outside,mx,0], border)
+            minmax[mz,outside,mx,1] = np.maximum(minmax[mz,outside,mx,1], border)
+    return minmax
@@ -7,18 +7,51 @@ uniform sampler2D   tex_front;
 uniform sampler3D   tex_volume;
 uniform sampler2D   tex_colormap;
 uniform sampler2D   tex_colormap_2d;
-uniform vec3        scale_norm;
-uniform vec3        offset_norm;
-uniform vec3        scale_lattice;
-uniform vec3        offset_lattice;
-uniform vec3        dim;
-uniform float       dim_max;
-uniform float       level;
-uniform mat4        MV;
-uniform float       scale_step;
-uniform float       scale_delta;
-
-out vec4 fColor;
+uniform sampler3D   tex_minmax;
+uniform sampler3D   tex_page_table;
+uniform sampler2D   tex_start;
+
+#define MAX_LEVELS 8
+
+#include "cc6_volume.glsl"
+
+// Per-frame parameters (QuadFull.ubo), std140, filled from a NumPy structured array
+// with the fields of QuadFull.uniform_fields.
+layout(std140) uniform Frame
+{
+    mat4    view_MV;
+    mat4    view_MVP_inv;
+    float   level;
+    float   scale_step;
+    float   scale_delta;
+    float   tolerance;
+    int     intersection;
+    bool    skip_empty;
+    bool    analytic_bbox;  // intersect the ray with the bbox here instead of reading tex_front/tex_back
+    bool    debug_cost;     // output (march iterations, EVALs, hit, ray in bbox) instead of the color
+    float   scale_k;        // curvature to colormap coordinate scale
+    bool    temporal;       // start the march before the reprojected previous hit in tex_start
+    float   temporal_margin;
+    // MULTI_LEVEL: nested isosurfaces composited in one march instead of the single level
+    int     num_levels;
+    float   opacity_max;                // early ray termination
+    float   levels[MAX_LEVELS];         // ascending
+    vec4    level_colors[MAX_LEVELS];   // color and opacity of the isosurface of each level
+};
+
+mat4        MV;
+mat4        MVP_inv;
+#ifdef BATCH
+// Batched views (cc6_batch.vert): row vView of tex_views holds the columns of MV and MVP_inv
+flat in int         vView;
+uniform sampler2D   tex_views;
+#endif
+
+layout(location = 0) out vec4 fColor;
+#ifdef GBUFFER
+// G-buffer output instead of the color: fColor = (position, k_max), fNormal = (normal, k_min), 0 on a miss
+layout(location = 1) out vec4 fNormal;
+#endif
 
 struct return_t
 {
@@ -27,6 +60,11 @@ struct return_t
 };
 
 #define MAX_ITERATIONS 1000
+#define MAX_REFINEMENTS 16
+
+#define INTERSECTION_SECANT     0
+#define INTERSECTION_BISECTION  1
+#define INTERSECTION_NEWTON     2
 
 
 #define DENOM_M 0.00260416667 // 1/384
@@ -93,7 +131,9 @@ float[38]	c;
 #define c37	c[37]		//( 2, 1, 1)
 
 
-#define EVAL(p) (preprocess(p), fetch_coefficients(), eval_M())
+int n_evals = 0;
+
+#define EVAL(p) (preprocess(p), fetch_coefficients(), n_evals++, eval_M())
 
 #define	GET_DATA(texcoords)	texelFetch(tex_volume, texcoords, 0).r
 
@@ -160,6 +200,68 @@ void preprocess(vec3 p_in)
     u0003 = u3*u0002;
 }
 
+#ifdef PACKED
+// Packed layout (Volume.packed): texel (i, y, z) of tex_volume holds the lattice values
+// i-2 .. i+1 of the row (y, z). The 38 coefficients are among the 4x4x4 lattice points
+// org + type_R*(x-1, y-1, z-1), x, y, z in [0, 3]: rows[4*y+z] holds the row (y, z) of
+// them in the order of x, one fetch each. Row (3, 3) is never used.
+vec4	rows[16];
+
+void fetch_coefficients(void)
+{
+	ivec3	coords = org - ivec3(0, 0, origin_z);     // the texture of a slab starts at origin_z
+	coords.x += int(type_R.x > 0);
+	for(int y = 0 ; y < 4 ; y++)
+		for(int z = 0 ; z < 4 ; z++)
+			if(y < 3 || z < 3)
+			{
+				vec4	row = texelFetch(tex_volume, coords + ivec3(0, type_R.y*(y-1), type_R.z*(z-1)), 0);
+				rows[4*y+z] = type_R.x > 0 ? row : row.wzyx;
+			}
+	// c_i at the offset (a, b, c) of the table above is at (x, y, z) = (a, b, c), (c, a, b)
+	// or (b, c, a) + 1 for type_P 0, 1 or 2: the row and the index in it of each
+#define	ROW_C(idx_c, row0, x0, row1, x1, row2, x2)	c[idx_c] = type_P == 0 ? rows[row0][x0] : type_P == 1 ? rows[row1][x1] : rows[row2][x2];
+	ROW_C( 0,  1,  0,  0,  1,  4,  0);
+	ROW_C( 1,  4,  0,  1,  0,  0,  1);
+	ROW_C( 2,  5,  0,  1,  1,  4,  1);
+	ROW_C( 3,  6,  0,  1,  2,  8,  1);
+	ROW_C( 4,  9,  0,  2,  1,  4,  2);
+	ROW_C( 5, 10,  0,  2,  2,  8,  2);
+	ROW_C( 6,  0,  1,  4,  0,  1,  0);
+	ROW_C( 7,  1,  1,  4,  1,  5,  0);
+	ROW_C( 8,  2,  1,  4,  2,  9,  0);
+	ROW_C( 9,  4,  1,  5,  0,  1,  1);
+	ROW_C(10,  5,  1,  5,  1,  5,  1);
+	ROW_C(11,  6,  1,  5,  2,  9,  1);
+	ROW_C(12,  7,  1,  5,  3, 13,  1);
+	ROW_C(13,  8,  1,  6,  0,  1,  2);
+	ROW_C(14,  9,  1,  6,  1,  5,  2);
+	ROW_C(15, 10,  1,  6,  2,  9,  2);
+	ROW_C(16, 11,  1,  6,  3, 13,  2);
+	ROW_C(17, 13,  1,  7,  1,  5,  3);
+	ROW_C(18, 14,  1,  7,  2,  9,  3);
+	ROW_C(19,  0,  2,  8,  0,  2,  0);
+	ROW_C(20,  1,  2,  8,  1,  6,  0);
+	ROW_C(21,  2,  2,  8,  2, 10,  0);
+	ROW_C(22,  4,  2,  9,  0,  2,  1);
+	ROW_C(23,  5,  2,  9,  1,  6,  1);
+	ROW_C(24,  6,  2,  9,  2, 10,  1);
+	ROW_C(25,  7,  2,  9,  3, 14,  1);
+	ROW_C(26,  8,  2, 10,  0,  2,  2);
+	ROW_C(27,  9,  2, 10,  1,  6,  2);
+	ROW_C(28, 10,  2, 10,  2, 10,  2);
+	ROW_C(29, 11,  2, 10,  3, 14,  2);
+	ROW_C(30, 13,  2, 11,  1,  6,  3);
+	ROW_C(31, 14,  2, 11,  2, 10,  3);
+	ROW_C(32,  1,  3, 12,  1,  7,  0);
+	ROW_C(33,  4,  3, 13,  0,  3,  1);
+	ROW_C(34,  5,  3, 13,  1,  7,  1);
+	ROW_C(35,  6,  3, 13,  2, 11,  1);
+	ROW_C(36,  9,  3, 14,  1,  7,  2);
+	ROW_C(37, 10,  3, 14,  2, 11,  2);
+#undef	ROW_C
+}
+#else
 void fetch_coefficients(void)
 {
 	ivec3 bit_P = ivec3(type_P==0, type_P==1, type_P==2);
@@ -167,7 +269,22 @@ void fetch_coefficients(void)
 	ivec3 diry = ivec3(type_R.x*bit_P.z, type_R.y*bit_P.x, type_R.z*bit_P.y);
 	ivec3 dirz = ivec3(type_R.x*bit_P.y, type_R.y*bit_P.z, type_R.z*bit_P.x);
 
-	ivec3	coords = org;
+	ivec3	coords = org - ivec3(0, 0, origin_z);     // the texture of a slab starts at origin_z
+	if(use_bricks)
+	{
+		// Bricked volume: tex_volume is the brick cache. The stencil stays within
+		// the apron of the brick containing org, so one page table lookup serves
+		// all 38 fetches. Bricks that are not resident hold a value on the same
+		// side of the isolevel as the whole brick.
+		ivec3	brick = clamp(org/size_brick, ivec3(0), textureSize(tex_page_table, 0)-1);
+		vec4	page = texelFetch(tex_page_table, brick, 0);
+		if(page.x < 0.0)
+		{
+			for(int i = 0 ; i < 38 ; i++) c[i] = page.w;
+			return;
+		}
+		coords += ivec3(page.xyz) + size_apron - brick*size_brick;
+	}
 #define	FETCH_C(idx_c, offset)	coords += (offset); c[idx_c] = GET_DATA(coords);
 	c[10] = GET_DATA(coords);
 	FETCH_C(23, dirx);
@@ -209,6 +326,7 @@ void fetch_coefficients(void)
 	FETCH_C(25, dirx);
 #undef	FETCH_C
 }
+#endif
 
 float eval_M_expr_red(void)
 {
@@ -287,7 +405,7 @@ float eval_M(void)
 {
     return (float(type_tet==TYPE_BLUE)*eval_M_expr_blue()
            +float(type_tet==TYPE_GREEN)*eval_M_expr_green()
-           +float(type_tet==TYPE_RED)*eval_M_expr_red()) * DENOM_M;
+           +float(type_tet==TYPE_RED)*eval_M_expr_red()) * (DENOM_M*data_scale) + data_bias;
 }
 vec3 eval_G_expr_red(void)
 {
@@ -430,7 +548,7 @@ vec3[2] eval_H_expr_red(void)
                u1*((c0+c4+c6-c7-c8+c13-c14-c15+c19-c20-c21+c26-c27-c28+c32+c36) + 2*(-c3+c9+c22-c35) + 4*(-c10+c12-c23+c25)) +
                u2*((c1+c3+c6+c8+c19+c21+c33+c35) + 2*(-c4-c7-c20-c36) + 3*(c9+c11+c13+c15+c22+c24+c26+c28) + 4*(-c14-c27) + 8*(-c10-c23)) +
                u3*((c1-c0+c3-c4-c32+c33+c35-c36) + 2*(c6+c8+c13+c15+c19+c21+c26+c28) + 3*(-c7+c9+c11-c14-c20+c22+c24-c27) + 8*(-c10-c23));
-    h[1].x = 2*u0*(((c6-c8-c13+c15+c19-c21-c26+c28)) +
+    h[1].x = 2*(u0*((c6-c8-c13+c15+c19-c21-c26+c28)) +
                 u3*((c6-c8-c13+c15+c19-c21-c26+c28))) +
                u1*((c0-c4+c6+c7-c13-c14+c19+c20-c26-c27+c32-c36) + 3*(-c8+c15-c21+c28)) +
                u2*((c1-c3+c6-c8+c9-c11+c19-c21+c22-c24+c33-c35) + 3*(-c13+c15-c26+c28));
@@ -524,7 +642,7 @@ vec3 compute_gradient(vec3 dummy)
     g *= vec3(type_R);
 
     // scale
-    return (DENOM_G*scale_norm)*g;
+    return (DENOM_G*data_scale*scale_norm)*g;
 }
 
 
@@ -551,59 +669,17 @@ float[6] compute_Hessian(vec3 dummy)
     h[1] *= float(type_R.x*type_R.y*type_R.z)*vec3(type_R);
 
     // scale
-    h[0] *= scale_norm*scale_norm*DENOM_H;
-    h[1] *= scale_norm.yzx*scale_norm.zxy*DENOM_H;
+    h[0] *= scale_norm*scale_norm*(DENOM_H*data_scale);
+    h[1] *= scale_norm.yzx*scale_norm.zxy*(DENOM_H*data_scale);
 
     return float[6](h[0].x, h[0].y, h[0].z, h[1].x, h[1].y, h[1].z);
 }
 
-#define	SHADING_BLINN_PHONG 1
-struct TMaterial
-{
-	vec3	ambient;
-	vec3	diffuse;
-	vec3	specular;
-	vec3	emission;
-	float	shininess;
-};
-struct TLight
-{
-	vec4	position;
-	vec3	ambient;
-	vec3	diffuse;
-	vec3	specular;
-};
+#include "cc6_shading.glsl"
 
-TLight		uLight = TLight(
-        vec4(1,1,1,0),
-        vec3(.2,.2,.2),
-        vec3(1,1,1),
-        vec3(1,1,1)
-        );
-
-vec4 shade_Blinn_Phong(vec3 n, vec4 pos_eye, TMaterial material, TLight light)
-{
-	vec3	l;
-	if(light.position.w == 1.0)
-		l = normalize((light.position - pos_eye).xyz);		// positional light
-	else
-		l = normalize((light.position).xyz);	// directional light
-	vec3	v = -normalize(pos_eye.xyz);
-	vec3	h = normalize(l + v);
-	float	l_dot_n = max(dot(l, n), 0.0);
-	vec3	ambient = light.ambient * material.ambient;
-	vec3	diffuse = light.diffuse * material.diffuse * l_dot_n;
-	vec3	specular = vec3(0.0);
-
-	if(l_dot_n >= 0.0)
-	{
-		specular = light.specular * material.specular * pow(max(dot(h, n), 0.0), material.shininess);
-	}
-	return vec4(ambient + diffuse + specular, 1);
-}
 
-
-vec4 compute_color(vec4 p, vec3 g, float[6] d2) {
+// Principal curvatures (k_max, k_min) of the isosurface from the gradient and the Hessian.
+vec2 compute_curvature(vec3 g, float[6] d2) {
 
 	float	Dxx = d2[0];
 	float	Dyy = d2[1];
@@ -627,32 +703,247 @@ vec4 compute_color(vec4 p, vec3 g, float[6] d2) {
 	float   k_max = (T + sqrt(2.0*F*F - T*T))*0.5;
 	float   k_min = (T - sqrt(2.0*F*F - T*T))*0.5;
 
-	float	scale_k = 10;
-	vec2	tc = vec2(scale_k*vec2(k_max,k_min)+0.5);
+	return vec2(k_max, k_min);
+}
+
+vec4 compute_color(vec4 p, vec3 g, float[6] d2) {
 
 	if(p.w!=0.0)
 	{
-#if	SHADING_BLINN_PHONG
-		TMaterial	material = 
-			TMaterial(
-				vec3(.1,.1,.1),
-				texture(tex_colormap_2d, tc).xyz,
-				vec3(1,1,1),
-				vec3(0,0,0),
-				128.0*0.5
-				);
-		return shade_Blinn_Phong(normalize(mat3(MV)*(-p.w*g)), MV*vec4(p.xyz,1), material, uLight);
-#else
-		return texture(tex_colormap_2d, tc);
-#endif
+		return shade_curvature(p.xyz, normalize(-p.w*g), compute_curvature(g, d2));   // the normal of the G-buffer
 	}
 }
 
 
+// Number of steps from p to the first sample past the macro-cell.
+int steps_to_exit(ivec3 cell, vec3 p, vec3 dir, float dt)
+{
+    vec3    bound = (vec3(cell) + vec3(greaterThanEqual(dir, vec3(0))))*size_macro;
+    vec3    t = mix((bound - p)/dir, vec3(1e20), equal(dir, vec3(0)));
+    float   t_exit = min(min(t.x, t.y), t.z);
+    return max(1, int(ceil(t_exit/dt)));
+}
+
+// Empty-space skipping: if the macro-cell containing p cannot contain a
+// crossing of level on the side we are looking for, returns the number of
+// steps to the first sample past the cell. Returns 1 otherwise.
+int steps_to_skip(vec3 p, vec3 dir, float dt, float orientation)
+{
+    ivec3   cell = clamp(ivec3(floor(p/size_macro)), ivec3(0), textureSize(tex_minmax, 0)-1);
+    vec2    range = texelFetch(tex_minmax, cell, 0).rg;
+    bool    empty = (orientation > 0.0) ? (range.y <= level) : (range.x >= level);
+    if(!empty) return 1;
+    return steps_to_exit(cell, p, dir, dt);
+}
+
+// Linear interpolation of the crossing between two samples on both sides of the isosurface.
+vec3 refine_secant(vec3 p0, float f0, vec3 p1, float f1, float iso)
+{
+    if(abs(f1-f0) > 0.00001)
+        return (p1*(f0-iso) - p0*(f1-iso))/(f0-f1);
+    return p1;
+}
+
+// Bisection on [p0,p1] (p0 on the starting side) down to the tolerance, then a secant step.
+vec3 refine_bisection(vec3 p0, float f0, vec3 p1, float f1, float orientation, float iso)
+{
+    float   tol = tolerance*dim_max;
+    for(int i = 0 ; i < MAX_REFINEMENTS && distance(p0, p1) > tol ; i++)
+    {
+        vec3    pm = .5*(p0 + p1);
+        float   fm = EVAL(pm);
+        if(orientation*fm > orientation*iso)
+        {
+            p1 = pm;
+            f1 = fm;
+        }
+        else
+        {
+            p0 = pm;
+            f0 = fm;
+        }
+    }
+    return refine_secant(p0, f0, p1, f1, iso);
+}
+
+// Newton iteration along the ray using the directional derivative of the box-spline,
+// safeguarded by the bracket [p0,p1]: steps leaving the bracket fall back to bisection.
+vec3 refine_newton(vec3 p0, float f0, vec3 p1, float f1, vec3 dir, float orientation, float iso)
+{
+    float   tol = tolerance*dim_max;
+    float   t0 = 0;
+    float   t1 = dot(p1 - p0, dir);
+    float   t = dot(refine_secant(p0, f0, p1, f1, iso) - p0, dir);
+    vec3    origin = p0;
+    for(int i = 0 ; i < MAX_REFINEMENTS ; i++)
+    {
+        vec3    p = origin + t*dir;
+        float   f = EVAL(p);
+        if(orientation*f > orientation*iso)     t1 = t;
+        else                                    t0 = t;
+#ifdef PREPROC_DERIVATIVES
+        preproc_derivatives(p);
+#endif
+        // compute_gradient() is scaled to the normalized coordinates; undo it for lattice steps.
+        float   df = dot(compute_gradient(p)/scale_norm, dir);
+        float   t_next = (df != 0.0) ? t - (f-iso)/df : .5*(t0 + t1);
+        if(t_next <= t0 || t_next >= t1)
+            t_next = .5*(t0 + t1);
+        bool    converged = abs(t_next - t) < tol || t1 - t0 < tol;
+        t = t_next;
+        if(converged) break;
+    }
+    return origin + t*dir;
+}
+
+vec3 refine_intersection(vec3 p0, float f0, vec3 p1, float f1, vec3 dir, float orientation, float iso)
+{
+    switch(intersection){
+        case INTERSECTION_BISECTION : return refine_bisection(p0, f0, p1, f1, orientation, iso);
+        case INTERSECTION_NEWTON    : return refine_newton(p0, f0, p1, f1, dir, orientation, iso);
+    }
+    return refine_secant(p0, f0, p1, f1, iso);
+}
+
+// Entry and exit points of the ray through this pixel with the bbox, in the [0,1]^3
+// coordinates the bbox pass writes into tex_front/tex_back (both 0 on a miss).
+void intersect_bbox(out vec3 entry, out vec3 exit)
+{
+    vec4    p_near = MVP_inv*vec4(2.0*vTexCoord-1.0, -1, 1);
+    vec4    p_far = MVP_inv*vec4(2.0*vTexCoord-1.0, 1, 1);
+    vec3    o = p_near.xyz/p_near.w;
+    vec3    d = p_far.xyz/p_far.w - o;
+    vec3    t0 = (-.5*scale_bbox_norm - o)/d;
+    vec3    t1 = (.5*scale_bbox_norm - o)/d;
+    vec3    t_min = min(t0, t1);
+    vec3    t_max = max(t0, t1);
+    float   t_entry = max(max(max(t_min.x, t_min.y), t_min.z), 0.0);   // clipped by the near plane
+    float   t_exit = min(min(min(t_max.x, t_max.y), t_max.z), 1.0);
+    entry = exit = vec3(0);
+    if(t_entry < t_exit)
+    {
+        entry = (o + t_entry*d)/scale_bbox_norm + .5;
+        exit = (o + t_exit*d)/scale_bbox_norm + .5;
+    }
+}
+
+#ifdef MULTI_LEVEL
+// Empty-space skipping of the multi-level march: the macro-cell containing p is skipped
+// if its range contains none of the levels.
+int steps_to_skip_levels(vec3 p, vec3 dir, float dt)
+{
+    ivec3   cell = clamp(ivec3(floor(p/size_macro)), ivec3(0), textureSize(tex_minmax, 0)-1);
+    vec2    range = texelFetch(tex_minmax, cell, 0).rg;
+    for(int i = 0 ; i < num_levels ; i++)
+        if(range.x <= levels[i] && levels[i] <= range.y) return 1;
+    return steps_to_exit(cell, p, dir, dt);
+}
+
+// Number of levels below f: samples with different counts lie on both sides of a level.
+int count_below(float f)
+{
+    int     n = 0;
+    for(int i = 0 ; i < num_levels ; i++)
+        n += int(levels[i] < f);
+    return n;
+}
+
+// Marches from start once for all levels: the crossings between two samples are refined and
+// shaded in the order the ray meets them and composited front-to-back until the opacity
+// reaches opacity_max. Returns the color over a white background.
+vec4 march_levels(vec3 start, vec3 dir, float len_full, inout int n_iterations, inout int n_hits)
+{
+    float   step = scale_step*dim_max;
+    vec3    p = start;
+    vec3    p_prev = p;
+    float   len = 0;
+    float   voxel = EVAL(p);
+    float   voxel_prev = voxel;
+    int     below = count_below(voxel);
+    int     below_prev = below;
+    vec4    dst = vec4(0);      // premultiplied color, opacity
+
+    int     i = 0;
+    while(dst.a < opacity_max)
+    {
+        // march to the next sample across any of the levels (kept tight, as the single-level march)
+        int     n_steps = 1;
+        for( ; i < MAX_ITERATIONS ; i++)
+        {
+            n_steps = skip_empty ? steps_to_skip_levels(p, dir, step) : 1;
+            p += float(n_steps)*step*dir;
+            len += float(n_steps)*step;
+            if(len > len_full)
+                break;
+            voxel = EVAL(p);
+            below = count_below(voxel);
+            if(below != below_prev)
+                break;
+            voxel_prev = voxel;
+            p_prev = p;
+        }
+        n_iterations = i;
+        if(i == MAX_ITERATIONS || len > len_full)
+            break;
+        i++;
+
+        if(n_steps > 1)
+        {
+            // The previous sample was skipped: evaluate it for the refinement.
+            p_prev = p - step*dir;
+            voxel_prev = EVAL(p_prev);
+        }
+        // the levels between the two samples, in the order the ray crosses them
+        int     k_end = abs(below - below_prev);
+        for(int k = 0 ; k < k_end && dst.a < opacity_max ; k++)
+        {
+            int     j = (below > below_prev) ? below_prev + k : below_prev - 1 - k;
+            float   orientation = 2.0*float(below > below_prev)-1.0;
+            vec3    q = refine_intersection(p_prev, voxel_prev, p, voxel, dir, orientation, levels[j]);
+#ifndef NO_PREPROCESS
+            preprocess(q);
+#endif
+#ifndef NO_FETCH_COEFFICIENTS
+            fetch_coefficients();
+#endif
+#ifdef PREPROC_DERIVATIVES
+            preproc_derivatives(q);
+#endif
+            vec3    g = compute_gradient(q);
+            vec3    pos = (q*vec3(scale_norm) + vec3(offset_norm) - vec3(.5,.5,.5));
+            vec4    color = shade_color(pos, -orientation*g, level_colors[j].rgb);
+            float   alpha = level_colors[j].a;
+            dst += (1.0 - dst.a)*vec4(alpha*color.rgb, alpha);
+            n_hits++;
+        }
+        below_prev = below;
+        voxel_prev = voxel;
+        p_prev = p;
+    }
+    return dst + (1.0 - dst.a)*vec4(1,1,1,1);
+}
+#endif
+
 void main() {
 
-    vec3 start = texture(tex_front, vTexCoord).xyz*scale_lattice + offset_lattice;
-    vec3 end = texture(tex_back, vTexCoord).xyz*scale_lattice + offset_lattice;
+    MV = view_MV;
+    MVP_inv = view_MVP_inv;
+#ifdef BATCH
+    MV = mat4(texelFetch(tex_views, ivec2(0, vView), 0), texelFetch(tex_views, ivec2(1, vView), 0),
+              texelFetch(tex_views, ivec2(2, vView), 0), texelFetch(tex_views, ivec2(3, vView), 0));
+    MVP_inv = mat4(texelFetch(tex_views, ivec2(4, vView), 0), texelFetch(tex_views, ivec2(5, vView), 0),
+                   texelFetch(tex_views, ivec2(6, vView), 0), texelFetch(tex_views, ivec2(7, vView), 0));
+#endif
+    vec3 start, end;
+    if(analytic_bbox)
+        intersect_bbox(start, end);
+    else
+    {
+        start = texture(tex_front, vTexCoord).xyz;
+        end = texture(tex_back, vTexCoord).xyz;
+    }
+    start = start*scale_lattice + offset_lattice;
+    end = end*scale_lattice + offset_lattice;
     
     vec3    p = start;
     vec3    p_prev;
@@ -663,15 +954,80 @@ void main() {
     float   len = 0;
     float   len_full = length(end - start);
     float   voxel, voxel_prev;
+    int     n_iterations = 0;
 
+#ifdef MULTI_LEVEL
+    int     n_hits = 0;
+    fColor = march_levels(start, dir, len_full, n_iterations, n_hits);
+    if(debug_cost)
+        fColor = vec4(float(n_iterations), float(n_evals), float(n_hits), float(len_full > 0.0));
+#else
+    // The march ends MAX_ITERATIONS steps from the start, whatever the empty-space skipping
+    // and where it starts (a slab, a temporal start), so that they all stop at the same sample.
+    // Sample k is at start + k*step*dir, not accumulated, so they also evaluate the same points.
+    len_full = min(len_full, (float(MAX_ITERATIONS) + 0.5)*step);
+    int     k = 0;
+#ifdef SLAB
+    // Sort-last rendering: only the samples of the full ray with z in the slab, from the one
+    // before them to the one after them (the sign change may be across a slab bound, and the
+    // slabs overlap by a sample). The other slabs march the rest of the ray and the nearest hit
+    // of all is kept.
+    vec2    t_slab = (slab_z - start.z)/dir.z;
+    k = int(max(ceil(max(min(t_slab.x, t_slab.y), 0.0)/step) - 1.0, 0.0));
+    len = float(k)*step;
+    len_full = min(max(t_slab.x, t_slab.y) + step, len_full);
+    p = start + len*dir;
+#endif
     voxel = EVAL(p);
 
     float   orientation = 2.0*float(voxel < level)-1.0;	// equivalent to (voxel<level?1:-1)
 
+    if(temporal)
+    {
+        // Skip to a sample (on the regular march grid) a safety margin before the nearest of
+        // the previous hits reprojected onto this pixel and its neighbours, if it is on the same
+        // side of the isosurface. Neighbourhoods with a pixel without a previous hit (disoccluded,
+        // a silhouette or a hole of the splats) or with a depth discontinuity, where a thin
+        // feature may lie before the nearest hit, and sign mismatches march in full.
+        float   t_prev = len_full;
+        float   t_prev_max = 0.0;
+        bool    valid = true;
+        ivec2   size_start = textureSize(tex_start, 0);
+        for(int j = -1; j <= 1; j++)
+            for(int i = -1; i <= 1; i++)
+            {
+                // the neighbours of the border pixels stay within the image
+                ivec2   coords = clamp(ivec2(gl_FragCoord.xy) + ivec2(i, j), ivec2(0), size_start - 1);
+                vec4    hit_prev = texelFetch(tex_start, coords, 0);
+                float   t_hit = dot(hit_prev.xyz - start, dir);
+                valid = valid && hit_prev.w > 0.0;
+                t_prev = min(t_prev, t_hit);
+                t_prev_max = max(t_prev_max, t_hit);
+            }
+        int     k_t = int(floor((t_prev - temporal_margin*dim_max)/step));
+        float   t = float(k_t)*step;
+        if(valid && t_prev_max - t_prev < temporal_margin*dim_max && t > 0.0 && t < len_full)
+        {
+            float   voxel_t = EVAL(start + t*dir);
+            if(orientation*voxel_t < orientation*level)
+            {
+                p = start + t*dir;
+                k = k_t;
+                len = t;
+                voxel = voxel_t;
+            }
+        }
+    }
+    voxel_prev = voxel;
+    p_prev = p;
+
     for(int i = 0 ; i < MAX_ITERATIONS ; i++)
     {
-        p += step*dir;
-        len += step;
+        n_iterations = i+1;
+        int     n_steps = skip_empty ? steps_to_skip(p, dir, step, orientation) : 1;
+        k += n_steps;
+        len = float(k)*step;
+        p = start + len*dir;
         if(len > len_full)
         {
             break;
@@ -681,16 +1037,19 @@ void main() {
         
         if(orientation*voxel > orientation*level)
         {
-            if(abs(voxel-voxel_prev) > 0.00001)
+            if(n_steps > 1)
             {
-                p = (p*(voxel_prev-level) - p_prev*(voxel-level))/(voxel_prev-voxel);
+                // The previous sample was skipped: evaluate it for the secant.
+                p_prev = start + float(k - 1)*step*dir;
+                voxel_prev = EVAL(p_prev);
+            }
+            p = refine_intersection(p_prev, voxel_prev, p, voxel, dir, orientation, level);
 #ifndef NO_PREPROCESS
-                preprocess(p);
+            preprocess(p);
 #endif
 #ifndef NO_FETCH_COEFFICIENTS
-                fetch_coefficients();
+            fetch_coefficients();
 #endif
-            }
 
 #ifdef PREPROC_DERIVATIVES
             preproc_derivatives(p);
@@ -699,12 +1058,34 @@ void main() {
             float[6] H = compute_Hessian(p);
 
             vec3        pos = (p*vec3(scale_norm) + vec3(offset_norm) - vec3(.5,.5,.5));
+#ifdef GBUFFER
+            vec2        k = compute_curvature(g, H);
+            fColor = vec4(pos, k.x);
+            fNormal = vec4(normalize(-orientation*g), k.y);
+#else
             fColor = compute_color(vec4(pos,orientation), g, H);
+#endif
+#ifdef SLAB
+            gl_FragDepth = dot(p - start, dir)/length(scale_lattice);     // relative to the bbox diagonal
+#endif
+            if(debug_cost)
+                fColor = vec4(float(n_iterations), float(n_evals), 1, float(len_full > 0.0));
             return;
         }
         voxel_prev = voxel;
         p_prev = p;
     }
+#ifdef GBUFFER
+    fColor = vec4(0);
+    fNormal = vec4(0);
+#else
     fColor = vec4(1,1,1,1);
+#endif
+#ifdef SLAB
+    gl_FragDepth = 1.0;     // fails the depth test: the framebuffer keeps the clear color
+#endif
+    if(debug_cost)
+        fColor = vec4(float(n_iterations), float(n_evals), 0, float(len_full > 0.0));
+#endif
 }
 
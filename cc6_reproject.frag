@@ -0,0 +1,9 @@
+#version 330 core
+
+in vec3 vPosition;
+
+out vec4 fColor;
+
+void main() {
+    fColor = vec4(vPosition, 1);    // nearest previous hit in lattice coordinates, w = 0 where none
+}
@@ -0,0 +1,26 @@
+#version 330 core
+
+// Temporal ray-start reuse: scatters the hits of the previous frame's G-buffer
+// (one point per pixel, gl_VertexID) into the current view.
+
+uniform sampler2D   tex_gbuffer_position;   // previous frame: (position, k_max)
+uniform sampler2D   tex_gbuffer_normal;     // previous frame: (normal, k_min), 0 where the ray missed
+uniform int         width;                  // viewport width of the previous frame
+uniform mat4        MVP;                    // current frame
+#include "cc6_volume.glsl"
+
+out vec3 vPosition;
+
+void main() {
+    ivec2   xy = ivec2(gl_VertexID % width, gl_VertexID / width);
+    if(texelFetch(tex_gbuffer_normal, xy, 0).xyz == vec3(0))
+    {
+        gl_Position = vec4(2, 2, 2, 1);     // no hit: clipped
+        return;
+    }
+    // normalized -> lattice -> bbox [0,1]^3 -> object coordinates of bbox.vert
+    vec3    p = (texelFetch(tex_gbuffer_position, xy, 0).xyz + .5 - offset_norm)/scale_norm;
+    vec3    t = (p - offset_lattice)/scale_lattice;
+    vPosition = p;
+    gl_Position = MVP*vec4((t - .5)*scale_bbox_norm, 1);
+}
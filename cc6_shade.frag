@@ -0,0 +1,26 @@
+#version 330 core
+
+// Shading pass of deferred rendering: colors the G-buffer written by
+// cc6_raycast_curvature.frag compiled with GBUFFER.
+
+uniform sampler2D   tex_gbuffer_position;   // (position, k_max)
+uniform sampler2D   tex_gbuffer_normal;     // (normal, k_min), 0 where the ray missed
+uniform sampler2D   tex_colormap_2d;
+uniform mat4        MV;
+uniform float       scale_k;
+
+out vec4 fColor;
+
+#include "cc6_shading.glsl"
+
+void main() {
+    ivec2   xy = ivec2(gl_FragCoord.xy);
+    vec4    position = texelFetch(tex_gbuffer_position, xy, 0);
+    vec4    normal = texelFetch(tex_gbuffer_normal, xy, 0);
+    if(normal.xyz == vec3(0))
+    {
+        fColor = vec4(1,1,1,1);
+        return;
+    }
+    fColor = shade_curvature(position.xyz, normal.xyz, vec2(position.w, normal.w));
+}
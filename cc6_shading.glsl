@@ -0,0 +1,80 @@
+// Shading of the isosurface from its position, normal and principal curvatures,
+// shared by the raycast (forward) and the G-buffer shading pass (cc6_shade.frag).
+// The including shader declares tex_colormap_2d, MV and scale_k.
+
+#ifndef SHADING_BLINN_PHONG     // may be set as a Program define
+#define	SHADING_BLINN_PHONG 1
+#endif
+struct TMaterial
+{
+	vec3	ambient;
+	vec3	diffuse;
+	vec3	specular;
+	vec3	emission;
+	float	shininess;
+};
+struct TLight
+{
+	vec4	position;
+	vec3	ambient;
+	vec3	diffuse;
+	vec3	specular;
+};
+
+TLight		uLight = TLight(
+        vec4(1,1,1,0),
+        vec3(.2,.2,.2),
+        vec3(1,1,1),
+        vec3(1,1,1)
+        );
+
+vec4 shade_Blinn_Phong(vec3 n, vec4 pos_eye, TMaterial material, TLight light)
+{
+	vec3	l;
+	if(light.position.w == 1.0)
+		l = normalize((light.position - pos_eye).xyz);		// positional light
+	else
+		l = normalize((light.position).xyz);	// directional light
+	vec3	v = -normalize(pos_eye.xyz);
+	vec3	h = normalize(l + v);
+	float	l_dot_n = max(dot(l, n), 0.0);
+	vec3	ambient = light.ambient * material.ambient;
+	vec3	diffuse = light.diffuse * material.diffuse * l_dot_n;
+	vec3	specular = vec3(0.0);
+
+	if(l_dot_n >= 0.0)
+	{
+		specular = light.specular * material.specular * pow(max(dot(h, n), 0.0), material.shininess);
+	}
+	return vec4(ambient + diffuse + specular, 1);
+}
+
+// pos: position in normalized coordinates, n: outward normal (any length), k: (k_max, k_min)
+vec4 shade_curvature(vec3 pos, vec3 n, vec2 k)
+{
+	vec2	tc = vec2(scale_k*k+0.5);
+#if	SHADING_BLINN_PHONG
+	TMaterial	material = 
+		TMaterial(
+			vec3(.1,.1,.1),
+			texture(tex_colormap_2d, tc).xyz,
+			vec3(1,1,1),
+			vec3(0,0,0),
+			128.0*0.5
+			);
+	return shade_Blinn_Phong(normalize(mat3(MV)*n), MV*vec4(pos,1), material, uLight);
+#else
+	return texture(tex_colormap_2d, tc);
+#endif
+}
+
+// Isosurface of a single color (multi-level rendering): pos and n as shade_curvature
+vec4 shade_color(vec3 pos, vec3 n, vec3 color)
+{
+#if	SHADING_BLINN_PHONG
+	TMaterial	material = TMaterial(vec3(.1,.1,.1), color, vec3(1,1,1), vec3(0,0,0), 128.0*0.5);
+	return shade_Blinn_Phong(normalize(mat3(MV)*n), MV*vec4(pos,1), material, uLight);
+#else
+	return vec4(color, 1);
+#endif
+}
@@ -0,0 +1,223 @@
+"""
+cc6_sortlast.py
+
+Sort-last distributed rendering of the cc6 isosurface over worker processes.
+
+Every worker owns a z-slab of the lattice (Volume.slab): its volume texture only
+holds the slab and the apron the cc6 stencil reaches from the samples, and it
+raycasts the slab headlessly in its own GL context. The SLAB variant of the
+raycast marches the samples of the full rays that fall into the slab (at the same
+positions along the ray as a single-node render) and writes the color and the
+hit depth. The partial images are in shared memory and are composited per pixel
+by the nearest depth: binary-swap compositing for a power of two of workers (each
+one ends up with its share of the rows), tree compositing otherwise.
+
+    >> python3 cc6_sortlast.py ML80 --workers 4 --size 512x512 --frames 4 --out frames_sortlast
+
+"""
+import os
+import time
+import json
+import argparse
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import pylab
+from cc6_datasets import volumes, open_dataset
+
+def slabs(dim_z, num_workers, apron):
+    """ (z0, z1, apron) of the slabs of num_workers, splitting the lattice planes evenly."""
+    bounds = np.linspace(0, dim_z, num_workers + 1).round().astype(int)
+    return [(int(bounds[i]), int(bounds[i+1]), apron) for i in range(num_workers)]
+
+def slab_apron(scale_step, dim_max):
+    """ Lattice planes a slab needs beyond its bounds: its first and last samples are up to a
+    step outside the slab, their nearest lattice points up to half a point further and the
+    stencil reaches two points more."""
+    return int(np.ceil(scale_step*dim_max + 2.5))
+
+def merge(color, depth, color_other, depth_other, y0, y1):
+    """ Keeps the nearer of the two partial images in color and depth, in the rows [y0, y1)."""
+    nearer = depth_other[y0:y1] < depth[y0:y1]
+    np.copyto(depth[y0:y1], depth_other[y0:y1], where=nearer)
+    np.copyto(color[y0:y1], color_other[y0:y1], where=nearer[...,None])
+
+def composite(rank, num_workers, color, depth, barrier):
+    """ Composites the partial images color[i], depth[i] of all the workers in place; returns the
+    rows [y0, y1) of the final image that end up in the buffers of this worker."""
+    height = depth.shape[1]
+    barrier.wait()          # all the partial images are there
+    bit = 1
+    if num_workers & (num_workers - 1) == 0:
+        # binary swap: the partners of a round hold the same rows, each keeps half of them
+        # and merges the other's half in; the halves they read are not written any more
+        y0, y1 = 0, height
+        while bit < num_workers:
+            mid = (y0 + y1)//2
+            y0, y1 = (y0, mid) if rank & bit == 0 else (mid, y1)
+            merge(color[rank], depth[rank], color[rank ^ bit], depth[rank ^ bit], y0, y1)
+            barrier.wait()
+            bit <<= 1
+        return y0, y1
+    # tree: in round r, the workers at multiples of 2^(r+1) merge the one 2^r after them in
+    while bit < num_workers:
+        if rank % (2*bit) == 0 and rank + bit < num_workers:
+            merge(color[rank], depth[rank], color[rank + bit], depth[rank + bit], 0, height)
+        barrier.wait()
+        bit <<= 1
+    return (0, height) if rank == 0 else (0, 0)
+
+def worker(rank, num_workers, name, cache, width, height, slab, packed, settings, name_shm, barrier, tasks, results):
+    """ Renders the slab of the volume for the poses from tasks and composites it with the other
+    workers; puts (rank, rows, seconds of the raycast) into results, or (rank, None, error)."""
+    try:
+        os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+        # llvmpipe: the workers share the cores
+        os.environ.setdefault('LP_NUM_THREADS', str(max(1, (os.cpu_count() or 1)//num_workers)))
+        import raycaster_cc6
+        from OpenGL import GL
+        raycaster_cc6.Volume.slab = slab
+        raycaster_cc6.Volume.packed = packed
+        renderer = raycaster_cc6.HeadlessRenderer(open_dataset(name, cache), width, height)
+        scene = renderer.scene
+        for key, value in settings.items():
+            setattr(scene.quad_full, key, value)
+        shm = shared_memory.SharedMemory(name_shm)
+        color, depth = buffers(shm, num_workers, width, height)
+        results.put((rank, 'ready', 0))
+        while True:
+            pose = tasks.get()
+            if pose is None:
+                break
+            t = time.perf_counter()
+            scene.set_pose(pose)
+            scene.render(renderer.fbo.fbo)
+            GL.glBindFramebuffer(GL.GL_READ_FRAMEBUFFER, renderer.fbo.fbo)
+            GL.glReadPixels(0, 0, width, height, GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, color[rank])
+            GL.glReadPixels(0, 0, width, height, GL.GL_DEPTH_COMPONENT, GL.GL_FLOAT, depth[rank])
+            t = time.perf_counter() - t
+            results.put((rank, composite(rank, num_workers, color, depth, barrier), t))
+        del color, depth
+        shm.close()
+    except Exception:
+        barrier.abort()
+        results.put((rank, None, traceback.format_exc()))
+
+def buffers(shm, num_workers, width, height):
+    """ The color (RGBA8) and depth (float32) images of all the workers in the shared memory shm."""
+    color = np.ndarray((num_workers, height, width, 4), np.uint8, buffer=shm.buf)
+    depth = np.ndarray((num_workers, height, width), np.float32, buffer=shm.buf, offset=color.nbytes)
+    return color, depth
+
+class SortLastRenderer:
+    """ Renders a volume with num_workers processes, each raycasting a slab of it, and
+    composites their images by depth. settings are QuadFull attributes of the raycast
+    (e.g. scale_step, intersection, tolerance, skip_empty); always forward shaded, with
+    a single isolevel. packed selects the packed layout of the slabs (Volume.packed). Call close()
+    (or use it as a context manager) to stop the workers."""
+
+    def __init__(self, name, width, height, num_workers, settings={}, cache=True, packed=False):
+        info = open_dataset(name, cache)
+        if info.timesteps:
+            print(f'{info.filename}: sort-last rendering shows the first timestep of the series')
+        self.width = width
+        self.height = height
+        self.num_workers = num_workers
+        apron = slab_apron(settings.get('scale_step', 0.001), max(info.dim[:3]))
+        self.slabs = slabs(info.dim[2], num_workers, apron)
+        self.shm = shared_memory.SharedMemory(create=True, size=num_workers*width*height*8)
+        self.color, self.depth = buffers(self.shm, num_workers, width, height)
+        # a fresh interpreter per worker for its own GL context
+        context = multiprocessing.get_context('spawn')
+        barrier = context.Barrier(num_workers)
+        self.results = context.Queue()
+        self.tasks = [context.Queue() for i in range(num_workers)]
+        self.workers = [context.Process(target=worker, args=(rank, num_workers, name, cache, width, height, self.slabs[rank],
+                                                             packed, settings, self.shm.name, barrier, self.tasks[rank], self.results))
+                        for rank in range(num_workers)]
+        for p in self.workers:
+            p.start()
+        self.collect()
+
+    def collect(self):
+        """ {rank: (rows, seconds)} of the results of all the workers."""
+        results = {}
+        for i in range(self.num_workers):
+            rank, rows, t = self.results.get()
+            if rows is None:
+                self.close()
+                raise RuntimeError(f'sort-last worker {rank} failed:\n{t}')
+            results[rank] = (rows, t)
+        return results
+
+    def render(self, pose):
+        """ (height, width, 4) uint8 frame of the pose, top row first. self.times holds the raycast
+        time of every worker."""
+        for tasks in self.tasks:
+            tasks.put(pose)
+        results = self.collect()
+        img = np.empty((self.height, self.width, 4), np.uint8)
+        depth = np.empty((self.height, self.width), np.float32)
+        for rank, ((y0, y1), t) in results.items():
+            img[y0:y1] = self.color[rank, y0:y1]
+            depth[y0:y1] = self.depth[rank, y0:y1]
+        img[depth >= 1] = 255       # no hit in any slab: the background of a single-node render
+        self.times = [results[rank][1] for rank in range(self.num_workers)]
+        return img[::-1]
+
+    def close(self):
+        for tasks, p in zip(self.tasks, self.workers):
+            if p.is_alive():
+                tasks.put(None)
+        for p in self.workers:
+            p.join()
+        self.workers = []
+        del self.color, self.depth
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Sort-last rendering of the cc6 isosurface over worker processes')
+    parser.add_argument('volume', help='registered dataset (' + ', '.join(volumes) + ') or lattice file, as raycaster_cc6.py')
+    parser.add_argument('--no-cache', action='store_true', help='do not use the on-disk dataset and shader program cache')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='worker processes, each raycasting a z-slab')
+    parser.add_argument('--size', default='512x512', help='frame size WxH')
+    parser.add_argument('--poses', help='JSON file with a list of poses (view_angle, angle_x, angle_y, position_x, position_y, level)')
+    parser.add_argument('--frames', type=int, default=36, help='number of orbit frames when no --poses is given')
+    parser.add_argument('--out', default='frames', help='output directory')
+    parser.add_argument('--format', nargs='+', default=['png'], choices=['png', 'npy'], help='output frame formats')
+    parser.add_argument('--scale-step', type=float, default=0.001, help='marching step relative to the largest dimension')
+    parser.add_argument('--intersection', default='secant', choices=('secant', 'bisection', 'newton'), help='root refinement at a sign change')
+    parser.add_argument('--tolerance', type=float, default=0.0001, help='stop tolerance of the root refinement, relative as --scale-step')
+    parser.add_argument('--packed', action='store_true', help='store runs of 4 lattice values along x in RGBA texels (see raycaster_cc6.py)')
+    args = parser.parse_args()
+
+    width, height = (int(s) for s in args.size.lower().split('x'))
+    if args.poses:
+        poses = json.load(open(args.poses, 'r'))
+    else:
+        poses = [{'angle_x': 320, 'angle_y': 360*i/args.frames} for i in range(args.frames)]
+    settings = {'scale_step': args.scale_step, 'intersection': args.intersection, 'tolerance': args.tolerance}
+    os.makedirs(args.out, exist_ok=True)
+    with SortLastRenderer(args.volume, width, height, args.workers, settings, cache=not args.no_cache, packed=args.packed) as renderer:
+        for i, pose in enumerate(poses):
+            t = time.perf_counter()
+            img = renderer.render(pose)
+            t = time.perf_counter() - t
+            print(f'frame {i}: {t*1e3:.0f} ms, slowest slab {max(renderer.times)*1e3:.0f} ms ({args.workers} workers)')
+            name = os.path.join(args.out, f'frame_{i:05d}')
+            for fmt in args.format:
+                if fmt == 'png':
+                    pylab.imsave(name + '.png', img)
+                elif fmt == 'npy':
+                    np.save(name + '.npy', img)
+
+if __name__ == '__main__':
+    main()
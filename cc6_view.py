@@ -0,0 +1,32 @@
+"""
+cc6_view.py
+
+View settings shared by the GPU raycaster (raycaster_cc6.py) and the CPU
+raycaster (cc6_cpu.py): the camera of a pose and the principal curvature
+colormap. Neither needs a GL context.
+
+# Copyright (c) 2022, Minho Kim & Hyunjun Kim
+# Computer Graphics Lab, Dept of Computer Science, University of Seoul
+# All rights reserved.
+
+"""
+import numpy as np
+import glm
+
+# colormap for principal curvatures courtesy of
+# G. Kindlmann, R. Whitaker, T. Tasdizen, T. Möller,
+# "Curvature-based transfer functions for direct volume rendering: Methods and applications"
+# in Proceedings of IEEE Visualization 2003, 2003, pp. 513–520.
+# https://dx.doi.org/10.1109/VISUAL.2003.1250414
+# rows: k_min, columns: k_max (the 3x3 texture of QuadFull.init_colormap)
+COLORMAP_CURVATURE = np.array([[1,0,0], [1,1,0], [0,1,0],
+                               [.5,.5,.5], [.5,.5,.5], [0,1,1],
+                               [.5,.5,.5], [.5,.5,.5], [0,0,1]], dtype=np.float32)
+
+def camera_matrices(view_angle, aspect, angle_x, angle_y, position_x, position_y):
+    """ glm P and MV of the camera of Scene."""
+    P = glm.perspective(glm.radians(view_angle), aspect, 1, 3)
+    MV = glm.translate(glm.mat4(), glm.vec3(position_x, position_y, -2))
+    MV = glm.rotate(MV, glm.radians(angle_x), glm.vec3(1,0,0))
+    MV = glm.rotate(MV, glm.radians(angle_y), glm.vec3(0,1,0))
+    return P, MV
@@ -0,0 +1,20 @@
+// Per-volume parameters (Volume.ubo), shared by the raycast and the reprojection.
+// std140, filled from a NumPy structured array with the fields of Volume.uniform_fields.
+layout(std140) uniform Volume
+{
+    vec3    scale_norm;
+    vec3    offset_norm;
+    vec3    scale_lattice;
+    vec3    offset_lattice;
+    vec3    dim;
+    vec3    scale_bbox_norm;
+    float   dim_max;
+    float   size_macro;
+    float   data_scale;     // lattice value = data_scale*texel + data_bias
+    float   data_bias;
+    bool    use_bricks;
+    int     size_brick;
+    int     size_apron;
+    vec2    slab_z;         // z-range of the samples raycast by a slab of a volume (Volume.slab)
+    int     origin_z;       // lattice z of the first texel plane
+};
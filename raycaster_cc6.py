@@ -7,46 +7,45 @@ raycaster_cc6.py
 
 """
 import sys
+import os
+# PyOpenGL binds its platform when it is first imported, so headless runs
+# have to select EGL (or OSMesa through PYOPENGL_PLATFORM=osmesa) before that.
+if '--headless' in sys.argv:
+    os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
 from OpenGL.GL import *
+import OpenGL.raw.GL.VERSION.GL_3_3
+import OpenGL.raw.GL.VERSION.GL_4_1
 import collections
 import pylab
 import time
 import numpy as np
 import glm
-import os
 import platform
-import glfw # https://github.com/FlorianRhiem/pyGLFW
-
-class VolumeInfo:
-    def __init__(self, filename, dtype, dim, scale, level):
-        self.filename = filename
-        self.dtype = dtype
-        self.dim = dim
-        self.scale = scale
-        self.level = level
-        self.offset = (0,0,0)
-        self.bbox_size = tuple((dim[i]-1)*scale[i] for i in range(3))
+import argparse
+import json
+import ctypes
+import concurrent.futures
+import contextlib
+import hashlib
+import re
+from cc6_datasets import VolumeInfo, LatticeFile, volumes, open_dataset, value_range, path_cache
+from cc6_numpy import compute_minmax
+from cc6_view import camera_matrices, COLORMAP_CURVATURE
 
 class ShaderInfo:
     def __init__(self, name, prog):
         self.name = name
         self.prog = prog
 
-path_volume = './'
-
-volumes = {
-    'ML40' :VolumeInfo(path_volume + 'ML_40_lattice.raw', np.float32, (41,41,41), (1,1,1), 0.5),
-    'ML50' :VolumeInfo(path_volume + 'ML_50_lattice.raw', np.float32, (51,51,51), (1,1,1), 0.5),
-    'ML80' :VolumeInfo(path_volume + 'ML_80_lattice.raw', np.float32, (81,81,81), (1,1,1), 0.5),
-    }
-
 #############################################################################################################
 class BBox:
-    def __init__(self, bbox_size, size_fbo):
-        self.fbo = FBO_bbox(size_fbo[0], size_fbo[1])
-        self.prog_bbox = Program('bbox.vert', 'bbox.frag', ['MVP', 'scale'])  
+    def __init__(self, bbox_size):
+        self.fbo = None             # entry/exit textures, only allocated when the raycast uses them (resize())
+        self.prog_bbox = Program('bbox.vert', 'bbox.frag', [])
         size_max = max(bbox_size)
         self.scale_bbox_norm = tuple(bbox_size[i]/size_max for i in range(3))
+        self.ubo = UniformBuffer('BBox', [('MVP', 'mat4'), ('scale', 'vec3')])
+        self.ubo.data['scale'] = self.scale_bbox_norm
         positions = np.array([  0, 0, 1,
                                 1, 0, 1,
                                 1, 1, 1,
@@ -83,8 +82,8 @@ class BBox:
 
     def render(self, MVP):
         glUseProgram(self.prog_bbox.id)
-        glUniformMatrix4fv(self.prog_bbox.uniform_locs['MVP'], 1, GL_FALSE, MVP)
-        glUniform3fv(self.prog_bbox.uniform_locs['scale'], 1, self.scale_bbox_norm)
+        self.ubo.data['MVP'] = MVP
+        self.ubo.update()
         glBindVertexArray(self.vao)
         glDrawElements(GL_TRIANGLES, self.size_indices, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
         glBindVertexArray(0)
@@ -110,6 +109,15 @@ class BBox:
         self.render(MVP)
         glDisable(GL_CULL_FACE)
 
+    def resize(self, width, height):
+        """ (Re)allocates the entry/exit textures for a width x height framebuffer; returns whether it did."""
+        if self.fbo is not None and (self.fbo.width, self.fbo.height) == (width, height):
+            return False
+        if self.fbo is not None:
+            self.fbo.delete()
+        self.fbo = FBO_bbox(width, height)
+        return True
+
     def render_bbox(self, MVP):
         glViewport(0, 0, self.fbo.width, self.fbo.height)
         glBindFramebuffer(GL_FRAMEBUFFER, self.fbo.fbo)
@@ -120,35 +128,442 @@ class BBox:
         glBindFramebuffer(GL_FRAMEBUFFER, 0)
 
 #############################################################################################################
+# 3D texture format of the lattice by source dtype:
+# (internal format, pixel type, texel dtype, stored value read as 1.0 by the shader)
+texture_formats = {
+    'uint8'  : (GL_R8,   GL_UNSIGNED_BYTE,  np.uint8,   255.),
+    'uint16' : (GL_R16,  GL_UNSIGNED_SHORT, np.uint16,  65535.),
+    'float16': (GL_R16F, GL_HALF_FLOAT,     np.float16, 1.),
+    'float32': (GL_R32F, GL_FLOAT,          np.float32, 1.),
+    'float64': (GL_R32F, GL_FLOAT,          np.float32, 1.),
+    }
+# internal format of the packed layout (Volume.packed) by the one of the lattice
+packed_formats = {GL_R8: GL_RGBA8, GL_R16: GL_RGBA16, GL_R16F: GL_RGBA16F, GL_R32F: GL_RGBA32F}
+
+def pack_rows(texels):
+    """ The packed layout of the (z, y, x) texels (Volume.packed): RGBA texel i of a row holds
+    the texels i-2 .. i+1 of the row, 0 beyond its ends."""
+    padded = np.zeros(texels.shape[:2] + (texels.shape[2] + 4,), texels.dtype)
+    padded[..., 2:-2] = texels
+    return np.ascontiguousarray(np.lib.stride_tricks.sliding_window_view(padded, 4, axis=2))
+
 class Volume:
-    def __init__(self, info, size_fbo_bbox):
+    # the Volume uniform block of cc6_raycast_curvature.frag
+    uniform_fields = [('scale_norm', 'vec3'), ('offset_norm', 'vec3'), ('scale_lattice', 'vec3'), ('offset_lattice', 'vec3'),
+                      ('dim', 'vec3'), ('scale_bbox_norm', 'vec3'), ('dim_max', 'float'), ('size_macro', 'float'),
+                      ('data_scale', 'float'), ('data_bias', 'float'), ('use_bricks', 'bool'), ('size_brick', 'int'), ('size_apron', 'int'),
+                      ('slab_z', 'vec2'), ('origin_z', 'int')]
+    size_macro = 8          # edge length of the macro-cells for empty-space skipping, in lattice units
+    size_cache = 0          # bytes of the GPU brick cache, 0 to keep the whole lattice in one 3D texture
+    size_slab = 64 << 20    # bytes read and uploaded at a time
+    compact = False         # store float lattices as 16-bit normalized texels with scale/bias
+    slab = None             # (z0, z1, apron): only hold the lattice planes [z0-apron, z1+apron) and raycast the
+                            # samples with z in [z0, z1) (sort-last rendering, see cc6_sortlast.py)
+    packed = False          # store runs of 4 lattice values along x in RGBA texels: 15 texture fetches per EVAL
+                            # instead of 38 (PACKED variant of the raycast), 4x the texture memory
+
+    def __init__(self, info, packed=None):
+        if packed is not None:
+            self.packed = packed    # this volume only
         self.load_data(info)
-        self.bbox = BBox(self.info.bbox_size, size_fbo_bbox)
+        self.bbox = BBox(self.info.bbox_size)
         bbox_size_max = max(self.info.bbox_size)
         self.scale_norm = tuple(self.info.scale[i]/bbox_size_max for i in range(3))
         self.offset_norm = tuple(self.info.offset[i]/bbox_size_max for i in range(3))
         self.scale_lattice =  tuple(info.bbox_size[i]/info.scale[i] for i in range(3))
         self.offset_lattice = tuple(-info.offset[i]/info.scale[i] for i in range(3))
         self.upload_data()
+        self.init_uniforms()
+        self.series = None
+        if info.timesteps is not None:
+            if self.bricks is None:
+                self.series = TimeSeries(self)
+            else:
+                print('time series are not paged through the brick cache, showing the first timestep')
        
+    def init_uniforms(self):
+        self.ubo = UniformBuffer('Volume', self.uniform_fields)
+        data = self.ubo.data
+        for name in ('scale_norm', 'offset_norm', 'scale_lattice', 'offset_lattice', 'dim_max', 'size_macro', 'data_scale', 'data_bias'):
+            data[name] = getattr(self, name)
+        data['dim'] = self.info.dim[:3]
+        data['scale_bbox_norm'] = self.bbox.scale_bbox_norm
+        data['use_bricks'] = self.bricks is not None
+        if self.bricks is not None:
+            data['size_brick'] = self.bricks.size_brick
+            data['size_apron'] = self.bricks.size_apron
+        # the first and the last slab reach out to the rays' ends
+        z0, z1 = self.slab[:2] if self.slab is not None else (0, self.info.dim[2])
+        data['slab_z'] = (z0 if z0 > 0 else -1e30, z1 if z1 < self.info.dim[2] else 1e30)
+        data['origin_z'] = self.z_tex
+
     def load_data(self, info):
         self.info = info
         self.dim_max = max(max(self.info.dim[0], self.info.dim[1]), self.info.dim[2])
         self.dim_tex = [self.info.dim[0], self.info.dim[1], self.info.dim[2], 1]
-        self.data = np.fromfile(info.filename, dtype=info.dtype).astype(np.float32)
+        self.bricks = None
+        self.z_tex = 0              # lattice z of the first texel plane
+        if self.slab is not None:
+            z0, z1, apron = self.slab
+            self.z_tex = max(z0 - apron, 0)
+            self.dim_tex[2] = min(z1 + apron, info.dim[2]) - self.z_tex
+            self.size_cache = 0     # slabs are not bricked
+        elif self.size_cache == 0 and self.dim_max > glGetIntegerv(GL_MAX_3D_TEXTURE_SIZE):
+            print(f'{info.filename} exceeds GL_MAX_3D_TEXTURE_SIZE, using a 512MB brick cache')
+            self.size_cache = 512 << 20
+        if self.packed and self.size_cache:
+            print(f'{info.filename}: the brick cache holds the plain layout, not the packed one')
+            self.packed = False
+        if self.packed:
+            self.dim_tex[0] += 1    # texel i holds the lattice values i-2 .. i+1 of a row
+        # texture fetches of the 38 coefficients of an EVAL (and the page table lookup)
+        self.fetches_per_eval = 15 if self.packed else 39 if self.size_cache else 38
+        # the lattice stays on disk and is read in slabs (or bricks)
+        self.data = LatticeFile(info.filename, info.dtype, info.dim, info.offset_file)
+        self.init_format()
+
+    def init_format(self):
+        """ Picks the texture format and the scale/bias mapping texels back to lattice values."""
+        if self.compact and self.data.dtype.kind == 'f' and self.data.dtype.itemsize > 2:
+            # one mapping for all the timesteps of a series
+            ranges = [info.cached('range', lambda: value_range(LatticeFile(info.filename, info.dtype, info.dim, info.offset_file), self.size_slab))
+                      for info in (self.info.timesteps or [self.info])]
+            lo, hi = min(r[0] for r in ranges), max(r[1] for r in ranges)
+            self.format = texture_formats['uint16']
+            self.data_bias = float(lo)
+            self.data_scale = float(hi - lo) or 1.
+        else:
+            self.format = texture_formats[self.data.dtype.name]
+            self.data_bias = 0.
+            self.data_scale = self.format[3]
+        self.pixel_format = GL_RED
+        if self.packed:
+            self.format = (packed_formats[self.format[0]],) + self.format[1:]
+            self.pixel_format = GL_RGBA
+
+    def to_texels(self, values):
+        """ Converts lattice values to the stored texel type, packed if packed."""
+        dtype, norm = self.format[2:]
+        if self.data_scale == norm and self.data_bias == 0:
+            texels = np.asarray(values, dtype=dtype)
+        else:
+            texels = np.clip(np.rint((values - self.data_bias)*(norm/self.data_scale)), 0, norm).astype(dtype)
+        return pack_rows(texels) if self.packed else texels
+
+    def compute_minmax(self, size_macro, apron=3, info=None, data=None):
+        """ compute_minmax() of the lattice (or of the timestep info/data) as the shader reconstructs it."""
+        info, data = (info, data) if info is not None else (self.info, self.data)
+        minmax = info.cached(f'minmax_{size_macro}_{apron}_{self.data_bias:g}',
+                             lambda: compute_minmax(data, size_macro, apron, border=self.data_bias))
+        if self.data_scale != self.format[3]:
+            # quantized values are off by up to half a step
+            minmax += np.float32(.5*self.data_scale/self.format[3])*np.array([-1, 1], dtype=np.float32)
+        return minmax
 
     def upload_data(self):
-        self.texid = glGenTextures(1)
+        if self.size_cache:
+            self.bricks = BrickCache(self, self.size_cache)
+            self.texid = self.bricks.texid
+            self.texid_minmax = self.upload_minmax(self.compute_minmax(self.size_macro))
+            return
+        type = self.format[1]
+        self.texid = self.create_texture()
         glPixelStorei(GL_UNPACK_ALIGNMENT,1)
         glBindTexture(GL_TEXTURE_3D, self.texid)
+        for z, slab in self.data.slabs(self.size_slab, self.z_tex, self.z_tex + self.dim_tex[2]):
+            glTexSubImage3D(GL_TEXTURE_3D, 0, 0, 0, z - self.z_tex, self.dim_tex[0], self.dim_tex[1], slab.shape[0], self.pixel_format, type, self.to_texels(slab))
+        glBindTexture(GL_TEXTURE_3D, 0)
+        self.texid_minmax = self.upload_minmax(self.compute_minmax(self.size_macro))
+
+    def create_texture(self):
+        internal_format, type = self.format[:2]
+        texid = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_3D, texid)
         glTexParameterf(GL_TEXTURE_3D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
         glTexParameterf(GL_TEXTURE_3D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
         glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_BORDER)
         glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_BORDER)
         glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_WRAP_R, GL_CLAMP_TO_BORDER)
-        glTexImage3D(GL_TEXTURE_3D, 0, GL_R32F, self.dim_tex[0], self.dim_tex[1], self.dim_tex[2], 0, GL_RED, GL_FLOAT, self.data)
+        glTexImage3D(GL_TEXTURE_3D, 0, internal_format, self.dim_tex[0], self.dim_tex[1], self.dim_tex[2], 0, self.pixel_format, type, None)
+        glBindTexture(GL_TEXTURE_3D, 0)
+        return texid
+
+    def upload_minmax(self, minmax, texid=None):
+        # min/max of the reconstruction over each macro-cell, used for empty-space skipping
+        if texid is not None:
+            glBindTexture(GL_TEXTURE_3D, texid)
+            glTexSubImage3D(GL_TEXTURE_3D, 0, 0, 0, 0, minmax.shape[2], minmax.shape[1], minmax.shape[0], GL_RG, GL_FLOAT, minmax)
+            glBindTexture(GL_TEXTURE_3D, 0)
+            return texid
+        texid = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_3D, texid)
+        glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_WRAP_R, GL_CLAMP_TO_EDGE)
+        glTexImage3D(GL_TEXTURE_3D, 0, GL_RG32F, minmax.shape[2], minmax.shape[1], minmax.shape[0], 0, GL_RG, GL_FLOAT, minmax)
+        glBindTexture(GL_TEXTURE_3D, 0)
+        return texid
+
+#############################################################################################################
+class TimeSeries:
+    """ Plays back the timesteps of a Volume without stalling the render thread.
+
+    A loader thread reads and converts the following timesteps straight into
+    mapped pixel unpack buffers; there are two, so reading one timestep overlaps
+    uploading the other. The render thread (update()) uploads a filled buffer into
+    the back 3D texture and, once the upload has completed on the GPU, swaps it
+    with the front one by exchanging the texture ids the raycaster binds.
+    """
+    def __init__(self, volume):
+        self.volume = volume
+        self.timesteps = volume.info.timesteps
+        self.index = 0              # timestep shown
+        self.requested = 0          # last timestep handed to the loader
+        self.playing = False
+        self.steps = 0              # single steps requested while paused
+        self.rate = 0               # timesteps per second, 0 for one per displayed frame
+        self.time_swap = 0
+
+        dim = volume.info.dim
+        self.shape = (dim[2], dim[1], volume.dim_tex[0]) + ((4,) if volume.packed else ())
+        self.size = int(np.prod(self.shape))*np.dtype(volume.format[2]).itemsize
+        self.pbos = list(glGenBuffers(2))
+        for pbo in self.pbos:
+            glBindBuffer(GL_PIXEL_UNPACK_BUFFER, pbo)
+            glBufferData(GL_PIXEL_UNPACK_BUFFER, self.size, None, GL_STREAM_DRAW)
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        self.free = list(self.pbos)
+        self.loading = collections.deque()      # (timestep, pbo, future) in request order
+        self.loader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        self.texid_back = volume.create_texture()
+        self.texid_minmax_back = volume.upload_minmax(np.zeros_like(volume.compute_minmax(volume.size_macro)))
+        self.index_back = None      # timestep in the back textures
+        self.fence_back = None
+
+    def following(self, index):
+        return (index + 1) % len(self.timesteps)
+
+    def load(self, index, ptr):
+        """ Loader thread: converts timestep index into the mapped buffer at ptr, returns its min/max grid."""
+        info = self.timesteps[index]
+        data = LatticeFile(info.filename, info.dtype, info.dim, info.offset_file)
+        dtype = self.volume.format[2]
+        texels = np.frombuffer((ctypes.c_ubyte*self.size).from_address(ptr), dtype=dtype).reshape(self.shape)
+        for z, slab in data.slabs(self.volume.size_slab):
+            texels[z:z+slab.shape[0]] = self.volume.to_texels(slab)
+        return self.volume.compute_minmax(self.volume.size_macro, info=info, data=data)
+
+    def request(self):
+        # hand the following timestep to the loader, in a freshly mapped buffer
+        pbo = self.free.pop()
+        self.requested = self.following(self.requested)
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, pbo)
+        ptr = glMapBufferRange(GL_PIXEL_UNPACK_BUFFER, 0, self.size, GL_MAP_WRITE_BIT | GL_MAP_INVALIDATE_BUFFER_BIT)
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        self.loading.append((self.requested, pbo, self.loader.submit(self.load, self.requested, ptr)))
+
+    def upload(self, texid, texid_minmax):
+        # texture upload from the oldest filled buffer, asynchronous on the GPU
+        index, pbo, future = self.loading.popleft()
+        minmax = future.result()
+        dim = self.volume.info.dim
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, pbo)
+        glUnmapBuffer(GL_PIXEL_UNPACK_BUFFER)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        glBindTexture(GL_TEXTURE_3D, texid)
+        glTexSubImage3D(GL_TEXTURE_3D, 0, 0, 0, 0, self.shape[2], dim[1], dim[2], self.volume.pixel_format, self.volume.format[1], ctypes.c_void_p(0))
+        glBindTexture(GL_TEXTURE_3D, 0)
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        self.volume.upload_minmax(minmax, texid_minmax)
+        self.free.append(pbo)
+        return index
+
+    def update(self):
+        """ Advances the streaming; returns whether another timestep was swapped in."""
+        if self.index_back is None and self.loading and self.loading[0][2].done():
+            self.index_back = self.upload(self.texid_back, self.texid_minmax_back)
+            self.fence_back = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        while self.free:
+            self.request()
+
+        due = (self.playing and time.time() - self.time_swap >= (1/self.rate if self.rate else 0)) or self.steps > 0
+        if not due or self.index_back != self.following(self.index):
+            return False
+        if glClientWaitSync(self.fence_back, 0, 0) in (GL_TIMEOUT_EXPIRED, GL_WAIT_FAILED):
+            return False
+        glDeleteSync(self.fence_back)
+        self.fence_back = None
+        volume = self.volume
+        volume.texid, self.texid_back = self.texid_back, volume.texid
+        volume.texid_minmax, self.texid_minmax_back = self.texid_minmax_back, volume.texid_minmax
+        self.index, self.index_back = self.index_back, None
+        self.steps = max(self.steps - 1, 0)
+        self.time_swap = time.time()
+        return True
+
+    def busy(self):
+        return self.playing or self.steps > 0
+
+    def seek(self, index):
+        """ Shows timestep index right away, waiting for it to be loaded."""
+        if index == self.index:
+            return
+        while self.loading:
+            self.upload(self.texid_back, self.texid_minmax_back)
+        if self.fence_back is not None:
+            glDeleteSync(self.fence_back)
+            self.fence_back = None
+        self.index_back = None
+        self.requested = index - 1
+        self.request()
+        self.upload(self.volume.texid, self.volume.texid_minmax)
+        self.index = index
+
+#############################################################################################################
+class BrickCache:
+    """ Paged GPU storage of a lattice that does not fit in one 3D texture.
+
+    The lattice is split into bricks of size_brick^3 lattice points. Each resident
+    brick occupies a slot of the cache texture together with an apron of
+    size_apron points on every side, so the whole cc6 stencil of a point whose
+    nearest lattice point lies in the brick is fetched from one slot. The page
+    table holds, per brick, the texel origin of its slot (x < 0 if not resident)
+    and a value within the brick's range that stands in while it is not resident.
+    Bricks touched by the view whose range contains the isolevel are streamed in,
+    nearest first; the least recently used ones are evicted.
+    """
+    def __init__(self, volume, size_cache, size_brick=32, size_apron=2):
+        self.volume = volume
+        self.data = volume.data     # LatticeFile, indexed [z,y,x]
+        self.size_brick = size_brick
+        self.size_apron = size_apron
+        self.size_slot = size_brick + 2*size_apron
+        self.max_uploads = 64       # bricks uploaded per update (None: no limit)
+        self.pending = 0            # needed bricks left for the following updates
+        self.version = 0            # bricks uploaded so far, i.e. changes of the cache contents
+
+        # conservative range of the values reconstructed from each brick
+        self.range = volume.compute_minmax(size_brick, size_apron).reshape(-1, 2)
+        self.shape = tuple((d-1)//size_brick + 1 for d in self.data.shape)     # bricks along z,y,x
+        self.init_corners(volume)
+
+        num_bricks = len(self.range)
+        internal_format, type, dtype = volume.format[:3]
+        capacity = min(size_cache // (np.dtype(dtype).itemsize*self.size_slot**3), num_bricks)
+        max_slots = glGetIntegerv(GL_MAX_3D_TEXTURE_SIZE) // self.size_slot
+        n = min(int(np.ceil(capacity**(1/3))), max_slots)
+        self.num_slots = (n, n, min(-(-capacity//(n*n)), max_slots)) if capacity else (0, 0, 0)
+        capacity = min(capacity, int(np.prod(self.num_slots)))
+        if capacity == 0:
+            raise ValueError(f'a brick cache of {size_cache} bytes cannot hold a single brick')
+        self.free = [tuple(self.size_slot*np.array(np.unravel_index(i, self.num_slots))) for i in range(capacity)]
+        self.resident = collections.OrderedDict()   # brick -> slot origin, least recently used first
+
+        self.page_table = np.empty((num_bricks, 4), dtype=np.float32)
+        self.page_table[:,:3] = -1
+        self.page_table[:,3] = (self.range.mean(axis=1) - volume.data_bias)/volume.data_scale    # as a texel
+
+        self.texid = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_3D, self.texid)
+        glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexImage3D(GL_TEXTURE_3D, 0, internal_format, *(k*self.size_slot for k in self.num_slots), 0, GL_RED, type, None)
+        self.texid_page_table = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_3D, self.texid_page_table)
+        glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexImage3D(GL_TEXTURE_3D, 0, GL_RGBA32F, self.shape[2], self.shape[1], self.shape[0], 0, GL_RGBA, GL_FLOAT, self.page_table)
+        glBindTexture(GL_TEXTURE_3D, 0)
+        print(f'brick cache: {capacity} of {num_bricks} bricks of {size_brick}^3')
+
+    def init_corners(self, volume):
+        # Object-space corners of the region of each brick: the points whose
+        # nearest lattice point is in the brick, clipped to the lattice.
+        dim = self.data.shape[::-1]
+        bounds = []
+        for axis in range(3):
+            lo = np.arange(self.shape[2-axis])*self.size_brick - .5
+            p = np.clip(np.stack([lo, lo + self.size_brick]), 0, dim[axis]-1)
+            t = (p - volume.offset_lattice[axis])/volume.scale_lattice[axis]
+            bounds.append((t - .5)*volume.bbox.scale_bbox_norm[axis])   # as bbox.vert, after dividing by w=2
+        x, y, z = bounds
+        self.corners = np.ones(self.shape + (8, 4), dtype=np.float32)
+        for i, (cz, cy, cx) in enumerate(np.ndindex(2, 2, 2)):
+            self.corners[...,i,0] = x[cx][None,None,:]
+            self.corners[...,i,1] = y[cy][None,:,None]
+            self.corners[...,i,2] = z[cz][:,None,None]
+        self.corners = self.corners.reshape(-1, 8, 4)
+
+    def touched(self, MVP):
+        """ Bricks whose screen-space bounds overlap the view volume, and their nearest depth."""
+        clip = self.corners @ MVP
+        w = clip[...,3]
+        front = w > 1e-6
+        ndc = clip[...,:3]/np.where(front, w, 1)[...,None]
+        lo = np.where(front[...,None], ndc, np.inf).min(axis=1)
+        hi = np.where(front[...,None], ndc, -np.inf).max(axis=1)
+        # a brick crossing the eye plane is kept, conservatively
+        behind = ~front.all(axis=1)
+        inside = np.all((lo <= 1) & (hi >= -1), axis=1)
+        touched = front.any(axis=1) & (behind | inside)
+        return touched, np.where(front, w, 0).min(axis=1)
+
+    def update(self, MVP, level):
+        """ Streams in the bricks the view needs at the isolevel (or any of a list of them), nearest first."""
+        touched, depth = self.touched(MVP)
+        level = np.atleast_1d(level)
+        crossed = ((self.range[:,0,None] <= level) & (level <= self.range[:,1,None])).any(axis=1)
+        needed = np.flatnonzero(touched & crossed)
+        needed = needed[np.argsort(depth[needed], kind='stable')]
+        missing = []
+        for brick in needed.tolist():
+            if brick in self.resident:
+                self.resident.move_to_end(brick)
+            else:
+                missing.append(brick)
+
+        needed = set(needed.tolist())
+        uploaded = 0
+        for brick in missing:
+            if self.max_uploads is not None and uploaded == self.max_uploads:
+                break
+            if self.free:
+                slot = self.free.pop()
+            else:
+                victim = next(iter(self.resident))
+                if victim in needed:
+                    break   # all slots hold needed bricks, the farthest ones stay out
+                slot = self.resident.pop(victim)
+                self.page_table[victim,:3] = -1
+            self.upload_brick(brick, slot)
+            self.resident[brick] = slot
+            self.page_table[brick,:3] = slot
+            uploaded += 1
+        self.pending = len(missing) - uploaded if uploaded == self.max_uploads else 0
+        self.version += uploaded
+
+        if uploaded:
+            glBindTexture(GL_TEXTURE_3D, self.texid_page_table)
+            glTexSubImage3D(GL_TEXTURE_3D, 0, 0, 0, 0, self.shape[2], self.shape[1], self.shape[0], GL_RGBA, GL_FLOAT, self.page_table)
+            glBindTexture(GL_TEXTURE_3D, 0)
+
+    def upload_brick(self, brick, slot):
+        internal_format, type, dtype = self.volume.format[:3]
+        block = np.zeros((self.size_slot,)*3, dtype=dtype)
+        src, dst = [], []
+        for b, d in zip(np.unravel_index(brick, self.shape), self.data.shape):
+            lo = b*self.size_brick - self.size_apron
+            hi = lo + self.size_slot
+            src.append(slice(max(lo, 0), min(hi, d)))
+            dst.append(slice(max(lo, 0) - lo, min(hi, d) - lo))
+        block[tuple(dst)] = self.volume.to_texels(self.data[tuple(src)])
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        glBindTexture(GL_TEXTURE_3D, self.texid)
+        glTexSubImage3D(GL_TEXTURE_3D, 0, int(slot[0]), int(slot[1]), int(slot[2]), self.size_slot, self.size_slot, self.size_slot, GL_RED, type, block)
         glBindTexture(GL_TEXTURE_3D, 0)
-        self.data = None
 
 #############################################################################################################
 class FBO_bbox:
@@ -185,28 +600,151 @@ class FBO_bbox:
 
         glBindFramebuffer(GL_FRAMEBUFFER, 0)
 
+    def delete(self):
+        glDeleteFramebuffers(1, [self.fbo])
+        glDeleteTextures([self.buf_back, self.buf_front])
+        glDeleteRenderbuffers(1, [self.rbo])
+
+#############################################################################################################
+class FBO_render:
+    """ Offscreen color target (RGBA8 by default) with a depth renderbuffer."""
+    def __init__(self, width, height, internal_format=GL_RGBA8):
+        self.width = width
+        self.height = height
+
+        self.fbo = glGenFramebuffers(1)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+
+        self.buf_color = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, self.buf_color)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexImage2D(GL_TEXTURE_2D, 0, internal_format, width, height, 0, GL_RGBA, GL_UNSIGNED_BYTE, None)
+        glBindTexture(GL_TEXTURE_2D, 0)
+        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, self.buf_color, 0)
+
+        self.rbo = glGenRenderbuffers(1)
+        glBindRenderbuffer(GL_RENDERBUFFER, self.rbo)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT, width, height)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, self.rbo)
+        glBindRenderbuffer(GL_RENDERBUFFER, 0)
+
+        if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+            raise RuntimeError('FBO_render is incomplete')
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+
+    def delete(self):
+        glDeleteFramebuffers(1, [self.fbo])
+        glDeleteTextures([self.buf_color])
+        glDeleteRenderbuffers(1, [self.rbo])
+
+class FBO_gbuffer:
+    """ G-buffer of deferred shading: (position, k_max) and (normal, k_min) RGBA32F targets."""
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+        self.fbo = glGenFramebuffers(1)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+        self.buf_position, self.buf_normal = glGenTextures(2)
+        for i, buf in enumerate((self.buf_position, self.buf_normal)):
+            glBindTexture(GL_TEXTURE_2D, buf)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA32F, width, height, 0, GL_RGBA, GL_FLOAT, None)
+            glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0 + i, GL_TEXTURE_2D, buf, 0)
+        glBindTexture(GL_TEXTURE_2D, 0)
+        glDrawBuffers(2, [GL_COLOR_ATTACHMENT0, GL_COLOR_ATTACHMENT1])
+
+        if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+            raise RuntimeError('FBO_gbuffer is incomplete')
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+
+    def delete(self):
+        glDeleteFramebuffers(1, [self.fbo])
+        glDeleteTextures([self.buf_position, self.buf_normal])
+
 #############################################################################################################
 class QuadFull:
     def __init__(self, volume, size_fbo):
-        self.tex_bbox_back = volume.bbox.fbo.buf_back
-        self.tex_bbox_front = volume.bbox.fbo.buf_front
-        self.tex_volume = volume.texid
         self.init_colormap()
 
+        self.defines = {}       # compile-time switches of the raycast shader, e.g. {'SHADING_BLINN_PHONG': 1}
         try:
             self.progs = {}
-            uniforms = ['dim','level', 'tex_colormap', 'tex_colormap_2d', 'tex_back', 'tex_front', 'MV', 'scale_lattice', 'offset_lattice', 'tex_volume', 'scale_norm', 'offset_norm', 'dim_max', 'scale_step', 'scale_delta' ]
-            self.progs['cc6'] = ShaderInfo('cc6-principal-curvature', Program('raycast_simple.vert', 'cc6_raycast_curvature.frag', uniforms))
+            self.uniforms = ['columns', 'rows']     # the rest is in the Frame and Volume uniform buffers
  
+            self.progs['cc6'] = ShaderInfo('cc6-principal-curvature', self.program())
+            self.progs['gbuffer'] = ShaderInfo('cc6-gbuffer', self.program(gbuffer=True))
+            self.progs['shade'] = ShaderInfo('cc6-shading', self.program_shade())
+            self.progs['reproject'] = ShaderInfo('cc6-reproject', Program('cc6_reproject.vert', 'cc6_reproject.frag',
+                ['width', 'MVP'],
+                samplers={'tex_gbuffer_position': 0, 'tex_gbuffer_normal': 1}))
     
         except BaseException as err:
             print(f'Exception while compiling shaders...!: {err}')
             quit()
 
         self.init_vao()
+        self.ubo = UniformBuffer('Frame', self.uniform_fields)
+        self.MVP_inverted = None    # MVP of view_MVP_inv in the uniform buffer
 
         self.scale_delta = 0.01
         self.scale_step = 0.001
+        self.tolerance = 0.0001     # stop tolerance of the root refinement, relative to dim_max as scale_step
+        self.intersection = 'secant'
+        self.skip_empty = True
+        self.debug_cost = False     # output the per-pixel cost instead of the color (see Scene.render_cost)
+        self.analytic_bbox = True   # intersect the rays with the bbox in the shader instead of reading the bbox pass
+        self.deferred = True        # raycast into a G-buffer, shaded by a separate pass (see Scene.render)
+        self.scale_k = 10.          # curvature to colormap coordinate scale
+        self.temporal = False       # deferred only: start the rays before the reprojected hits of the previous frame
+        self.temporal_margin = 0.1  # safety margin before the reprojected hit, relative to dim_max as scale_step
+        self.opacity_max = 0.95     # multi-level rendering: stop the rays at this accumulated opacity
+
+    intersections = ('secant', 'bisection', 'newton')
+    max_levels = 8      # MAX_LEVELS of the raycast shader
+    # texture units of the raycast shader and their targets
+    samplers = {'tex_back': 0, 'tex_front': 1, 'tex_volume': 2, 'tex_views': 3, 'tex_colormap_2d': 4,
+                'tex_minmax': 5, 'tex_page_table': 6, 'tex_start': 7}
+    texture_targets = (GL_TEXTURE_2D, GL_TEXTURE_2D, GL_TEXTURE_3D, GL_TEXTURE_2D, GL_TEXTURE_2D,
+                       GL_TEXTURE_3D, GL_TEXTURE_3D, GL_TEXTURE_2D)
+    # the Frame uniform block of cc6_raycast_curvature.frag
+    uniform_fields = [('view_MV', 'mat4'), ('view_MVP_inv', 'mat4'), ('level', 'float'), ('scale_step', 'float'),
+                      ('scale_delta', 'float'), ('tolerance', 'float'), ('intersection', 'int'), ('skip_empty', 'bool'),
+                      ('analytic_bbox', 'bool'), ('debug_cost', 'bool'), ('scale_k', 'float'), ('temporal', 'bool'),
+                      ('temporal_margin', 'float'), ('num_levels', 'int'), ('opacity_max', 'float'),
+                      ('levels', 'float', max_levels), ('level_colors', 'vec4', max_levels)]
+    shading_defines = ('SHADING_BLINN_PHONG',)      # only used by the shading
+
+    def program(self, gbuffer=False, multi_level=False, batch=False, slab=False, packed=False):
+        """ The raycast program variant of the current defines, writing the G-buffer if gbuffer,
+        compositing several isosurfaces if multi_level, drawing tiles of batched views if batch,
+        marching the slab of the volume and writing the hit depth if slab (Volume.slab), reading
+        the packed layout of the lattice if packed (Volume.packed)."""
+        defines = self.defines
+        if gbuffer:
+            defines = {name: value for name, value in self.defines.items() if name not in self.shading_defines}
+            defines['GBUFFER'] = None
+        if multi_level:
+            defines = dict(defines, MULTI_LEVEL=None)
+        if slab:
+            defines = dict(defines, SLAB=None)
+        if packed:
+            defines = dict(defines, PACKED=None)
+        if batch:
+            defines = dict(defines, BATCH=None)
+            return Program.variant('cc6_batch.vert', 'cc6_raycast_curvature.frag', self.uniforms, defines, self.samplers)
+        return Program.variant('raycast_simple.vert', 'cc6_raycast_curvature.frag', self.uniforms, defines, self.samplers)
+
+    def program_shade(self):
+        defines = {name: value for name, value in self.defines.items() if name in self.shading_defines}
+        return Program.variant('raycast_simple.vert', 'cc6_shade.frag', ['MV', 'scale_k'], defines,
+                               samplers={'tex_gbuffer_position': 0, 'tex_gbuffer_normal': 1, 'tex_colormap_2d': 4})
+
+    def shading_key(self):
+        """ Everything the shading pass depends on besides the G-buffer."""
+        return (self.scale_k, self.tex_colormap2d, tuple(sorted((name, self.defines[name]) for name in self.shading_defines if name in self.defines)))
 
     def init_vao(self):
         verts = np.array(
@@ -226,52 +764,107 @@ class QuadFull:
         glVertexAttribPointer(1, 2, GL_FLOAT, GL_FALSE, 4*ctypes.sizeof(ctypes.c_float), ctypes.c_void_p(2*ctypes.sizeof(ctypes.c_float)))
         glBindVertexArray(0)
 
-    def render_raycast(self, level, volume, MV):
+    def render_raycast(self, level, volume, MV, MVP, gbuffer=False, tex_start=None, levels=None):
+        """ Raycasts into the bound framebuffer, the two attachments of an FBO_gbuffer if gbuffer.
+        tex_start holds the reprojected previous hits (render_reproject) the rays may start from.
+        levels, a list of (isolevel, (r, g, b, opacity)), composites these isosurfaces in one
+        march instead of the isosurface of level (not with gbuffer). The slab of a Volume.slab
+        also writes the hit depth (see cc6_sortlast.py)."""
+        prog = self.program(gbuffer, multi_level=levels is not None, slab=volume.slab is not None, packed=volume.packed)
+        self.bind_raycast(prog, level, volume, self.analytic_bbox, levels, MV, MVP, tex_start=tex_start)
+
+        glBindVertexArray(self.vao)
+        glDrawArrays(GL_TRIANGLE_FAN, 0, 4)
+        glBindVertexArray(0)
+
+    def render_raycast_views(self, level, volume, tex_views, count, columns, rows, levels=None):
+        """ Raycasts count views in one instanced draw into the columns x rows tiles of the bound
+        viewport (cc6_batch.vert). Row i of the RGBA32F texture tex_views holds the columns of MV
+        and of the inverse MVP of view i. Always forward and with the analytic bbox."""
+        prog = self.program(multi_level=levels is not None, batch=True, packed=volume.packed)
+        self.bind_raycast(prog, level, volume, True, levels, tex_views=tex_views)
+        glUniform1i(prog.uniform_locs['columns'], columns)
+        glUniform1i(prog.uniform_locs['rows'], rows)
+
+        glBindVertexArray(self.vao)
+        glDrawArraysInstanced(GL_TRIANGLE_FAN, 0, 4, count)
+        glBindVertexArray(0)
 
+    def bind_raycast(self, prog, level, volume, analytic_bbox, levels, MV=None, MVP=None, tex_start=None, tex_views=None):
+        # clears the framebuffer, binds the textures and fills the uniform buffers of the raycast
         glClearColor(0, 0, 0, 0)
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-        glActiveTexture(GL_TEXTURE0)
-        glBindTexture(GL_TEXTURE_2D, self.tex_bbox_back)
-        glActiveTexture(GL_TEXTURE1)
-        glBindTexture(GL_TEXTURE_2D, self.tex_bbox_front)
-        glActiveTexture(GL_TEXTURE2)
-        glBindTexture(GL_TEXTURE_3D, self.tex_volume)
-        glActiveTexture(GL_TEXTURE4)
-        glBindTexture(GL_TEXTURE_2D, self.tex_colormap2d)
-
+        fbo_bbox = None if analytic_bbox else volume.bbox.fbo
+        bind_textures(self.texture_targets,
+                      (fbo_bbox.buf_back if fbo_bbox else 0, fbo_bbox.buf_front if fbo_bbox else 0,
+                       volume.texid,        # swapped by TimeSeries
+                       tex_views or 0, self.tex_colormap2d, volume.texid_minmax,
+                       volume.bricks.texid_page_table if volume.bricks is not None else 0, tex_start or 0))
 
-        prog = self.progs["cc6"].prog
         glUseProgram(prog.id)
+        volume.ubo.update()
+        data = self.ubo.data
+        if MV is not None:
+            data['view_MV'] = MV
+            if MVP.tobytes() != self.MVP_inverted:
+                data['view_MVP_inv'] = np.linalg.inv(MVP)
+                self.MVP_inverted = MVP.tobytes()
+        data['level'] = level
+        data['scale_step'] = self.scale_step
+        data['scale_delta'] = self.scale_delta
+        data['tolerance'] = self.tolerance
+        data['intersection'] = self.intersections.index(self.intersection)
+        data['skip_empty'] = self.skip_empty
+        data['analytic_bbox'] = analytic_bbox
+        data['debug_cost'] = self.debug_cost
+        data['scale_k'] = self.scale_k
+        data['temporal'] = tex_start is not None
+        data['temporal_margin'] = self.temporal_margin
+        data['num_levels'] = 0
+        if levels is not None:
+            levels = sorted(levels, key=lambda l: l[0])[:self.max_levels]
+            data['num_levels'] = len(levels)
+            data['opacity_max'] = self.opacity_max
+            data['levels'][:len(levels), 0] = [l for l, color in levels]
+            data['level_colors'][:len(levels)] = [color for l, color in levels]
+        self.ubo.update()
+
+    def render_shade(self, gbuffer, MV):
+        """ Shades the G-buffer into the bound framebuffer (same viewport as the raycast)."""
+        glClearColor(0, 0, 0, 0)
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        bind_textures(self.texture_targets[:5], (gbuffer.buf_position, gbuffer.buf_normal, 0, 0, self.tex_colormap2d))
 
-        glUniform1i(prog.uniform_locs['tex_back'], 0)   
-        glUniform1i(prog.uniform_locs['tex_front'], 1) 
-        glUniform1i(prog.uniform_locs['tex_volume'], 2)
-        glUniform1i(prog.uniform_locs['tex_colormap_2d'], 4)
-        glUniform1f(prog.uniform_locs['level'], level)
-        glUniform3f(prog.uniform_locs['scale_norm'], volume.scale_norm[0], volume.scale_norm[1], volume.scale_norm[2])
-        glUniform3f(prog.uniform_locs['offset_norm'], volume.offset_norm[0], volume.offset_norm[1], volume.offset_norm[2])
-        glUniform3f(prog.uniform_locs['scale_lattice'], volume.scale_lattice[0], volume.scale_lattice[1], volume.scale_lattice[2])
-        glUniform3f(prog.uniform_locs['offset_lattice'], volume.offset_lattice[0], volume.offset_lattice[1], volume.offset_lattice[2])
-        glUniform3f(prog.uniform_locs['dim'], volume.info.dim[0], volume.info.dim[1], volume.info.dim[2])
-        glUniform1f(prog.uniform_locs['dim_max'], volume.dim_max)
+        prog = self.program_shade()
+        glUseProgram(prog.id)
         glUniformMatrix4fv(prog.uniform_locs['MV'], 1, GL_FALSE, MV)
-        glUniform1f(prog.uniform_locs['scale_step'], self.scale_step)
-        glUniform1f(prog.uniform_locs['scale_delta'], self.scale_delta)
+        glUniform1f(prog.uniform_locs['scale_k'], self.scale_k)
 
         glBindVertexArray(self.vao)
         glDrawArrays(GL_TRIANGLE_FAN, 0, 4)
         glBindVertexArray(0)
 
-    def init_colormap(self):
-# colormap for principal curvatures courtesy of 
-# G. Kindlmann, R. Whitaker, T. Tasdizen, T. Möller, 
-# "Curvature-based transfer functions for direct volume rendering: Methods and applications"
-# in Proceedings of IEEE Visualization 2003, 2003, pp. 513–520. 
-# https://dx.doi.org/10.1109/VISUAL.2003.1250414
-        colormap2d = np.array([[1,0,0], [1,1,0], [0,1,0],
-                                [.5,.5,.5], [.5,.5,.5], [0,1,1],
-                                [.5,.5,.5], [.5,.5,.5], [0,0,1]], dtype=np.float32)
+    def render_reproject(self, gbuffer, width, height, volume, MVP):
+        """ Scatters the hits in the width x height viewport of the previous frame's G-buffer into
+        the bound framebuffer with MVP, keeping the nearest (depth test) per pixel."""
+        glClearColor(0, 0, 0, 0)
+        glClearDepth(1)
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        glDepthFunc(GL_LESS)
+        bind_textures(self.texture_targets[:2], (gbuffer.buf_position, gbuffer.buf_normal))
+
+        prog = self.progs['reproject'].prog
+        glUseProgram(prog.id)
+        volume.ubo.update()
+        glUniform1i(prog.uniform_locs['width'], width)
+        glUniformMatrix4fv(prog.uniform_locs['MVP'], 1, GL_FALSE, MVP)
+
+        glBindVertexArray(self.vao)     # no attributes are read, but core profile needs a VAO
+        glDrawArrays(GL_POINTS, 0, width*height)
+        glBindVertexArray(0)
 
+    def init_colormap(self):
+        # principal curvature colormap of Kindlmann et al. (COLORMAP_CURVATURE of cc6_view.py)
         self.tex_colormap2d = glGenTextures(1)
         glBindTexture(GL_TEXTURE_2D, self.tex_colormap2d)
         glPixelStorei(GL_UNPACK_ALIGNMENT,1)
@@ -280,24 +873,117 @@ class QuadFull:
         glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
         glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
 
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, 3, 3, 0, GL_RGB, GL_FLOAT, colormap2d)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, 3, 3, 0, GL_RGB, GL_FLOAT, COLORMAP_CURVATURE)
 
 
+def bind_textures(targets, textures):
+    """ Binds the textures (0: none) to the texture units 0, 1, ..., with a single call where
+    glBindTextures (GL 4.4) is available."""
+    if bool(glBindTextures):
+        glBindTextures(0, len(textures), np.array(textures, np.uint32))
+        return
+    for unit, (target, texture) in enumerate(zip(targets, textures)):
+        if texture:
+            glActiveTexture(GL_TEXTURE0 + unit)
+            glBindTexture(target, texture)
+
 #############################################################################################################
 class Program:
-    def __init__(self, filename_vert, filename_frag, uniforms):
+    """ Shader program built from source files and a dict of defines (name -> value,
+    None for a plain #define). Linked programs are saved with glGetProgramBinary
+    in path_binaries, keyed by the sources, the defines and the driver, and later
+    loaded from there instead of being compiled."""
+
+    path_binaries = os.path.join(path_cache(), 'programs')     # None always compiles
+    variants = {}   # (filename_vert, filename_frag, defines) -> Program
+
+    def __init__(self, filename_vert, filename_frag, uniforms, defines=None, samplers=None):
         self.path = './'
         self.filename_vert = filename_vert
         self.filename_frag = filename_frag
+        self.defines = dict(defines or {})
         src_vert = self.load_source(filename_vert)
         src_frag = self.load_source(filename_frag)
-        self.id = self.build(src_vert, src_frag, uniforms)
+        self.id = self.load_binary(src_vert, src_frag)
+        if self.id is None:
+            self.id = self.build(src_vert, src_frag)
+            self.save_binary()
+        self.uniform_locs = {}
+        for u in uniforms:
+            self.uniform_locs[u] = glGetUniformLocation(self.id, u)
+        # uniform blocks and samplers (name -> texture unit) are set once
+        for name, binding in UniformBuffer.bindings.items():
+            index = glGetUniformBlockIndex(self.id, name)
+            if index != GL_INVALID_INDEX:
+                glUniformBlockBinding(self.id, index, binding)
+        if samplers:
+            glUseProgram(self.id)
+            for name, unit in samplers.items():
+                glUniform1i(glGetUniformLocation(self.id, name), unit)
+            glUseProgram(0)
+
+    @classmethod
+    def variant(cls, filename_vert, filename_frag, uniforms, defines=None, samplers=None):
+        """ The program with defines, built once and then taken from Program.variants."""
+        key = (filename_vert, filename_frag, tuple(sorted((defines or {}).items())))
+        if key not in cls.variants:
+            cls.variants[key] = cls(filename_vert, filename_frag, uniforms, defines, samplers)
+        return cls.variants[key]
 
     def load_source(self, filename):
         # If the shader source is composed of several files, merge them.
         src = open(self.path + filename, 'r').read()
+        src = re.sub(r'^#include\s+"(.+)"[ \t]*$', lambda m: open(self.path + m.group(1), 'r').read(), src, flags=re.M)
+        if self.defines:
+            # the defines go right after the #version line
+            lines = src.split('\n')
+            i = next((k+1 for k, line in enumerate(lines) if line.startswith('#version')), 0)
+            lines[i:i] = [f'#define {name} {"" if value is None else value}'.rstrip() for name, value in sorted(self.defines.items())]
+            src = '\n'.join(lines)
         return src
 
+    def binary_filename(self, src_vert, src_frag):
+        if self.path_binaries is None or not OpenGL.raw.GL.VERSION.GL_4_1.glProgramBinary \
+                or glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS) == 0:
+            return None
+        key = hashlib.blake2b(digest_size=16)
+        for s in (glGetString(GL_VENDOR), glGetString(GL_RENDERER), glGetString(GL_VERSION),
+                  repr(sorted(self.defines.items())).encode(), src_vert.encode(), src_frag.encode()):
+            key.update(s + b'\0')
+        return os.path.join(self.path_binaries, key.hexdigest() + '.bin')
+
+    def load_binary(self, src_vert, src_frag):
+        """ The program linked from a saved binary, None if there is none or the driver rejects it."""
+        self.filename_binary = self.binary_filename(src_vert, src_frag)
+        if self.filename_binary is None or not os.path.exists(self.filename_binary):
+            return None
+        data = open(self.filename_binary, 'rb').read()
+        format = int.from_bytes(data[:4], 'little')
+        program = glCreateProgram()
+        OpenGL.raw.GL.VERSION.GL_4_1.glProgramBinary(program, format, data[4:], len(data) - 4)
+        if not glGetProgramiv(program, GL_LINK_STATUS):
+            # e.g. a driver update: compile again
+            glDeleteProgram(program)
+            return None
+        return program
+
+    def save_binary(self):
+        if self.filename_binary is None:
+            return
+        size = glGetProgramiv(self.id, GL_PROGRAM_BINARY_LENGTH)
+        if size == 0:
+            return
+        binary = (ctypes.c_ubyte*size)()
+        format = ctypes.c_uint()
+        length = ctypes.c_int()
+        OpenGL.raw.GL.VERSION.GL_4_1.glGetProgramBinary(self.id, size, ctypes.byref(length), ctypes.byref(format), binary)
+        os.makedirs(self.path_binaries, exist_ok=True)
+        filename_tmp = f'{self.filename_binary}.{os.getpid()}.tmp'
+        with open(filename_tmp, 'wb') as f:
+            f.write(format.value.to_bytes(4, 'little'))
+            f.write(bytes(binary)[:length.value])
+        os.replace(filename_tmp, self.filename_binary)
+
     def compile(self, src, type):
             
         id = glCreateShader(type)
@@ -318,7 +1004,7 @@ class Program:
                 )
         return id
 
-    def build(self, src_vert, src_frag, uniforms):
+    def build(self, src_vert, src_frag):
         try:
             id_vert = self.compile(src_vert, GL_VERTEX_SHADER)
         except RuntimeError as err:
@@ -335,6 +1021,8 @@ class Program:
     
         glAttachShader(program, id_vert)
         glAttachShader(program, id_frag)
+        if glProgramParameteri:
+            glProgramParameteri(program, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
         glLinkProgram(program)
         status = glGetProgramiv(program, GL_LINK_STATUS)
         if not status:
@@ -344,17 +1032,70 @@ class Program:
             glDeleteShader(id_frag)
             print(infoLog)
             raise RuntimeError("Error linking program:\n%s\n", infoLog)
-
-        self.uniform_locs = {}
-        for u in uniforms:
-            self.uniform_locs[u] = glGetUniformLocation(program, u)
+        glDetachShader(program, id_vert)
+        glDetachShader(program, id_frag)
+        glDeleteShader(id_vert)
+        glDeleteShader(id_frag)
         return program
 
+#############################################################################################################
+def std140_dtype(fields):
+    """ NumPy structured dtype with the std140 layout of a uniform block declaring the
+    fields, (name, GLSL type) or (name, GLSL type, array length), in this order. Arrays
+    (of scalars and vec4) have a vec4 stride: their field has shape (length, 4)."""
+    types = {'float': ('<f4', 4, ()), 'int': ('<i4', 4, ()), 'bool': ('<i4', 4, ()),
+             'vec2': ('<f4', 8, (2,)), 'vec3': ('<f4', 16, (3,)), 'vec4': ('<f4', 16, (4,)), 'mat4': ('<f4', 16, (4, 4))}
+    names, formats, offsets = [], [], []
+    offset = 0
+    for name, type, *length in fields:
+        base, align, shape = types[type]
+        if length:
+            align, shape = 16, (length[0], 4)
+        offset = -(-offset//align)*align
+        names.append(name)
+        formats.append((base, shape))
+        offsets.append(offset)
+        offset += np.dtype((base, shape)).itemsize
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': -(-offset//16)*16})
+
+class UniformBuffer:
+    """ Uniform buffer object of a std140 block, filled from the NumPy structured array
+    data: set its fields, then update() binds the buffer to the binding point of the
+    block and copies data into it only if it changed since the last update."""
+
+    bindings = {'Volume': 0, 'Frame': 1, 'BBox': 2}     # block name -> binding point, set by Program
+    bound = {}          # binding point -> buffer id
+
+    def __init__(self, name, fields):
+        self.binding = self.bindings[name]
+        self.data = np.zeros((), std140_dtype(fields))
+        self.uploaded = None
+        self.id = glGenBuffers(1)
+        glBindBuffer(GL_UNIFORM_BUFFER, self.id)
+        glBufferData(GL_UNIFORM_BUFFER, self.data.nbytes, None, GL_DYNAMIC_DRAW)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+
+    def update(self):
+        if self.bound.get(self.binding) != self.id:
+            glBindBufferBase(GL_UNIFORM_BUFFER, self.binding, self.id)
+            self.bound[self.binding] = self.id
+        data = self.data.tobytes()
+        if data != self.uploaded:
+            glBindBuffer(GL_UNIFORM_BUFFER, self.id)
+            glBufferSubData(GL_UNIFORM_BUFFER, 0, len(data), data)
+            glBindBuffer(GL_UNIFORM_BUFFER, 0)
+            self.uploaded = data
+
+    def delete(self):
+        glDeleteBuffers(1, [self.id])
+        if self.bound.get(self.binding) == self.id:
+            del self.bound[self.binding]
+
 #############################################################################################################
 class Scene:    
-    """ OpenGL 3D scene class"""
+    """ OpenGL 3D scene class. packed selects the lattice layout of its Volume (default: Volume.packed)."""
 
-    def __init__(self, width, height):
+    def __init__(self, width, height, info, packed=None):
 
         self.platform = platform.system()
         self.width = width
@@ -366,26 +1107,323 @@ class Scene:
         self.position_x = 0
         self.position_y = 0
 
-        self.volume = Volume(volumes[sys.argv[1]], (width,height))
+        self.volume = Volume(info, packed)
         self.quad_full = QuadFull(self.volume, (width,height))
+        self.MVP = None
         self.refresh_MVP()
-        self.texid = [self.volume.bbox.fbo.buf_front, self.volume.bbox.fbo.buf_back]
-        self.level = volumes[sys.argv[1]].level
+        self.level = info.level
+        self.levels = None          # [(isolevel, (r, g, b, opacity)), ...] to composite instead of level
+        self.fbo_lowres = None
+        self.fbo_cost = None
+        self.gbuffer = None
+        self.gbuffer_key = None     # raycast_key() of the G-buffer contents
+        self.gbuffer_full = False   # the G-buffer was marched in full (not from reprojected starts)
+        self.fbo_start = None       # previous hits reprojected into the view (temporal ray-start reuse)
+        self.fbo_views = None       # atlas of render_views
+        self.tex_views = None
+        self.timers = GPUTimers()
+
+    def camera(self, pose={}, aspect=None):
+        """ glm P and MV of the camera, with the camera keys in pose instead of the attributes."""
+        get = lambda key: pose.get(key, getattr(self, key))
+        return camera_matrices(get('view_angle'), aspect or self.width/self.height, get('angle_x'), get('angle_y'),
+                               get('position_x'), get('position_y'))
+
+    def pose_matrices(self, poses, width, height):
+        """ (n, 4, 4) arrays of the MV and P of the poses at width x height, as Scene.MV (see render_views)."""
+        cameras = [self.camera(pose, width/height) for pose in poses]
+        return (np.array([glm.transpose(MV) for P, MV in cameras], np.float32),
+                np.array([glm.transpose(P) for P, MV in cameras], np.float32))
 
     def refresh_MVP(self):
-        self.P = glm.perspective(glm.radians(self.view_angle), self.width/self.height, 1, 3)
-        self.MV = glm.translate(glm.mat4(), glm.vec3(self.position_x, self.position_y, -2))
-        self.MV = glm.rotate(self.MV, glm.radians(self.angle_x), glm.vec3(1,0,0))
-        self.MV = glm.rotate(self.MV, glm.radians(self.angle_y), glm.vec3(0,1,0))
-        self.MVP = np.array(glm.transpose(self.P * self.MV))
+        self.P, self.MV = self.camera()
+        MVP = np.array(glm.transpose(self.P * self.MV))
         self.MV = np.array(glm.transpose(self.MV))
+        # the bbox entry/exit textures only depend on MVP
+        if self.MVP is None or not np.array_equal(MVP, self.MVP):
+            self.bbox_dirty = True
+        self.MVP = MVP
+
+    def view_key(self):
+        """ Everything the raycast depends on (but the bricks streamed in)."""
+        q = self.quad_full
+        defines = tuple(sorted((name, value) for name, value in q.defines.items() if name not in q.shading_defines))
+        levels = self.levels and tuple((level, tuple(color)) for level, color in self.levels)
+        return (self.MVP.tobytes(), self.level, levels, q.opacity_max, self.width, self.height, self.volume.texid,
+                q.scale_step, q.scale_delta, q.tolerance, q.intersection, q.skip_empty, defines, q.analytic_bbox)
+
+    def frame_key(self):
+        """ Everything a rendered frame depends on: equal keys give equal frames."""
+        return self.view_key() + (self.quad_full.deferred,) + self.quad_full.shading_key()
+
+    def raycast_key(self, downscale):
+        bricks = self.volume.bricks
+        return self.view_key() + (downscale, bricks.version if bricks is not None else None)
+
+    def resize(self, width, height):
+        self.width = width
+        self.height = height
+        self.refresh_MVP()
+
+    def set_pose(self, pose):
+        """ Applies a camera pose, a dict with any of the keys in Scene.pose_keys."""
+        for key in self.pose_keys:
+            if key in pose:
+                setattr(self, key, pose[key])
+        if 'timestep' in pose and self.volume.series is not None:
+            self.volume.series.seek(pose['timestep'] % len(self.volume.series.timesteps))
+        self.refresh_MVP()
+
+    pose_keys = ('view_angle', 'angle_x', 'angle_y', 'position_x', 'position_y', 'level', 'levels', 'timestep')
+    camera_keys = pose_keys[:5]
+
+    def render(self, fbo=0, downscale=1):
+        self.prepare()
+        if downscale > 1:
+            self.render_lowres(fbo, downscale)
+        else:
+            glBindFramebuffer(GL_FRAMEBUFFER, fbo)
+            glViewport(0, 0, self.width, self.height)
+            self.render_view(fbo, downscale)
+        self.timers.end_frame(downscale=downscale)
+
+    def render_view(self, fbo, downscale):
+        # into the bound fbo and viewport: a raycast, or a raycast into the G-buffer (unless it
+        # still holds this view) and the shading pass; several isosurfaces and slabs are always forward
+        if not self.quad_full.deferred or self.levels or self.volume.slab is not None:
+            with self.timers.measure('raycast'):
+                self.quad_full.render_raycast(self.level, self.volume, self.MV, self.MVP, levels=self.levels or None)
+            return
+        if self.gbuffer is None or (self.gbuffer.width, self.gbuffer.height) != (self.width, self.height):
+            if self.gbuffer is not None:
+                self.gbuffer.delete()
+                self.fbo_start.delete()
+            self.gbuffer = FBO_gbuffer(self.width, self.height)
+            self.fbo_start = FBO_render(self.width, self.height, GL_RGBA32F)
+            self.gbuffer_key = None
+        key = self.raycast_key(downscale)
+        if key != self.gbuffer_key:
+            # the G-buffer holds the previous frame of the same scene seen from another camera; only
+            # fully marched frames are reprojected, so the errors of a temporal frame do not accumulate
+            tex_start = None
+            if (self.quad_full.temporal and self.gbuffer_full and self.gbuffer_key is not None
+                    and self.gbuffer_key[1:] == key[1:]):
+                width, height = glGetIntegerv(GL_VIEWPORT)[2:]
+                glBindFramebuffer(GL_FRAMEBUFFER, self.fbo_start.fbo)
+                with self.timers.measure('reproject'):
+                    self.quad_full.render_reproject(self.gbuffer, width, height, self.volume, self.MVP)
+                tex_start = self.fbo_start.buf_color
+            glBindFramebuffer(GL_FRAMEBUFFER, self.gbuffer.fbo)
+            with self.timers.measure('raycast'):
+                self.quad_full.render_raycast(self.level, self.volume, self.MV, self.MVP, gbuffer=True, tex_start=tex_start)
+            self.gbuffer_key = key
+            self.gbuffer_full = tex_start is None
+            glBindFramebuffer(GL_FRAMEBUFFER, fbo)
+        with self.timers.measure('shade'):
+            self.quad_full.render_shade(self.gbuffer, self.MV)
+
+    def prepare(self):
+        # passes the raycast depends on: bbox entry/exit textures and resident bricks
+        if not self.quad_full.analytic_bbox:
+            if self.volume.bbox.resize(self.width, self.height):
+                self.bbox_dirty = True
+            if self.bbox_dirty:
+                with self.timers.measure('bbox'):
+                    self.volume.bbox.render_bbox(self.MVP)
+                self.bbox_dirty = False
+        if self.volume.bricks is not None:
+            self.volume.bricks.update(self.MVP, [level for level, color in self.levels] if self.levels else self.level)
+
+    def render_views(self, MV, P, width, height, size_atlas=4096):
+        """ Renders the views of the (n, 4, 4) arrays MV and P (transposed as Scene.MV, e.g. from
+        pose_matrices) at width x height and returns them as an (n, height, width, 4) uint8 array,
+        top row first. The views are raycast with one instanced draw per atlas of up to
+        size_atlas^2 pixels and each atlas is read back at once. Forward shading and the
+        analytic bbox; the isolevel(s) and volume are those of the scene."""
+        if self.volume.bricks is not None:
+            raise RuntimeError('render_views does not support the brick cache')
+        MV = np.asarray(MV, np.float32).reshape(-1, 4, 4)
+        P = np.asarray(P, np.float32).reshape(-1, 4, 4)
+        # per view: the columns of MV and of the inverse MVP (rows of the transposed matrices)
+        views = np.concatenate([MV, np.linalg.inv(MV @ P)], axis=1).astype(np.float32)
+        columns = max(1, min(len(views), size_atlas//width))
+        rows_max = max(1, size_atlas//height)
+        rows = min(rows_max, -(-len(views)//columns))
+        if self.fbo_views is None or (self.fbo_views.width, self.fbo_views.height) != (columns*width, rows*height):
+            if self.fbo_views is not None:
+                self.fbo_views.delete()
+            self.fbo_views = FBO_render(columns*width, rows*height)
+        if self.tex_views is None:
+            self.tex_views = glGenTextures(1)
+            glBindTexture(GL_TEXTURE_2D, self.tex_views)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+
+        self.prepare()
+        images = np.empty((len(views), height, width, 4), np.uint8)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo_views.fbo)
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        for first in range(0, len(views), columns*rows_max):
+            chunk = views[first:first + columns*rows_max]
+            rows = -(-len(chunk)//columns)
+            glBindTexture(GL_TEXTURE_2D, self.tex_views)
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA32F, 8, len(chunk), 0, GL_RGBA, GL_FLOAT, chunk)
+            glViewport(0, 0, columns*width, rows*height)
+            with self.timers.measure('raycast'):
+                self.quad_full.render_raycast_views(self.level, self.volume, self.tex_views, len(chunk), columns, rows,
+                                                    levels=self.levels or None)
+            atlas = np.frombuffer(glReadPixels(0, 0, columns*width, rows*height, GL_RGBA, GL_UNSIGNED_BYTE), np.uint8)
+            atlas = atlas.reshape(rows, height, columns, width, 4).transpose(0, 2, 1, 3, 4).reshape(-1, height, width, 4)
+            images[first:first + len(chunk)] = atlas[:len(chunk), ::-1]
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        self.timers.end_frame(views=len(views))
+        return images
+
+    def render_cost(self):
+        """ Raycasts the current view with the cost output of the shader and returns a float32
+        (height, width, 4) array of (march iterations, EVALs, hit, ray in bbox) per pixel
+        (hit: the number of isosurfaces composited with Scene.levels)."""
+        if self.fbo_cost is None or (self.fbo_cost.width, self.fbo_cost.height) != (self.width, self.height):
+            if self.fbo_cost is not None:
+                self.fbo_cost.delete()
+            self.fbo_cost = FBO_render(self.width, self.height, GL_RGBA32F)
+        self.prepare()
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo_cost.fbo)
+        glViewport(0, 0, self.width, self.height)
+        self.quad_full.debug_cost = True
+        self.quad_full.render_raycast(self.level, self.volume, self.MV, self.MVP, levels=self.levels or None)
+        self.quad_full.debug_cost = False
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        cost = glReadPixels(0, 0, self.width, self.height, GL_RGBA, GL_FLOAT)
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        return np.frombuffer(cost, np.float32).reshape(self.height, self.width, 4)[::-1]
+
+    def render_lowres(self, fbo, downscale):
+        """ Raycasts into the lower-left 1/downscale of an offscreen buffer and upsamples it into fbo."""
+        if self.fbo_lowres is None or (self.fbo_lowres.width, self.fbo_lowres.height) != (self.width, self.height):
+            if self.fbo_lowres is not None:
+                self.fbo_lowres.delete()
+            self.fbo_lowres = FBO_render(self.width, self.height)
+        width = max(1, int(self.width/downscale))
+        height = max(1, int(self.height/downscale))
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo_lowres.fbo)
+        glViewport(0, 0, width, height)
+        self.render_view(self.fbo_lowres.fbo, downscale)
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, self.fbo_lowres.fbo)
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, fbo)
+        glBlitFramebuffer(0, 0, width, height, 0, 0, self.width, self.height, GL_COLOR_BUFFER_BIT, GL_LINEAR)
+        glBindFramebuffer(GL_FRAMEBUFFER, fbo)
+        glViewport(0, 0, self.width, self.height)
+#############################################################################################################
+class GPUTimers:
+    """ GL_TIME_ELAPSED queries around the render passes of each frame.
+    A frame's results are read once GL_QUERY_RESULT_AVAILABLE says so, a few
+    frames later, so measuring never stalls the pipeline. Each frame gives a
+    record {'frame': i, '<pass>_ms': ...}, kept in records and written as a
+    JSON line to log if set; a pass whose result is bogus is None."""
+
+    def __init__(self, log=None):
+        self.enabled = False
+        self.log = log
+        self.records = []
+        self.index = 0              # frame being rendered
+        self.queries = []           # (pass, query) of that frame
+        self.pending = collections.deque()  # (record, queries) waiting for their results
+        self.free = []
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        if not self.enabled:
+            yield
+            return
+        query = self.free.pop() if self.free else int(glGenQueries(1)[0])
+        glBeginQuery(GL_TIME_ELAPSED, query)
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            glEndQuery(GL_TIME_ELAPSED)
+            self.queries.append((name, query, t))
+
+    def end_frame(self, **fields):
+        """ Closes the frame; fields (e.g. downscale) are added to its record."""
+        if self.queries:
+            self.pending.append((dict(frame=self.index, **fields), self.queries))
+            self.queries = []
+        self.index += 1
+        self.collect()
+
+    def collect(self, wait=False):
+        """ Reads the results that are available (all of them if wait), oldest first."""
+        while self.pending:
+            record, queries = self.pending[0]
+            if not wait and not glGetQueryObjectiv(queries[-1][1], GL_QUERY_RESULT_AVAILABLE):
+                break
+            self.pending.popleft()
+            elapsed = ctypes.c_uint64()
+            for name, query, t in queries:
+                key = name + '_ms'
+                # the wrapped glGetQueryObjectui64v has no array type for GLuint64
+                OpenGL.raw.GL.VERSION.GL_3_3.glGetQueryObjectui64v(query, GL_QUERY_RESULT, ctypes.pointer(elapsed))
+                self.free.append(query)
+                # llvmpipe reports a bogus first result: a pass cannot take longer than it has been running
+                if elapsed.value*1e-9 > time.perf_counter() - t or record.get(key, 0) is None:
+                    record[key] = None
+                else:
+                    record[key] = record.get(key, 0) + elapsed.value*1e-6
+            self.add(record)
+
+    def add(self, record):
+        self.records.append(record)
+        if self.log is not None:
+            self.log.write(json.dumps(record) + '\n')
+            self.log.flush()
+
+    def stats(self, records=None):
+        """ {'<pass>_ms': {'mean', 'p50', 'p95', 'max', 'dropped'}} over records (all the collected ones by
+        default); dropped counts the bogus results left out."""
+        records = self.records if records is None else records
+        names = sorted({key for r in records for key in r if key.endswith('_ms')})
+        stats = {}
+        for name in names:
+            dropped = sum(1 for r in records if name in r and r[name] is None)
+            times = np.array([r[name] for r in records if r.get(name) is not None])
+            if times.size == 0:
+                stats[name] = {'dropped': dropped}
+                continue
+            stats[name] = {'mean': float(times.mean()), 'p50': float(np.percentile(times, 50)),
+                           'p95': float(np.percentile(times, 95)), 'max': float(times.max()), 'dropped': dropped}
+        return stats
+
+def cost_stats(cost):
+    """ Summary of Scene.render_cost() over the rays entering the volume."""
+    rays = cost[..., 3] > 0
+    stats = {'rays': int(rays.sum()), 'hits': int((cost[..., 2] > 0).sum())}
+    for i, name in enumerate(('iterations', 'evals')):
+        values = cost[..., i][rays]
+        if values.size == 0:
+            continue
+        stats[name] = {'mean': float(values.mean()), 'p50': float(np.percentile(values, 50)),
+                       'p95': float(np.percentile(values, 95)), 'p99': float(np.percentile(values, 99)),
+                       'max': float(values.max()), 'total': float(values.sum())}
+    return stats
+
+def save_cost_heatmaps(cost, name):
+    """ Writes name_iterations.png and name_evals.png, black outside the volume."""
+    rays = cost[..., 3] > 0
+    for i, key in enumerate(('iterations', 'evals')):
+        values = np.where(rays, cost[..., i], np.nan)
+        vmax = max(float(np.nanmax(values)), 1) if rays.any() else 1
+        img = pylab.cm.inferno(np.nan_to_num(values/vmax))
+        img[~rays] = (0, 0, 0, 1)
+        pylab.imsave(f'{name}_{key}.png', img)
 
-    def render(self):
-        self.volume.bbox.render_bbox(self.MVP)
-        self.quad_full.render_raycast(self.level, self.volume, self.MV) 
 #############################################################################################################
 class RenderWindow:
-    def __init__(self):
+    def __init__(self, info):
+        # only the window needs GLFW (https://github.com/FlorianRhiem/pyGLFW): headless rendering runs without libglfw
+        global glfw
+        import glfw
         cwd = os.getcwd() # save current working directory
         glfw.init() # initialize glfw - this changes cwd
         os.chdir(cwd) # restore cwd
@@ -418,10 +1456,24 @@ class RenderWindow:
 
         # set window callbacks
         glfw.set_key_callback(self.win, self.onKeyboard)
-        glfw.set_window_size_callback(self.win, self.onSize)        
+        glfw.set_framebuffer_size_callback(self.win, self.onSize)
+        glfw.set_window_refresh_callback(self.win, self.onRefresh)
 
         # create 3D
-        self.scene = Scene(self.fb_width, self.fb_height)
+        self.scene = Scene(self.fb_width, self.fb_height, info)
+
+        # progressive rendering: reduced resolution while the view changes
+        self.downscale_max = 4      # largest downscale factor (1 disables progressive rendering)
+        self.idle_delay = 0.25      # seconds without input before refining to full resolution
+        self.frame_time = 1/30      # target frame time while the view changes
+        self.downscale = 2
+        self.time_input = -self.idle_delay
+
+        # the last frame is kept offscreen and reused while nothing changes
+        self.fbo_frame = None
+        self.frame_key = None
+        self.frame_downscale = 1
+        self.damaged = True
 
         # exit flag
         self.exitNow = False
@@ -438,6 +1490,7 @@ class RenderWindow:
 
 
         if action == glfw.PRESS:
+            self.time_input = glfw.get_time()
             # ESC to quit
             if key == glfw.KEY_ESCAPE: 
                 self.exitNow = True
@@ -499,6 +1552,35 @@ class RenderWindow:
                 else:
                     self.scene.level = self.scene.level - set_step_level(mods)
                 print(self.scene.level)
+            # E: toggle empty-space skipping
+            elif key == glfw.KEY_E:
+                self.scene.quad_full.skip_empty = not self.scene.quad_full.skip_empty
+                print(f'empty-space skipping: {self.scene.quad_full.skip_empty}')
+            # I: cycle through the intersection refinement methods
+            elif key == glfw.KEY_I:
+                quad_full = self.scene.quad_full
+                quad_full.intersection = quad_full.intersections[(quad_full.intersections.index(quad_full.intersection)+1) % len(quad_full.intersections)]
+                print(f'intersection: {quad_full.intersection}')
+            # SPACE: play/pause a time series, .: step to the next timestep
+            elif key == glfw.KEY_SPACE and self.scene.volume.series is not None:
+                self.scene.volume.series.playing = not self.scene.volume.series.playing
+            elif key == glfw.KEY_PERIOD and self.scene.volume.series is not None:
+                self.scene.volume.series.steps += 1
+            # L: toggle Blinn-Phong lighting (a shader variant)
+            elif key == glfw.KEY_L:
+                defines = self.scene.quad_full.defines
+                if defines.pop('SHADING_BLINN_PHONG', None) is None:
+                    defines['SHADING_BLINN_PHONG'] = 0
+                print(f'shader defines: {defines}')
+            # [ and ]: scale of the curvature colormap (reshades the G-buffer without raycasting)
+            elif key in (glfw.KEY_LEFT_BRACKET, glfw.KEY_RIGHT_BRACKET):
+                self.scene.quad_full.scale_k *= 1.25 if key == glfw.KEY_RIGHT_BRACKET else 1/1.25
+                print(f'scale_k: {self.scene.quad_full.scale_k}')
+            # C: write the per-pixel cost heatmaps of the current view
+            elif key == glfw.KEY_C:
+                cost = self.scene.render_cost()
+                save_cost_heatmaps(cost, 'cost')
+                print(f'cost_iterations.png, cost_evals.png: {json.dumps(cost_stats(cost))}')
             # PgUp: zoom in
             elif key == glfw.KEY_PAGE_UP:
                 self.scene.view_angle = self.scene.view_angle - 1
@@ -508,41 +1590,385 @@ class RenderWindow:
                 self.scene.view_angle = self.scene.view_angle + 1
                 self.scene.refresh_MVP()
         
+    def adapt_downscale(self, elapsed):
+        """ Moves the downscale factor toward the one meeting the target frame time (cost ~ pixel count)."""
+        target = self.downscale*np.sqrt(elapsed/self.frame_time)
+        self.downscale = float(np.clip(.5*(self.downscale + target), 1, self.downscale_max))
+
     def onSize(self, win, width, height):
+        # framebuffer size, in pixels also on retina displays
+        if width == 0 or height == 0:
+            return
         self.aspect = width/float(height)
-        self.scene.width = width
-        self.scene.height = height
+        self.fb_width, self.fb_height = width, height
+        self.scene.resize(width, height)
+
+    def onRefresh(self, win):
+        self.damaged = True
+
+    def render_frame(self, downscale):
+        """ Renders the scene into the offscreen frame and returns the render time."""
+        if self.fbo_frame is None or (self.fbo_frame.width, self.fbo_frame.height) != (self.scene.width, self.scene.height):
+            if self.fbo_frame is not None:
+                self.fbo_frame.delete()
+            self.fbo_frame = FBO_render(self.scene.width, self.scene.height)
+        t = glfw.get_time()
+        self.scene.render(self.fbo_frame.fbo, downscale)
+        glFinish()
+        return glfw.get_time() - t
+
+    def present(self):
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, self.fbo_frame.fbo)
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, 0)
+        glBlitFramebuffer(0, 0, self.fbo_frame.width, self.fbo_frame.height,
+                          0, 0, self.fbo_frame.width, self.fbo_frame.height, GL_COLOR_BUFFER_BIT, GL_NEAREST)
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        glfw.swap_buffers(self.win)
 
     def run(self):
         glfw.set_time(0)
         glClearColor(1,1,1,1)
-        lastT = glfw.get_time()
+        time_render = 0     # wall-clock time of the rendered frames (render_frame waits for them)
         frames = 0
+        timers = self.scene.timers
         while not glfw.window_should_close(self.win) and not self.exitNow:
-            currT = glfw.get_time()
             if frames == 20:
-                elapsed = currT - lastT
-                print('fps = {}'.format(frames/elapsed))
-                lastT = currT
+                # GPU time of the passes next to it, with --profile
+                gpu = ', '.join(f'{name[:-3]} {stat["mean"]:.2f} ms' for name, stat in timers.stats(timers.records[-frames:]).items() if 'mean' in stat)
+                print('fps = {}'.format(frames/time_render) + (f' (GPU: {gpu})' if gpu else ''))
+                time_render = 0
                 frames = 0
-            self.scene.render()
-            frames += 1
-            glfw.swap_buffers(self.win)
-            glfw.poll_events()
+            idle = glfw.get_time() - self.time_input
+            moving = idle < self.idle_delay and self.downscale_max > 1
+            series = self.scene.volume.series
+            if series is not None:
+                series.update()
+            key = self.scene.frame_key()
+            bricks = self.scene.volume.bricks
+            streaming = bricks is not None and bricks.pending > 0
+            # render when the scene changed, refine a reduced frame once the input stopped,
+            # or show the bricks streamed in since the last frame
+            if key != self.frame_key or (self.frame_downscale > 1 and not moving) or streaming:
+                downscale = self.downscale if moving and key != self.frame_key else 1
+                elapsed = self.render_frame(downscale)
+                if downscale > 1:
+                    self.adapt_downscale(elapsed)
+                self.frame_key = key
+                self.frame_downscale = downscale
+                self.damaged = True
+                time_render += elapsed
+                frames += 1
+            if self.damaged:
+                self.present()
+                self.damaged = False
+            # block until input arrives (or the reduced frame is due for refinement)
+            if bricks is not None and bricks.pending > 0 or series is not None and series.busy():
+                glfw.poll_events()
+            elif self.frame_downscale > 1:
+                glfw.wait_events_timeout(max(self.idle_delay - (glfw.get_time() - self.time_input), 0.001))
+            else:
+                glfw.wait_events()
+        timers.collect(wait=True)
         glfw.terminate()
 
+#############################################################################################################
+class HeadlessContext:
+    """ Offscreen OpenGL 3.3 core context without a display (EGL or OSMesa, e.g., Mesa llvmpipe).
+    The platform follows PYOPENGL_PLATFORM, which has to be set before OpenGL is imported."""
+
+    EGL_PLATFORM_SURFACELESS_MESA = 0x31DD
+
+    def __init__(self, width, height):
+        self.platform = os.environ.get('PYOPENGL_PLATFORM', '')
+        if self.platform == 'egl':
+            self.init_egl()
+        elif self.platform == 'osmesa':
+            self.init_osmesa(width, height)
+        else:
+            raise RuntimeError('Headless rendering needs PYOPENGL_PLATFORM=egl or osmesa '
+                               'to be set before OpenGL is imported.')
+        print("OpenGL version = ", glGetString( GL_VERSION ))
+        print("OpenGL renderer = ", glGetString( GL_RENDERER ))
+
+    def init_egl(self):
+        from OpenGL import EGL
+        major, minor = EGL.EGLint(), EGL.EGLint()
+        self.display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        try:
+            EGL.eglInitialize(self.display, ctypes.pointer(major), ctypes.pointer(minor))
+        except EGL.EGLError:
+            # No native display (e.g., no X server): fall back to Mesa's surfaceless platform.
+            self.display = EGL.eglGetPlatformDisplayEXT(self.EGL_PLATFORM_SURFACELESS_MESA, EGL.EGL_DEFAULT_DISPLAY, None)
+            EGL.eglInitialize(self.display, ctypes.pointer(major), ctypes.pointer(minor))
+
+        attribs = [EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT, EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT, EGL.EGL_NONE]
+        config = EGL.EGLConfig()
+        num_configs = EGL.EGLint()
+        EGL.eglChooseConfig(self.display, (EGL.EGLint*len(attribs))(*attribs), ctypes.pointer(config), 1, ctypes.pointer(num_configs))
+        if num_configs.value == 0:
+            raise RuntimeError('eglChooseConfig found no OpenGL config')
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        attribs = [EGL.EGL_CONTEXT_MAJOR_VERSION, 3,
+                   EGL.EGL_CONTEXT_MINOR_VERSION, 3,
+                   EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK, EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT,
+                   EGL.EGL_NONE]
+        self.context = EGL.eglCreateContext(self.display, config, EGL.EGL_NO_CONTEXT, (EGL.EGLint*len(attribs))(*attribs))
+        # Everything is rendered into FBOs, so no surface is needed.
+        EGL.eglMakeCurrent(self.display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, self.context)
+
+    def init_osmesa(self, width, height):
+        from OpenGL import osmesa
+        attribs = [osmesa.OSMESA_FORMAT, osmesa.OSMESA_RGBA,
+                   osmesa.OSMESA_DEPTH_BITS, 24,
+                   osmesa.OSMESA_PROFILE, osmesa.OSMESA_CORE_PROFILE,
+                   osmesa.OSMESA_CONTEXT_MAJOR_VERSION, 3,
+                   osmesa.OSMESA_CONTEXT_MINOR_VERSION, 3,
+                   0]
+        self.context = osmesa.OSMesaCreateContextAttribs(attribs, None)
+        if not self.context:
+            raise RuntimeError('OSMesaCreateContextAttribs failed')
+        # OSMesa always needs a color buffer to be current, although we render into FBOs.
+        self.buffer = np.zeros((height, width, 4), dtype=np.uint8)
+        if not osmesa.OSMesaMakeCurrent(self.context, self.buffer, GL_UNSIGNED_BYTE, width, height):
+            raise RuntimeError('OSMesaMakeCurrent failed')
+
+def write_frame(img, name, formats):
+    for fmt in formats:
+        if fmt == 'png':
+            pylab.imsave(name + '.png', img)
+        elif fmt == 'npy':
+            np.save(name + '.npy', img)
+
+#############################################################################################################
+class FrameReader:
+    """ Asynchronous readback of an FBO through a ring of PBOs.
+    glReadPixels only queues a copy into a PBO; the PBO is mapped a few frames
+    later when the copy is done and the frame is written by a worker thread,
+    so rendering, readback and disk writes overlap."""
+
+    def __init__(self, width, height, num_pbos=3, formats=('png',)):
+        self.width = width
+        self.height = height
+        self.size = width*height*4
+        self.formats = formats
+        self.pbos = glGenBuffers(num_pbos)
+        self.pbos = [self.pbos] if num_pbos == 1 else list(self.pbos)
+        for pbo in self.pbos:
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+            glBufferData(GL_PIXEL_PACK_BUFFER, self.size, None, GL_STREAM_READ)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.fences = [None]*num_pbos
+        self.names = [None]*num_pbos
+        self.index = 0
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        self.writes = []
+
+    def read(self, fbo, name):
+        slot = self.index % len(self.pbos)
+        if self.names[slot] is not None:
+            self.collect(slot)
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, fbo)
+        glReadBuffer(GL_COLOR_ATTACHMENT0)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pbos[slot])
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        glReadPixels(0, 0, self.width, self.height, GL_RGBA, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, 0)
+        self.fences[slot] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self.names[slot] = name
+        self.index += 1
+
+    def collect(self, slot):
+        # By the time a slot is reused the copy has normally finished, so this rarely blocks.
+        glClientWaitSync(self.fences[slot], GL_SYNC_FLUSH_COMMANDS_BIT, 10**10)
+        glDeleteSync(self.fences[slot])
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pbos[slot])
+        ptr = glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, self.size, GL_MAP_READ_BIT)
+        img = np.ctypeslib.as_array((ctypes.c_ubyte*self.size).from_address(ptr)).copy()
+        glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        img = img.reshape(self.height, self.width, 4)[::-1]
+        self.writes.append(self.writer.submit(self.write, img, self.names[slot]))
+        self.fences[slot] = None
+        self.names[slot] = None
+
+    def write(self, img, name):
+        write_frame(img, name, self.formats)
+
+    def finish(self):
+        for i in range(len(self.pbos)):
+            slot = (self.index + i) % len(self.pbos)
+            if self.names[slot] is not None:
+                self.collect(slot)
+        for w in self.writes:
+            w.result()
+        self.writes = []
+
+#############################################################################################################
+class HeadlessRenderer:
+    """ Renders a list of camera poses/isolevels offscreen and writes the frames."""
+
+    def __init__(self, info, width, height):
+        self.width, self.height = width, height
+        self.context = HeadlessContext(width, height)
+        glEnable(GL_DEPTH_TEST)
+        self.scene = Scene(width, height, info)
+        self.fbo = FBO_render(width, height)
+        if self.scene.volume.bricks is not None:
+            self.scene.volume.bricks.max_uploads = None     # every frame is complete
+
+    def render(self, poses, path_out, formats=('png',), cost=False):
+        """ Renders and writes the frames; with cost, also their cost heatmaps and statistics
+        (added to the records of the scene's GPUTimers)."""
+        os.makedirs(path_out, exist_ok=True)
+        reader = FrameReader(self.width, self.height, formats=formats)
+        timers = self.scene.timers
+        t0 = time.time()
+        for i, pose in enumerate(poses):
+            self.scene.set_pose(pose)
+            self.scene.render(self.fbo.fbo)
+            name = os.path.join(path_out, f'frame_{i:05d}')
+            reader.read(self.fbo.fbo, name)
+            if cost:
+                frame_cost = self.scene.render_cost()
+                save_cost_heatmaps(frame_cost, name)
+                timers.add({'frame': timers.index - 1, 'cost': cost_stats(frame_cost)})
+        reader.finish()
+        timers.collect(wait=True)
+        elapsed = time.time() - t0
+        print(f'{len(poses)} frames in {elapsed:.2f}s ({len(poses)/elapsed:.2f} fps)')
+        for name, stat in timers.stats().items():
+            dropped = f' ({stat["dropped"]} bogus results dropped)' if stat['dropped'] else ''
+            if 'mean' in stat:
+                print(f'{name[:-3]}: mean {stat["mean"]:.2f} ms, p95 {stat["p95"]:.2f} ms{dropped}')
+            else:
+                print(f'{name[:-3]}: no valid result{dropped}')
+
+    def render_batch(self, poses, path_out, formats=('png',)):
+        """ Renders the poses with Scene.render_views and writes the frames; the poses may
+        only differ in the camera (Scene.camera_keys)."""
+        others = [{key: value for key, value in pose.items() if key not in Scene.camera_keys} for pose in poses]
+        if any(other != others[0] for other in others):
+            raise ValueError('batched poses may only differ in the camera (' + ', '.join(Scene.camera_keys) + ')')
+        os.makedirs(path_out, exist_ok=True)
+        t0 = time.time()
+        self.scene.set_pose(others[0] if poses else {})
+        MV, P = self.scene.pose_matrices(poses, self.width, self.height)
+        images = self.scene.render_views(MV, P, self.width, self.height)
+        elapsed = time.time() - t0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as writer:
+            for i, img in enumerate(images):
+                writer.submit(write_frame, img, os.path.join(path_out, f'frame_{i:05d}'), formats)
+        print(f'{len(poses)} frames in {elapsed:.2f}s ({len(poses)/elapsed:.2f} fps) rendered, {time.time() - t0:.2f}s written')
+
+def parse_levels(specs, opacity=0.4):
+    """ Scene.levels from 'LEVEL' or 'LEVEL:R,G,B,A' strings, colored along viridis by default."""
+    colors = pylab.cm.viridis(np.linspace(0, 1, len(specs)))
+    levels = []
+    for spec, color in zip(specs, colors):
+        level, _, rgba = spec.partition(':')
+        color = [float(c) for c in rgba.split(',')] if rgba else list(color[:3]) + [opacity]
+        if len(color) != 4:
+            raise ValueError(f'{spec}: the color needs 4 components R,G,B,A')
+        levels.append((float(level), tuple(color)))
+    return levels
+
+def orbit_poses(num_frames, angle_x=320, level=None, timesteps=None):
+    """ Camera poses of a full turn around the y-axis (playing back the timesteps of a series)."""
+    poses = [{'angle_x': angle_x, 'angle_y': 360*i/num_frames} for i in range(num_frames)]
+    for i, pose in enumerate(poses):
+        if level is not None:
+            pose['level'] = level
+        if timesteps is not None:
+            pose['timestep'] = i % timesteps
+    return poses
+
 #############################################################################################################
 # main() function
+def parse_defines(defines):
+    """ {name: value} of NAME[=VALUE] arguments; NAME alone is defined as 1, like -DNAME, so that
+    both #ifdef and #if (e.g. SHADING_BLINN_PHONG in cc6_shading.glsl) see it as set."""
+    return {name: value or '1' for name, _, value in (define.partition('=') for define in defines)}
+
 def main():
-    if len(sys.argv) < 2:
-        print(f"Usage: python raycaster_cc6.py <volume data name>")
-        print(f"\t<voluem data name>: one of {list(volumes.keys())}")
-        exit(-1)
-    if not sys.argv[1] in volumes:
-        print(f"The 1nd argument should be one of {list(volumes.keys())}.")
-        exit(-1)
-
-    rw = RenderWindow()
+    parser = argparse.ArgumentParser(description='GPU raycaster based on the six-direction box-spline (cc6)')
+    parser.add_argument('volume', help='registered dataset (' + ', '.join(volumes) + '), lattice file (.nrrd, .nhdr, .raw with a .json sidecar, .json, .npy) or a directory of timesteps')
+    parser.add_argument('--no-cache', action='store_true', help='do not use the on-disk dataset and shader program cache (CC6_CACHE, ~/.cache/cc6 by default)')
+    parser.add_argument('--define', action='append', default=[], metavar='NAME[=VALUE]', help='compile the raycast shader with this define (e.g. SHADING_BLINN_PHONG=0, NO_PREPROCESS; NAME alone is 1), repeatable')
+    parser.add_argument('--headless', action='store_true', help='render offscreen (EGL/OSMesa) and write frames')
+    parser.add_argument('--size', default='512x512', help='framebuffer size WxH of headless rendering')
+    parser.add_argument('--poses', help='JSON file with a list of poses, each a dict with any of ' + ', '.join(Scene.pose_keys))
+    parser.add_argument('--frames', type=int, default=36, help='number of orbit frames when no --poses is given')
+    parser.add_argument('--out', default='frames', help='output directory of headless rendering')
+    parser.add_argument('--batch', action='store_true', help='headless: render all poses (differing only in the camera) in a few instanced draws into an atlas, forward shaded')
+    parser.add_argument('--format', nargs='+', default=['png'], choices=['png', 'npy'], help='output frame formats')
+    parser.add_argument('--scale-step', type=float, default=0.001, help='marching step relative to the largest dimension')
+    parser.add_argument('--intersection', default='secant', choices=QuadFull.intersections, help='root refinement at a sign change')
+    parser.add_argument('--tolerance', type=float, default=0.0001, help='stop tolerance of the root refinement, relative as --scale-step')
+    parser.add_argument('--forward', action='store_true', help='shade in the raycast instead of raycasting into a G-buffer shaded by a separate pass')
+    parser.add_argument('--levels', nargs='+', metavar='LEVEL[:R,G,B,A]', help='composite the isosurfaces of these isolevels in one march (up to %d), each with a color and opacity' % QuadFull.max_levels)
+    parser.add_argument('--opacity-max', type=float, default=0.95, help='with --levels, stop the rays at this accumulated opacity')
+    parser.add_argument('--temporal', action='store_true', help='start the rays of a moving view before the reprojected hits of the previous frame')
+    parser.add_argument('--bbox-pass', action='store_true', help='rasterize the bbox into entry/exit textures instead of intersecting the rays with it in the shader')
+    parser.add_argument('--brick-cache', type=int, default=0, help='size (MB) of the GPU brick cache for volumes larger than GPU memory (0: one 3D texture)')
+    parser.add_argument('--compact', action='store_true', help='store float lattices as 16-bit normalized texels with scale/bias')
+    parser.add_argument('--packed', action='store_true', help='store runs of 4 lattice values along x in RGBA texels: fewer texture fetches per EVAL, 4x the texture memory')
+    parser.add_argument('--downscale', type=float, default=4, help='largest downscale factor while the view changes (1 disables it)')
+    parser.add_argument('--idle-delay', type=float, default=0.25, help='seconds without input before rendering at full resolution')
+    parser.add_argument('--frame-time', type=float, default=1/30, help='target frame time (s) while the view changes')
+    parser.add_argument('--rate', type=float, default=0, help='timesteps per second when playing a series (0: one per displayed frame)')
+    parser.add_argument('--play', action='store_true', help='start playing a series right away')
+    parser.add_argument('--profile', help='measure the GPU time of the bbox and raycast passes and write it to this file, one JSON line per frame')
+    parser.add_argument('--cost', action='store_true', help='headless: also write per-pixel march iteration and EVAL heatmaps of each frame (with --profile, their statistics)')
+    args = parser.parse_args()
+    Volume.size_cache = args.brick_cache << 20
+    Volume.compact = args.compact
+    Volume.packed = args.packed
+    if args.no_cache:
+        Program.path_binaries = None
+    info = open_dataset(args.volume, cache=not args.no_cache)
+    if info.timesteps is not None:
+        print(f'{args.volume}: {len(info.timesteps)} timesteps')
+
+    def set_options(scene):
+        if args.profile:
+            scene.timers.enabled = True
+            scene.timers.log = open(args.profile, 'w')
+        quad_full = scene.quad_full
+        quad_full.defines.update(parse_defines(args.define))
+        quad_full.scale_step = args.scale_step
+        quad_full.intersection = args.intersection
+        quad_full.tolerance = args.tolerance
+        quad_full.analytic_bbox = not args.bbox_pass
+        quad_full.deferred = not args.forward
+        quad_full.temporal = args.temporal
+        quad_full.opacity_max = args.opacity_max
+        if args.levels:
+            scene.levels = parse_levels(args.levels)
+
+    if args.headless:
+        width, height = (int(s) for s in args.size.lower().split('x'))
+        if args.poses:
+            poses = json.load(open(args.poses, 'r'))
+        else:
+            poses = orbit_poses(args.frames, timesteps=info.timesteps and len(info.timesteps))
+        renderer = HeadlessRenderer(info, width, height)
+        set_options(renderer.scene)
+        if args.batch:
+            renderer.render_batch(poses, args.out, args.format)
+        else:
+            renderer.render(poses, args.out, args.format, cost=args.cost)
+        return
+
+    rw = RenderWindow(info)
+    set_options(rw.scene)
+    rw.downscale_max = args.downscale
+    rw.idle_delay = args.idle_delay
+    rw.frame_time = args.frame_time
+    if rw.scene.volume.series is not None:
+        rw.scene.volume.series.rate = args.rate
+        rw.scene.volume.series.playing = args.play
+        print("Press SPACE to play/pause the series, . to step.")
     print("Starting raycaster. "
           "Press ESC to quit.")
     rw.run()
@@ -0,0 +1,30 @@
+import os
+import sys
+import pytest
+
+# the modules of the raycaster are scripts at the top of the repository
+path_repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, path_repo)
+# PyOpenGL binds its platform when it is first imported
+os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+
+@pytest.fixture(scope='session')
+def gl():
+    """ One headless GL context for the session (a second one in the process would not share
+    the programs), or skip the test without one. Programs are compiled, not cached."""
+    import raycaster_cc6
+    from OpenGL.GL import glEnable, GL_DEPTH_TEST
+    try:
+        context = raycaster_cc6.HeadlessContext(64, 64)
+    except Exception as err:
+        pytest.skip(f'no headless GL context: {err}')
+    raycaster_cc6.Program.path_binaries = None
+    glEnable(GL_DEPTH_TEST)
+    return context
+
+@pytest.fixture
+def repo(monkeypatch):
+    """ Runs the test in the repository directory, which holds the shaders and the registered
+    datasets (paths relative to it), and restores the working directory afterwards."""
+    monkeypatch.chdir(path_repo)
+    return path_repo
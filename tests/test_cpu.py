@@ -0,0 +1,24 @@
+import numpy as np
+from OpenGL.GL import *
+from raycaster_cc6 import Scene, FBO_render, volumes
+from cc6_cpu import CPURaycaster
+
+def test_matches_gpu(gl, repo):
+    # tiles of 16 pixels: the frame is split among the processes
+    size = 32
+    pose = {'angle_x': 320, 'angle_y': 30}
+    scene = Scene(size, size, volumes['ML40'])
+    scene.quad_full.deferred = False
+    scene.set_pose(pose)
+    fbo = FBO_render(size, size)
+    scene.render(fbo.fbo)
+    glBindFramebuffer(GL_READ_FRAMEBUFFER, fbo.fbo)
+    expected = np.frombuffer(glReadPixels(0, 0, size, size, GL_RGBA, GL_UNSIGNED_BYTE), np.uint8).reshape(size, size, 4)[::-1]
+    fbo.delete()
+    assert (expected != 255).any()      # the isosurface is in view
+    images = []
+    for processes in (1, 2):
+        with CPURaycaster(volumes['ML40'], size, size, processes=processes, size_tile=16) as raycaster:
+            images.append(raycaster.render(pose))
+    np.testing.assert_array_equal(images[0], images[1])
+    assert np.abs(images[0].astype(int) - expected).max() <= 1
@@ -0,0 +1,103 @@
+import gzip
+import json
+import numpy as np
+import pytest
+from cc6_datasets import DatasetCache, LatticeFile, open_dataset, volumes
+
+def lattice(seed=0, dim=(5, 4, 3), dtype=np.float32):
+    """ [z,y,x] array of a dim lattice."""
+    return np.random.default_rng(seed).random(dim[::-1]).astype(dtype)
+
+def read(info):
+    return LatticeFile(info.filename, info.dtype, info.dim, info.offset_file)[:]
+
+def write_nhdr(path, name, data, data_file=None, encoding='raw', endian='little'):
+    """ Writes name.nhdr with detached data (data_file) or name.nrrd with attached data."""
+    types = {'float32': 'float', 'uint8': 'uchar', 'uint16': 'ushort'}
+    header = ['NRRD0004', f'type: {types[data.dtype.name]}', 'dimension: 3',
+              'sizes: ' + ' '.join(str(s) for s in data.shape[::-1]), f'encoding: {encoding}',
+              f'endian: {endian}', 'space directions: (2,0,0) (0,2,0) (0,0,2)', 'space origin: (1,2,3)']
+    raw = data.astype(data.dtype.newbyteorder('>' if endian == 'big' else '<')).tobytes()
+    if encoding == 'gzip':
+        raw = gzip.compress(raw)
+    if data_file is None:
+        filename = path / (name + '.nrrd')
+        filename.write_bytes(('\n'.join(header) + '\n\n').encode() + raw)
+    else:
+        filename = path / (name + '.nhdr')
+        filename.write_text('\n'.join(header + [f'data file: {data_file}']) + '\n')
+        (path / data_file).write_bytes(raw)
+    return filename
+
+@pytest.fixture
+def cache(tmp_path):
+    return DatasetCache(str(tmp_path / 'cache'))
+
+def test_nrrd_attached(tmp_path, cache):
+    data = lattice()
+    info = open_dataset(str(write_nhdr(tmp_path, 'a', data)), cache)
+    assert info.dim == (5, 4, 3)
+    assert info.scale == (2, 2, 2)
+    assert info.offset == (1, 2, 3)
+    np.testing.assert_array_equal(read(info), data)
+
+def test_nrrd_converted(tmp_path, cache):
+    # gzip and big endian are converted into the cache
+    data = lattice()
+    info = open_dataset(str(write_nhdr(tmp_path, 'a', data, encoding='gzip', endian='big')), cache)
+    assert info.filename.startswith(cache.path)
+    np.testing.assert_array_equal(read(info), data)
+    with pytest.raises(ValueError):
+        open_dataset(str(tmp_path / 'a.nrrd'), cache=False)
+
+def test_raw_sidecar(tmp_path, cache):
+    data = lattice(dtype=np.uint16)
+    data.tofile(tmp_path / 'b.raw')
+    (tmp_path / 'b.json').write_text(json.dumps({'dtype': 'uint16', 'dim': [5, 4, 3], 'level': 7}))
+    info = open_dataset(str(tmp_path / 'b.raw'), cache)
+    assert info.level == 7
+    np.testing.assert_array_equal(read(info), data)
+
+def test_npy(tmp_path, cache):
+    data = lattice()
+    np.save(tmp_path / 'c.npy', data)
+    info = open_dataset(str(tmp_path / 'c.npy'), cache)
+    assert info.dim == (5, 4, 3)
+    # no isolevel in the header: the middle of the value range
+    assert info.level == pytest.approx(.5*(data.min() + data.max()))
+    np.testing.assert_array_equal(read(info), data)
+
+def test_series_nhdr(tmp_path, cache):
+    # detached data files are not timesteps of their own
+    steps = [lattice(i) for i in range(2)]
+    for i, data in enumerate(steps):
+        write_nhdr(tmp_path, f't{i}', data, data_file=f't{i}.raw')
+    info = open_dataset(str(tmp_path), cache)
+    assert len(info.timesteps) == 2
+    for t, data in zip(info.timesteps, steps):
+        np.testing.assert_array_equal(read(t), data)
+    assert info.timesteps[1].level == info.level
+
+def test_series_sidecars(tmp_path, cache):
+    for i in range(3):
+        lattice(i).tofile(tmp_path / f'{i}.raw')
+        (tmp_path / f'{i}.json').write_text(json.dumps({'dtype': 'float32', 'dim': [5, 4, 3], 'level': 0.5}))
+    info = open_dataset(str(tmp_path), cache)
+    assert [t.filename for t in info.timesteps] == [str(tmp_path / f'{i}.raw') for i in range(3)]
+
+def test_registered_copy(cache):
+    # the registry entry does not keep the cache of a caller
+    info = open_dataset('ML40', cache)
+    assert info.cache is cache and info is not volumes['ML40']
+    assert volumes['ML40'].cache is None
+    assert open_dataset('ML40', cache=False).cache is None
+
+def test_cache_key(tmp_path, cache):
+    filename = tmp_path / 'd.npy'
+    np.save(filename, lattice())
+    key = cache.key(str(filename))
+    assert DatasetCache(cache.path).key(str(filename)) == key
+    np.save(filename, lattice(1))
+    assert cache.key(str(filename)) != key
+    assert cache.get(key, 'x', lambda: np.arange(3)).tolist() == [0, 1, 2]
+    assert cache.get(key, 'x', lambda: None).tolist() == [0, 1, 2]
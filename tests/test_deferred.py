@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from OpenGL.GL import *
+from raycaster_cc6 import Scene, FBO_render, volumes
+
+def render(scene, fbo, pose):
+    scene.set_pose(pose)
+    scene.render(fbo.fbo)
+    glBindFramebuffer(GL_READ_FRAMEBUFFER, fbo.fbo)
+    return np.frombuffer(glReadPixels(0, 0, fbo.width, fbo.height, GL_RGBA, GL_UNSIGNED_BYTE), np.uint8).copy()
+
+@pytest.mark.parametrize('temporal', [False, True])
+def test_deferred_matches_forward(gl, repo, temporal):
+    # consecutive views of a camera motion, the default deferred path against --forward
+    size = 32
+    poses = [{'angle_x': 320, 'angle_y': angle_y} for angle_y in range(0, 60, 10)]
+    fbo = FBO_render(size, size)
+    images = []
+    for deferred in (False, True):
+        scene = Scene(size, size, volumes['ML40'])
+        assert scene.quad_full.deferred and not scene.quad_full.temporal
+        scene.quad_full.deferred = deferred
+        scene.quad_full.temporal = temporal
+        images.append([render(scene, fbo, pose) for pose in poses])
+    fbo.delete()
+    for forward, deferred in zip(*images):
+        assert (forward != 255).any()   # the isosurface is in view
+        np.testing.assert_array_equal(forward, deferred)
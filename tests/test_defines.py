@@ -0,0 +1,14 @@
+import pytest
+from raycaster_cc6 import parse_defines, Scene, volumes
+
+def test_parse_defines():
+    assert parse_defines(['SHADING_BLINN_PHONG', 'NO_PREPROCESS', 'X=0', 'Y=2']) == \
+        {'SHADING_BLINN_PHONG': '1', 'NO_PREPROCESS': '1', 'X': '0', 'Y': '2'}
+
+@pytest.mark.parametrize('define', ['SHADING_BLINN_PHONG', 'SHADING_BLINN_PHONG=0', 'NO_PREPROCESS'])
+def test_define_compiles(gl, repo, define):
+    # the raycast (forward and G-buffer) and the shading programs build with the define
+    quad_full = Scene(8, 8, volumes['ML40']).quad_full
+    quad_full.defines.update(parse_defines([define]))
+    for program in (quad_full.program(), quad_full.program(gbuffer=True), quad_full.program_shade()):
+        assert program.id
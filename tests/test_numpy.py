@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+from cc6_numpy import CC6Evaluator, compute_minmax
+
+DIM = (9, 8, 7)
+
+@pytest.fixture(scope='module')
+def evaluator():
+    data = np.random.default_rng(1).random(DIM[::-1])
+    return CC6Evaluator(data, dtype=np.float64, n_threads=1)
+
+def interior_points(n, seed=2):
+    """ Points whose stencil stays within the lattice."""
+    return np.random.default_rng(seed).uniform(2.5, np.array(DIM) - 3.5, (n, 3))
+
+def test_gradient_finite_differences(evaluator):
+    p = interior_points(200)
+    h = 1e-5
+    value, g, H = evaluator.evaluate(p)
+    for axis in range(3):
+        e = np.eye(3)[axis]*h
+        fd = (evaluator.value(p + e) - evaluator.value(p - e))/(2*h)
+        np.testing.assert_allclose(g[:, axis], fd, atol=1e-6)
+
+def test_hessian_finite_differences(evaluator):
+    p = interior_points(200)
+    h = 1e-5
+    H = evaluator.evaluate(p)[2]
+    fd = np.empty((len(p), 3, 3))
+    for axis in range(3):
+        e = np.eye(3)[axis]*h
+        fd[:, axis] = (evaluator.evaluate(p + e)[1] - evaluator.evaluate(p - e)[1])/(2*h)
+    # xx, yy, zz, yz, zx, xy as compute_Hessian()
+    pairs = [(0, 0), (1, 1), (2, 2), (1, 2), (2, 0), (0, 1)]
+    fd = np.stack([fd[:, i, j] for i, j in pairs], axis=1)
+    # the second derivatives jump across the pieces, a few points straddle one
+    close = np.isclose(H, fd, atol=1e-4).all(axis=1)
+    assert close.mean() > 0.95
+
+def test_reproduces_linear():
+    # the box-spline sums up to one and is symmetric: linear functions are reproduced
+    z, y, x = np.meshgrid(*(np.arange(n) for n in DIM[::-1]), indexing='ij')
+    a = np.array([0.3, -0.2, 0.7])
+    evaluator = CC6Evaluator(a[0]*x + a[1]*y + a[2]*z + 1, dtype=np.float64, n_threads=1)
+    p = interior_points(100)
+    value, g, H = evaluator.evaluate(p)
+    np.testing.assert_allclose(value, p @ a + 1, atol=1e-9)
+    np.testing.assert_allclose(g, np.broadcast_to(a, g.shape), atol=1e-9)
+    np.testing.assert_allclose(H, 0, atol=1e-9)
+
+def test_interpolates_nothing_outside():
+    # far outside the lattice every coefficient is 0
+    evaluator = CC6Evaluator(np.ones(DIM[::-1]), n_threads=1)
+    assert evaluator.value(np.array([[-4., -4., -4.], [20., 1., 1.]])).tolist() == [0, 0]
+
+def test_chunks_and_threads(evaluator):
+    p = interior_points(1000)
+    chunked = CC6Evaluator(evaluator.lattice, dtype=np.float64, size_chunk=64, n_threads=3, padded=True)
+    # the matrix products of other batch sizes may round differently
+    for a, b in zip(evaluator.evaluate(p), chunked.evaluate(p)):
+        np.testing.assert_allclose(a, b, rtol=1e-12, atol=1e-15)
+    # the value-only path groups the points differently
+    np.testing.assert_allclose(chunked.value(p), evaluator.evaluate(p)[0], rtol=1e-12)
+
+def test_minmax_bounds(evaluator):
+    data = evaluator.lattice[5:-5, 5:-5, 5:-5]
+    size_macro = 4
+    minmax = compute_minmax(data, size_macro)
+    p = np.random.default_rng(3).uniform(0, np.array(DIM) - 1, (2000, 3))
+    cell = (p // size_macro).astype(int)
+    lo, hi = minmax[cell[:, 2], cell[:, 1], cell[:, 0]].T
+    value = evaluator.value(p)
+    assert (value >= lo - 1e-6).all() and (value <= hi + 1e-6).all()
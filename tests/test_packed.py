@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from OpenGL.GL import *
+from raycaster_cc6 import pack_rows, Scene, FBO_render, volumes
+
+def test_pack_rows():
+    texels = np.arange(2*3*5, dtype=np.uint16).reshape(2, 3, 5) + 1
+    packed = pack_rows(texels)
+    assert packed.shape == (2, 3, 6, 4) and packed.flags.c_contiguous
+    # texel i of a row holds the texels i-2 .. i+1, 0 beyond the ends
+    padded = np.pad(texels, ((0, 0), (0, 0), (2, 2)))
+    for i in range(6):
+        np.testing.assert_array_equal(packed[:, :, i], padded[:, :, i:i+4])
+
+def render(scene, fbo, pose):
+    scene.set_pose(pose)
+    scene.render(fbo.fbo)
+    glBindFramebuffer(GL_READ_FRAMEBUFFER, fbo.fbo)
+    return np.frombuffer(glReadPixels(0, 0, fbo.width, fbo.height, GL_RGBA, GL_UNSIGNED_BYTE), np.uint8).copy()
+
+@pytest.mark.parametrize('deferred', [False, True])
+def test_packed_matches_plain(gl, repo, deferred):
+    size = 24
+    fbo = FBO_render(size, size)
+    images = []
+    for packed in (False, True):
+        scene = Scene(size, size, volumes['ML40'], packed=packed)
+        assert scene.volume.fetches_per_eval == (15 if packed else 38)
+        scene.quad_full.deferred = deferred
+        scene.quad_full.temporal = False
+        images.append([render(scene, fbo, {'angle_x': angle_x, 'angle_y': angle_y})
+                       for angle_x, angle_y in ((320, 30), (200, 75))])
+    fbo.delete()
+    for plain, packed in zip(*images):
+        assert (plain != 255).any()     # the isosurface is in view
+        np.testing.assert_array_equal(plain, packed)
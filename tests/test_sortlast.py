@@ -0,0 +1,86 @@
+import threading
+import numpy as np
+import pytest
+from cc6_numpy import CC6Evaluator
+from cc6_sortlast import slabs, slab_apron, merge, composite, SortLastRenderer
+
+@pytest.mark.parametrize('dim_z, num_workers', [(81, 1), (81, 2), (81, 3), (41, 8), (5, 5)])
+def test_slabs_partition(dim_z, num_workers):
+    parts = slabs(dim_z, num_workers, 3)
+    assert parts[0][0] == 0 and parts[-1][1] == dim_z
+    assert all(a[1] == b[0] for a, b in zip(parts, parts[1:]))
+    sizes = [z1 - z0 for z0, z1, apron in parts]
+    assert max(sizes) - min(sizes) <= 1
+    assert all(apron == 3 for z0, z1, apron in parts)
+
+def test_apron_covers_the_stencil():
+    # samples up to a step outside a slab evaluate the same from the slab's planes and apron alone
+    dim = (12, 11, 40)
+    data = np.random.default_rng(0).random(dim[::-1])
+    full = CC6Evaluator(data, dtype=np.float64, n_threads=1)
+    scale_step = 0.02
+    step = scale_step*max(dim)
+    apron = slab_apron(scale_step, max(dim))
+    rng = np.random.default_rng(1)
+    for z0, z1, apron in slabs(dim[2], 3, apron):
+        z_tex = max(z0 - apron, 0)
+        part = CC6Evaluator(data[z_tex:min(z1 + apron, dim[2])], dtype=np.float64, n_threads=1)
+        p = rng.uniform((0, 0, max(z0 - step, 0)), (dim[0] - 1, dim[1] - 1, min(z1 + step, dim[2] - 1)), (500, 3))
+        np.testing.assert_array_equal(part.value(p - (0, 0, z_tex)), full.value(p))
+
+def test_merge_keeps_the_nearer():
+    color = np.zeros((2, 3, 4), np.uint8)
+    depth = np.full((2, 3), .5, np.float32)
+    color_other = np.full((2, 3, 4), 9, np.uint8)
+    depth_other = np.array([[.4, .6, .4], [.4, .4, .4]], np.float32)
+    merge(color, depth, color_other, depth_other, 0, 1)
+    np.testing.assert_allclose(depth, [[.4, .5, .4], [.5, .5, .5]])
+    assert color[..., 0].tolist() == [[9, 0, 9], [0, 0, 0]]
+
+@pytest.mark.parametrize('num_workers', [1, 2, 3, 4, 5, 8])
+def test_composite(num_workers):
+    height, width = 16, 5
+    rng = np.random.default_rng(num_workers)
+    color = rng.integers(0, 256, (num_workers, height, width, 4), dtype=np.uint8)
+    depth = rng.random((num_workers, height, width)).astype(np.float32)
+    nearest = depth.argmin(axis=0)
+    expected = np.take_along_axis(color, nearest[None, ..., None], axis=0)[0]
+    expected_depth = depth.min(axis=0)
+
+    barrier = threading.Barrier(num_workers)
+    rows = [None]*num_workers
+    def run(rank):
+        rows[rank] = composite(rank, num_workers, color, depth, barrier)
+    threads = [threading.Thread(target=run, args=(rank,)) for rank in range(num_workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # the rows of the workers cover the image once
+    covered = np.zeros(height, int)
+    for rank, (y0, y1) in enumerate(rows):
+        covered[y0:y1] += 1
+        np.testing.assert_array_equal(color[rank, y0:y1], expected[y0:y1])
+        np.testing.assert_array_equal(depth[rank, y0:y1], expected_depth[y0:y1])
+    assert (covered == 1).all()
+
+@pytest.mark.parametrize('num_workers', [2, 3, 4])
+def test_matches_single_node(gl, repo, num_workers):
+    # an oblique pose, where the rays through several slabs are longer than MAX_ITERATIONS steps
+    from OpenGL.GL import glBindFramebuffer, glReadPixels, GL_READ_FRAMEBUFFER, GL_RGBA, GL_UNSIGNED_BYTE
+    from raycaster_cc6 import Scene, FBO_render, volumes
+    size = 32
+    pose = {'angle_x': 320, 'angle_y': 120}
+    scene = Scene(size, size, volumes['ML40'])
+    scene.quad_full.deferred = False
+    scene.set_pose(pose)
+    fbo = FBO_render(size, size)
+    scene.render(fbo.fbo)
+    glBindFramebuffer(GL_READ_FRAMEBUFFER, fbo.fbo)
+    expected = np.frombuffer(glReadPixels(0, 0, size, size, GL_RGBA, GL_UNSIGNED_BYTE), np.uint8).reshape(size, size, 4)[::-1]
+    fbo.delete()
+    assert (expected != 255).any()      # the isosurface is in view
+    with SortLastRenderer('ML40', size, size, num_workers) as renderer:
+        img = renderer.render(pose)
+    assert np.abs(img.astype(int) - expected).max() <= 2
@@ -0,0 +1,49 @@
+import ctypes
+import numpy as np
+from OpenGL.GL import *
+from raycaster_cc6 import std140_dtype, QuadFull, Volume, Program
+
+def offsets(dtype):
+    return {name: dtype.fields[name][1] for name in dtype.names}
+
+def test_scalars_and_vectors():
+    dtype = std140_dtype([('a', 'float'), ('b', 'vec3'), ('c', 'float'), ('d', 'vec2'), ('e', 'int'), ('f', 'mat4'), ('g', 'bool')])
+    # a vec3 aligns to 16 and a following scalar fills its last 4 bytes
+    assert offsets(dtype) == {'a': 0, 'b': 16, 'c': 28, 'd': 32, 'e': 40, 'f': 48, 'g': 112}
+    assert dtype.itemsize == 128
+
+def test_arrays():
+    dtype = std140_dtype([('a', 'float'), ('levels', 'float', 8), ('b', 'int'), ('colors', 'vec4', 2)])
+    # arrays have a vec4 stride and start on 16 bytes
+    assert offsets(dtype) == {'a': 0, 'levels': 16, 'b': 144, 'colors': 160}
+    assert dtype['levels'].shape == (8, 4)
+    assert dtype.itemsize == 192
+
+def test_fields_written():
+    data = np.zeros((), std140_dtype([('s', 'float'), ('v', 'vec3'), ('m', 'mat4')]))
+    data['v'] = (1, 2, 3)
+    data['m'] = np.arange(16).reshape(4, 4)
+    floats = np.frombuffer(data.tobytes(), np.float32)
+    assert floats[4:7].tolist() == [1, 2, 3]
+    assert floats[8:24].tolist() == list(range(16))
+
+def test_blocks_match_the_shader(gl, repo):
+    # the offsets the GL compiler gives the members of the Frame and Volume blocks
+    prog = Program.variant('raycast_simple.vert', 'cc6_raycast_curvature.frag', ['columns', 'rows'], {}, QuadFull.samplers).id
+    for block, fields in (('Frame', QuadFull.uniform_fields), ('Volume', Volume.uniform_fields)):
+        dtype = std140_dtype(fields)
+        index = glGetUniformBlockIndex(prog, block)
+        size = np.zeros(1, np.int32)
+        glGetActiveUniformBlockiv(prog, index, GL_UNIFORM_BLOCK_DATA_SIZE, size)
+        assert size[0] == dtype.itemsize
+        for name in dtype.names:
+            # arrays are named with their first element
+            member = name + '[0]' if dtype[name].shape[:1] == (QuadFull.max_levels,) else name
+            names = (ctypes.c_char_p*1)(member.encode())
+            indices = np.zeros(1, np.uint32)
+            glGetUniformIndices(prog, 1, ctypes.cast(names, ctypes.POINTER(ctypes.POINTER(ctypes.c_char))), indices)
+            if indices[0] == GL_INVALID_INDEX:
+                continue        # not used by this variant, so not active
+            offset = np.zeros(1, np.int32)
+            glGetActiveUniformsiv(prog, 1, indices, GL_UNIFORM_OFFSET, offset)
+            assert offset[0] == dtype.fields[name][1], (block, name)
@@ -0,0 +1,30 @@
+import numpy as np
+from OpenGL.GL import *
+from raycaster_cc6 import Scene, FBO_render, volumes
+
+def render(scene, fbo, pose):
+    scene.set_pose(pose)
+    scene.render(fbo.fbo)
+    glBindFramebuffer(GL_READ_FRAMEBUFFER, fbo.fbo)
+    return np.frombuffer(glReadPixels(0, 0, fbo.width, fbo.height, GL_RGBA, GL_UNSIGNED_BYTE), np.uint8).copy()
+
+def test_temporal_matches_full(gl, repo):
+    # an orbit in steps of 10 degrees, through views where thin features are uncovered
+    size = 32
+    poses = [{'angle_x': 320, 'angle_y': angle_y} for angle_y in range(200, 280, 10)]
+    fbo = FBO_render(size, size)
+    images = []
+    for temporal in (False, True):
+        scene = Scene(size, size, volumes['ML40'])
+        scene.quad_full.temporal = temporal
+        full = []
+        images.append([])
+        for pose in poses:
+            images[-1].append(render(scene, fbo, pose))
+            full.append(scene.gbuffer_full)
+    fbo.delete()
+    # every other frame starts from the reprojected hits of the fully marched one before
+    assert full == [True, False]*(len(poses)//2)
+    for plain, temporal in zip(*images):
+        assert (plain != 255).any()     # the isosurface is in view
+        np.testing.assert_array_equal(plain, temporal)